@@ -0,0 +1,214 @@
+import io, json, sqlite3, sys, threading, time
+import os.path as op, os
+
+from SoXspectroCore import ExportResult, build_sox_command, choose_backend, file_signature
+
+# Packed spectrogram archive: one SQLite file per folder instead of one image file per track.
+# Each row holds an image (or .npy output), the render parameters and the fingerprint of the audio file it was
+# rendered from, so a folder can be shown again from its archive without running SoX.
+# List an archive: python SoXspectroArchive.py <folder or archive>
+
+ARCHIVE_NAME = "Spectrograms.sqlite"
+ARCHIVE_FORMAT = 'png' # 'png', 'webp' or 'jpeg'. webp and jpeg are encoded by Pillow when installed, PyQt5 otherwise
+ARCHIVE_QUALITY = 90 # webp and jpeg
+ARCHIVE_BATCH = 200 # images written per transaction
+
+FORMAT_EXTENSIONS = {'png': '.png', 'webp': '.webp', 'jpeg': '.jpg'}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    name TEXT PRIMARY KEY, -- file name the image would have on disk
+    source TEXT NOT NULL, -- name of the audio file
+    output TEXT NOT NULL, -- render output suffix: '.png', '_thumb.png', '.npy'...
+    format TEXT NOT NULL,
+    params TEXT, -- JSON, see render_params
+    fingerprint TEXT, -- JSON [size, mtime_ns] of the audio file when it was rendered
+    analysis TEXT, -- JSON lossy transcode metrics, or NULL
+    created REAL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_source ON images (source, output);
+"""
+
+
+def render_params(job):
+    # What the image depends on besides the audio: backend and SoX arguments, as in the cache key
+    return {'backend': choose_backend(job), 'command': build_sox_command(job, ())[1:]}
+
+
+def convert_image(data, image_format=ARCHIVE_FORMAT, quality=ARCHIVE_QUALITY):
+    # PNG bytes to image_format
+    if image_format == 'png':
+        return data
+    if image_format not in FORMAT_EXTENSIONS:
+        raise ValueError(f"Unknown archive image format: {image_format}")
+    try:
+        from PIL import Image
+    except ImportError:
+        from PyQt5.QtCore import QBuffer
+        from PyQt5.QtGui import QImage
+
+        image = QImage.fromData(data)
+        buffer = QBuffer()
+        buffer.open(QBuffer.WriteOnly)
+        if image.isNull() or not image.save(buffer, image_format.upper(), quality):
+            raise ValueError(f"Qt could not encode {image_format}, install Pillow")
+        return bytes(buffer.data())
+    with Image.open(io.BytesIO(data)) as image:
+        output = io.BytesIO()
+        image.convert('RGB').save(output, image_format.upper(), quality=quality)
+        return output.getvalue()
+
+
+class SpectrogramArchive:
+    # SQLite archive of one folder. Safe to share between threads, reads are random access by image name
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(op.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def put_many(self, rows):
+        # rows: (name, source, output, format, params, fingerprint, analysis, data), written in one transaction
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO images (name, source, output, format, params, fingerprint, analysis, created, data) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(name, source, output, image_format, json.dumps(params), json.dumps(fingerprint), json.dumps(analysis), now, data)
+                 for name, source, output, image_format, params, fingerprint, analysis, data in rows])
+
+    def read(self, name):
+        with self.lock:
+            row = self.connection.execute("SELECT data FROM images WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise OSError(f"{name} is not in {self.path}")
+        return bytes(row[0])
+
+    def names(self):
+        with self.lock:
+            return {name for name, in self.connection.execute("SELECT name FROM images")}
+
+    def records(self):
+        # {(source, output): record} of every image, without the image data
+        with self.lock:
+            rows = self.connection.execute("SELECT name, source, output, format, params, fingerprint, analysis, length(data) FROM images").fetchall()
+        return {(source, output): {'name': name, 'format': image_format, 'params': json.loads(params), 'fingerprint': json.loads(fingerprint),
+                                   'analysis': json.loads(analysis), 'size': size}
+                for name, source, output, image_format, params, fingerprint, analysis, size in rows}
+
+    def find(self, job, records, output='.png'):
+        # Record of the image of job when it was rendered from the current file with the same parameters, None otherwise
+        record = records.get((job.name, output))
+        signature = file_signature(job.path)
+        if record is None or signature is None or record['fingerprint'] != list(signature) or record['params'] != render_params(job):
+            return None
+        return record
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def archive_path(folder):
+    return op.join(folder, ARCHIVE_NAME)
+
+
+def open_archive(folder):
+    # Archive of a folder, None when it has none
+    path = archive_path(folder)
+    return SpectrogramArchive(path) if op.isfile(path) else None
+
+
+class ArchiveWriter:
+    # Groups images by folder into the archive of each folder, ARCHIVE_BATCH images per transaction.
+    # add() takes the path the image would have as a loose file, a full batch is written right away
+    def __init__(self, image_format=ARCHIVE_FORMAT, quality=ARCHIVE_QUALITY, batch_size=ARCHIVE_BATCH):
+        self.image_format = image_format
+        self.quality = quality
+        self.batch_size = batch_size
+        self.archives = {} # folder -> SpectrogramArchive
+        self.pending = {} # folder -> [(row, conversion seconds)]
+
+    def member_path(self, file_path):
+        # Path of the image in its archive, as reported in the ExportResults: <folder>/Spectrograms.sqlite/<name>
+        folder, name = op.split(file_path)
+        if not name.endswith('.npy'):
+            name = op.splitext(name)[0] + FORMAT_EXTENSIONS[self.image_format]
+        return op.join(archive_path(folder), name)
+
+    def add(self, data, file_path, job=None, analysis=None):
+        # Returns the ExportResults of the batch written, if this image completed one
+        start = time.perf_counter()
+        folder, name = op.split(file_path)
+        if job is None:
+            output = op.splitext(name)[1]
+        elif name.startswith(job.name): # "track.flac.png" names of SoXspectroD&D
+            output = name[len(job.name):]
+        else: # "track.png"
+            output = name[len(op.splitext(job.name)[0]):]
+        image_format = 'npy' if name.endswith('.npy') else self.image_format
+        try:
+            if image_format != 'npy':
+                data = convert_image(data, image_format, self.quality)
+                name = op.splitext(name)[0] + FORMAT_EXTENSIONS[image_format]
+        except (ImportError, ValueError) as e:
+            return [ExportResult(op.join(archive_path(folder), name), error=f"{type(e).__name__}: {e}", elapsed=time.perf_counter() - start)]
+        row = (name, job.name if job is not None else name, output, image_format, render_params(job) if job is not None else None,
+               list(file_signature(job.path) or ()) if job is not None else None, analysis, data)
+        self.pending.setdefault(folder, []).append((row, time.perf_counter() - start))
+        if len(self.pending[folder]) >= self.batch_size:
+            return self.flush(folder)
+        return []
+
+    def flush(self, folder=None):
+        # Writes the pending images (of one folder, of all by default) and returns their ExportResults
+        results = []
+        for folder in ([folder] if folder is not None else list(self.pending)):
+            batch = self.pending.pop(folder, [])
+            if not batch:
+                continue
+            start = time.perf_counter()
+            path = archive_path(folder)
+            try:
+                archive = self.archives.get(folder)
+                if archive is None:
+                    archive = self.archives[folder] = SpectrogramArchive(path)
+                archive.put_many([row for row, _ in batch])
+                error = None
+            except (OSError, sqlite3.Error) as e:
+                error = f"{type(e).__name__}: {e}"
+            elapsed = (time.perf_counter() - start) / len(batch) # the transaction is shared by the batch
+            for row, convert_time in batch:
+                results.append(ExportResult(op.join(path, row[0]), written=error is None, error=error,
+                                            elapsed=convert_time + elapsed, bytes_out=len(row[-1]) if error is None else 0))
+        return results
+
+    def close(self):
+        results = self.flush()
+        for archive in self.archives.values():
+            archive.close()
+        self.archives.clear()
+        return results
+
+
+def export_archive(items, image_format=ARCHIVE_FORMAT, quality=ARCHIVE_QUALITY, batch_size=ARCHIVE_BATCH):
+    # items: (image bytes, output path, RenderJob, analysis). Generator yielding one ExportResult per item, batch by batch
+    writer = ArchiveWriter(image_format, quality, batch_size)
+    for data, file_path, job, analysis in items:
+        yield from writer.add(data, file_path, job, analysis)
+    yield from writer.close()
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else "."
+    path = archive_path(path) if op.isdir(path) else path
+    if not op.isfile(path):
+        sys.exit("No archive: " + path)
+    archive = SpectrogramArchive(path)
+    records = archive.records()
+    for (source, output), record in sorted(records.items()):
+        print(f"{record['name']:<40} {record['format']:<5} {record['size']:>9} bytes  {source}")
+    print(f"{archive.path} : {len(records)} images, {sum(record['size'] for record in records.values()) / (1024 * 1024):.1f} MB")
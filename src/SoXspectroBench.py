@@ -0,0 +1,245 @@
+import argparse, io, json, platform, shutil, subprocess, sys, tempfile, time, wave
+import os.path as op, os
+from datetime import datetime, timezone
+
+import numpy as np
+
+from SoXspectroCore import RenderJob, RenderEngine, build_sox_command, write_atomic, SoXPath, SoXSpectroW, SoXSpectroH, MAX_WORKERS
+from SoXspectroStats import peak_rss_mb
+
+# Performance benchmark of the rendering pipeline on a deterministic synthetic corpus. Runs headless.
+#   python SoXspectroBench.py --output bench.json                      (full corpus)
+#   python SoXspectroBench.py --quick --baseline bench.json            (compare, exit code 1 on regression)
+
+CORPUS_DIR = op.join(tempfile.gettempdir(), "SoXspectroBench")
+SEED = 1234
+
+KINDS = ('sweep', 'noise')
+DURATIONS = (5, 30, 120) # seconds
+SAMPLE_RATES = (44100, 96000)
+CHANNELS = (1, 2)
+FORMATS = ('wav', 'flac')
+QUICK = dict(durations=(5,), sample_rates=(44100,), channels=(2,), formats=('wav',))
+
+REGRESSION_THRESHOLD = 0.15 # relative slowdown flagged when comparing with a baseline
+
+
+def synth(kind, duration, sample_rate, channels, seed=SEED):
+    # (frames, channels) float array in [-1, 1]
+    t = np.arange(int(duration * sample_rate)) / sample_rate
+    if kind == 'sweep': # logarithmic sweep from 20 Hz to the Nyquist frequency, channels slightly detuned
+        f0 = 20
+        signals = []
+        for c in range(channels):
+            rate = np.log(sample_rate / 2 * (.95 - .05 * c) / f0) / duration
+            signals.append(np.sin(2 * np.pi * f0 / rate * (np.exp(rate * t) - 1)))
+        return .8 * np.stack(signals, axis=1)
+    rng = np.random.default_rng(seed + channels * 1000 + sample_rate + int(duration))
+    return np.clip(rng.normal(0, .25, (len(t), channels)), -1, 1)
+
+
+def write_wav(file_path, samples, sample_rate, sample_width):
+    scale = 2 ** (8 * sample_width - 1) - 1
+    data = np.round(samples * scale).astype(np.int32)
+    if sample_width == 3:
+        raw = data.astype('<i4').view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+    else:
+        raw = data.astype('<i2').tobytes()
+    with wave.open(file_path, 'wb') as wav:
+        wav.setnchannels(samples.shape[1])
+        wav.setsampwidth(sample_width)
+        wav.setframerate(sample_rate)
+        wav.writeframes(raw)
+
+
+def convert(wav_path, file_path, sox_path=SoXPath):
+    # Transcodes with SoX, or ffmpeg when SoX is missing. Returns False when neither can do it
+    for command in ([sox_path, wav_path, file_path], ['ffmpeg', '-v', 'error', '-y', '-i', wav_path, file_path]):
+        try:
+            if subprocess.run(command, capture_output=True).returncode == 0:
+                return True
+        except OSError:
+            pass
+    return False
+
+
+def make_corpus(folder=CORPUS_DIR, kinds=KINDS, durations=DURATIONS, sample_rates=SAMPLE_RATES, channels=CHANNELS,
+                formats=FORMATS, sox_path=SoXPath):
+    # Generates the files that do not exist yet and returns the list of corpus files
+    os.makedirs(folder, exist_ok=True)
+    files = []
+    for kind in kinds:
+        for duration in durations:
+            for sample_rate in sample_rates:
+                for channel_count in channels:
+                    name = f"{kind}_{duration}s_{sample_rate // 1000}k_{channel_count}ch"
+                    wav_path = op.join(folder, name + ".wav")
+                    if not op.exists(wav_path):
+                        write_wav(wav_path, synth(kind, duration, sample_rate, channel_count), sample_rate, 3 if sample_rate > 48000 else 2)
+                    for file_format in formats:
+                        file_path = op.join(folder, f"{name}.{file_format}")
+                        if op.exists(file_path) or convert(wav_path, file_path, sox_path):
+                            files.append(file_path)
+                        else:
+                            print(f"Skipping {file_format}: no encoder available")
+    return files
+
+
+class StageTimer:
+    def __init__(self):
+        self.stages = {}
+
+    def time(self, stage, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        self.stages.setdefault(stage, []).append(time.perf_counter() - start)
+        return result
+
+    def summary(self):
+        return {stage: {'files': len(times), 'total_s': sum(times), 'mean_s': sum(times) / len(times)}
+                for stage, times in self.stages.items()}
+
+
+def bench_legacy_stages(files, out_dir, sox_path=SoXPath):
+    # The original process_audio/save_images path, one stage at a time:
+    # file read, pydub decode, WAV export, SoX spectrogram, image decode, PNG write
+    from pydub import AudioSegment
+    try:
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        from PyQt5.QtGui import QImage
+    except ImportError:
+        QImage = None
+
+    timer = StageTimer()
+    start = time.perf_counter()
+    for file_path in files:
+        def read():
+            with open(file_path, "rb") as file:
+                return file.read()
+
+        def sox(wav_data):
+            job = RenderJob(file_path, width=SoXSpectroW, height=SoXSpectroH, sox_path=sox_path)
+            return subprocess.run(build_sox_command(job), input=wav_data, capture_output=True, check=True).stdout
+
+        audio_data = timer.time('read', read)
+        audio_segment = timer.time('pydub_decode', AudioSegment.from_file, io.BytesIO(audio_data))
+        wav_data = timer.time('wav_export', lambda: audio_segment.export(format='wav').read())
+        image = timer.time('sox_spectrogram', sox, wav_data)
+        if QImage is not None:
+            timer.time('image_decode', QImage.fromData, image)
+        timer.time('png_write', write_atomic, op.join(out_dir, op.basename(file_path) + ".png"), image)
+    return timer.summary(), time.perf_counter() - start
+
+
+def bench_engine(files, backend, workers, sox_path=SoXPath):
+    jobs = [RenderJob(file_path, index, SoXSpectroW, SoXSpectroH, sox_path, backend=backend) for index, file_path in enumerate(files)]
+    start = time.perf_counter()
+    results = list(RenderEngine(workers).run(jobs))
+    failed = [result for result in results if not result.ok]
+    if failed:
+        raise RuntimeError(f"{len(failed)} files failed, first: {op.basename(failed[0].job.path)}: {failed[0].error.strip()}")
+    return time.perf_counter() - start
+
+
+def pipeline_entry(files, seconds):
+    return {'files': len(files), 'seconds': seconds, 'files_per_s': len(files) / seconds if seconds else 0.0}
+
+
+def run(args):
+    if args.quick:
+        corpus = make_corpus(args.corpus, sox_path=args.sox, **QUICK)
+    else:
+        corpus = make_corpus(args.corpus, sox_path=args.sox)
+    print(f"{len(corpus)} corpus files in {args.corpus}")
+
+    report = {
+        'date': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'workers': args.workers,
+        'quick': args.quick,
+        'files': len(corpus),
+        'corpus_bytes': sum(op.getsize(file_path) for file_path in corpus),
+        'stages': {},
+        'pipelines': {},
+        'skipped': {},
+    }
+    sox_available = shutil.which(args.sox) is not None or op.isfile(args.sox)
+
+    out_dir = tempfile.mkdtemp(prefix="SoXspectroBench_out_")
+    try:
+        if sox_available:
+            try:
+                stages, seconds = bench_legacy_stages(corpus, out_dir, args.sox)
+                report['stages'] = stages
+                report['pipelines']['legacy_serial'] = pipeline_entry(corpus, seconds)
+            except (ImportError, OSError) as e: # pydub or its ffmpeg missing
+                report['skipped']['legacy_serial'] = str(e)
+        else:
+            report['skipped']['legacy_serial'] = report['skipped']['engine_sox'] = "SoX not found"
+        for backend in ('sox', 'numpy') if sox_available else ('numpy',):
+            try:
+                report['pipelines']['engine_' + backend] = pipeline_entry(corpus, bench_engine(corpus, backend, args.workers, args.sox))
+            except RuntimeError as e: # a time missing some files would not compare with other runs
+                report['skipped']['engine_' + backend] = str(e)
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    report['peak_rss_mb'] = peak_rss_mb()
+    return report
+
+
+def compare(report, baseline, threshold=REGRESSION_THRESHOLD):
+    # Returns the list of metrics slower than the baseline by more than threshold
+    regressions = []
+    for name, entry in report['pipelines'].items():
+        old = baseline.get('pipelines', {}).get(name)
+        if old and old['files_per_s'] and entry['files_per_s'] < old['files_per_s'] * (1 - threshold):
+            regressions.append(f"pipeline {name}: {entry['files_per_s']:.2f} files/s, baseline {old['files_per_s']:.2f}")
+    for stage, entry in report['stages'].items():
+        old = baseline.get('stages', {}).get(stage)
+        if old and entry['mean_s'] > old['mean_s'] * (1 + threshold):
+            regressions.append(f"stage {stage}: {entry['mean_s'] * 1000:.1f} ms/file, baseline {old['mean_s'] * 1000:.1f}")
+    return regressions
+
+
+def print_report(report):
+    for stage, entry in report['stages'].items():
+        print(f"  {stage:<16} {entry['mean_s'] * 1000:9.1f} ms/file")
+    for name, entry in report['pipelines'].items():
+        print(f"  {name:<16} {entry['files_per_s']:9.2f} files/s ({entry['seconds']:.1f} s)")
+    for name, reason in report['skipped'].items():
+        print(f"  {name:<16} skipped: {reason}")
+    print("  peak RSS (MB): " + ", ".join(f"{key} {value:.0f}" for key, value in report['peak_rss_mb'].items()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the SoXspectro rendering pipeline on a synthetic corpus.")
+    parser.add_argument('--corpus', default=CORPUS_DIR, help="folder of the generated corpus, reused between runs")
+    parser.add_argument('--quick', action='store_true', help="small corpus (2 files per format)")
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS)
+    parser.add_argument('--sox', default=SoXPath)
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="JSON results of a previous run to compare with")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(report, json.load(file), args.threshold)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            return 1
+        print("No regression")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
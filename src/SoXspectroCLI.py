@@ -0,0 +1,239 @@
+import argparse, csv, json, sys, time
+import os.path as op, os
+
+from SoXspectroStats import PipelineStats, Profiler
+from SoXspectroCore import RenderJob, RenderEngine, ExportResult, write_atomic, walk_audio_files, SoXPath, SoXSpectroW, SoXSpectroH, AUDIO_FORMATS, MAX_WORKERS, DECODE_STRATEGY, DECODE_STRATEGIES, RENDER_BACKEND, RENDER_PROFILES
+
+# Headless batch mode: renders every audio file of a folder tree without Qt, cv2 or winsound.
+# Usage: python SoXspectroCLI.py <folder> [--subfolder] [--manifest report.json] [--workers 16] [--journal batch.jsonl]
+
+SUBFOLDER_NAME = "Spectrograms"
+
+
+def find_audio_files(root, recursive=True, skip_dir=SUBFOLDER_NAME):
+    if op.isfile(root):
+        return [root]
+    if not recursive:
+        return sorted(op.join(root, name) for name in os.listdir(root)
+                      if name.lower().endswith(AUDIO_FORMATS) and op.isfile(op.join(root, name)))
+    return list(walk_audio_files(root, AUDIO_FORMATS, skip_dir)) # never descend into our own output folders
+
+
+def output_path(audio_path, to_subfolder=False, subfolder_name=SUBFOLDER_NAME):
+    folder, audio_file = op.split(audio_path)
+    if to_subfolder:
+        folder = op.join(folder, subfolder_name)
+    return op.join(folder, op.splitext(audio_file)[0] + ".png")
+
+
+def result_files(result, image_path):
+    # (path, bytes) of every file of a successful result: the outputs of its profile, its tiles or its image
+    stem = op.splitext(image_path)[0]
+    if result.outputs:
+        return [(stem + suffix, data) for suffix, data in result.outputs.items()]
+    if result.tiles:
+        return [(f"{stem}_{number:03d}.png", tile) for number, tile in enumerate(result.tiles, 1)]
+    return [(image_path, result.image)]
+
+
+def write_manifest(manifest_path, records):
+    if manifest_path.lower().endswith('.csv'):
+        with open(manifest_path, "w", newline='', encoding='utf-8') as file:
+            writer = csv.DictWriter(file, fieldnames=list(records[0]) if records else ['path'])
+            writer.writeheader()
+            writer.writerows(records)
+    else:
+        with open(manifest_path, "w", encoding='utf-8') as file:
+            json.dump(records, file, indent=1, ensure_ascii=False)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Render SoX spectrograms of every audio file in a folder tree.")
+    parser.add_argument('root', help="folder (or single file) to process")
+    parser.add_argument('--no-recursive', dest='recursive', action='store_false', help="only process the top level of the folder")
+    parser.add_argument('--subfolder', action='store_true', help=f"write images into a '{SUBFOLDER_NAME}' folder next to the audio")
+    parser.add_argument('--skip-existing', action='store_true', help="do not render files whose image already exists")
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS, help="number of files rendered in parallel")
+    parser.add_argument('-x', '--width', type=int, default=SoXSpectroW)
+    parser.add_argument('-y', '--height', type=int, default=SoXSpectroH, help="height of one channel")
+    parser.add_argument('--sox', default=SoXPath, help="path to the sox executable")
+    parser.add_argument('--decoder', default=DECODE_STRATEGY, choices=DECODE_STRATEGIES,
+                        help="how audio reaches SoX: read by SoX itself, on its stdin, streamed by ffmpeg or decoded by pydub, "
+                             "auto picks SoX for the formats it reads and ffmpeg otherwise")
+    parser.add_argument('--backend', default=RENDER_BACKEND, choices=('sox', 'numpy', 'auto'), help="numpy renders without SoX (no axes)")
+    parser.add_argument('--tile-minutes', type=float, help="split long files into one image per tile (numpy backend)")
+    parser.add_argument('--render-profile', choices=sorted(RENDER_PROFILES),
+                        help="render every output of a profile (sizes, mono or per channel images, .npy dB data) from one decode of each file")
+    parser.add_argument('--analyze', action='store_true',
+                        help="measure the lowpass cutoff, energy above 16/19/20 kHz and clipping of each file (needs numpy), added to the manifest")
+    parser.add_argument('--archive', nargs='?', const='png', choices=('png', 'webp', 'jpeg'),
+                        help="pack the images of each folder into one SQLite archive instead of loose files, optionally as webp or jpeg")
+    parser.add_argument('--journal', help="record the progress of every file in this journal, running again resumes the batch "
+                                          "where it stopped (done and unchanged files are skipped)")
+    parser.add_argument('--retry-failed', action='store_true', help="with --journal, render again the files that failed last time")
+    parser.add_argument('--cache', action='store_true', help="use the spectrogram cache shared with the GUI")
+    parser.add_argument('--stats-log', help="append a JSON line per render and save to this file")
+    parser.add_argument('--profile', help="profile the workers with cProfile and tracemalloc, raw data written to this file")
+    parser.add_argument('--manifest', help="write a per-file report, as CSV if the name ends with .csv, JSON otherwise")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.tile_minutes:
+        args.backend = 'numpy' # tiles are cut while streaming the samples
+    start = time.perf_counter()
+
+    audio_files = find_audio_files(args.root, args.recursive)
+    file_count = len(audio_files)
+    jobs, records = [], []
+    journal = params = None
+    if args.journal:
+        from SoXspectroJournal import BatchJournal
+        journal = BatchJournal(args.journal)
+        # what the images depend on: a run with other parameters renders the files again
+        params = {name: getattr(args, name) for name in ('width', 'height', 'sox', 'decoder', 'backend', 'tile_minutes', 'render_profile',
+                                                         'analyze', 'archive', 'subfolder')}
+        audio_files, resumed = journal.resume(audio_files, retry_failed=args.retry_failed, params=params)
+        for audio_path in resumed:
+            state = journal.state(audio_path)
+            records.append({'path': audio_path, 'output': state.output or '', 'status': 'skipped' if state.state == 'done' else 'failed',
+                            'error': state.error or '', 'cached': False, 'seconds': 0.0})
+        if resumed:
+            print(f"{len(resumed)} files skipped from the journal")
+    analysis_fields = []
+    if args.analyze:
+        from SoXspectroNumpy import ANALYSIS_BANDS
+        analysis_fields = ['cutoff_hz', *(f"energy_{band // 1000}k" for band in ANALYSIS_BANDS), 'clipping', 'suspect']
+    writer = None
+    if args.archive:
+        from SoXspectroArchive import ArchiveWriter, open_archive
+        writer = ArchiveWriter(args.archive)
+        archives = {} # folder -> (SpectrogramArchive or None, records), for --skip-existing
+
+    def exists(job, image_path):
+        if writer is None:
+            return op.exists(image_path)
+        folder = op.dirname(image_path)
+        if folder not in archives:
+            archive = open_archive(folder)
+            archives[folder] = (archive, archive.records() if archive is not None else {})
+        archive, archive_records = archives[folder]
+        return archive is not None and archive.find(job, archive_records) is not None
+
+    for index, audio_path in enumerate(audio_files):
+        image_path = output_path(audio_path, args.subfolder)
+        job = RenderJob(audio_path, index, args.width, args.height, args.sox, args.decoder, args.backend,
+                        args.tile_minutes * 60 if args.tile_minutes else None, outputs=RENDER_PROFILES.get(args.render_profile),
+                        analyze=args.analyze)
+        if args.skip_existing and exists(job, image_path):
+            records.append({'path': audio_path, 'output': writer.member_path(image_path) if writer else image_path, 'status': 'skipped',
+                            'error': '', 'cached': False, 'seconds': 0.0, **dict.fromkeys(analysis_fields)})
+            continue
+        jobs.append(job)
+    for record in records:
+        record.update({field: record.get(field) for field in analysis_fields})
+    print(f"{file_count} audio files, {len(jobs)} to render")
+
+    cache = None
+    if args.cache:
+        from SoXspectroCache import SpectrogramCache
+        cache = SpectrogramCache()
+
+    stats = PipelineStats(args.stats_log)
+    profiler = Profiler(True, True) if args.profile else None
+    engine = RenderEngine(args.workers, cache, stats, profiler, journal)
+    archived = {} # archive member path -> record, until its batch is written
+    unarchived = {} # audio path -> images of the record not written yet
+
+    def finish(record):
+        # A file is done in the journal once all its images are on disk
+        if journal is not None:
+            journal.record(record['path'], 'done' if record['status'] == 'ok' else 'failed', record['error'], record['output'], params)
+
+    def archive_exported(export_results):
+        # Archive batches are written after the records of their images, a failed batch fails them afterwards
+        for export_result in export_results:
+            stats.add_export(export_result)
+            record = archived.pop(export_result.file_path, None)
+            if record is None:
+                continue
+            if export_result.error and record['status'] == 'ok':
+                record['status'], record['error'] = 'failed', export_result.error
+                print(f"FAILED {export_result.file_path}: {export_result.error}", file=sys.stderr)
+            unarchived[record['path']] -= 1
+            if not unarchived[record['path']]:
+                del unarchived[record['path']]
+                finish(record)
+
+    interrupted = False
+    try:
+        for done, result in enumerate(engine.run(jobs), 1):
+            image_path = output_path(result.job.path, args.subfolder)
+            record = {'path': result.job.path, 'output': '', 'status': 'ok', 'error': '', 'cached': result.cached, 'seconds': round(result.elapsed, 3)}
+            record.update({field: (result.analysis or {}).get(field) for field in analysis_fields})
+            if result.ok:
+                files = result_files(result, image_path)
+                try:
+                    if writer is not None:
+                        member_paths = [writer.member_path(path) for path, _ in files]
+                        archived.update(dict.fromkeys(member_paths, record))
+                        unarchived[record['path']] = len(member_paths)
+                        record['output'] = ';'.join(member_paths)
+                        for path, data in files:
+                            archive_exported(writer.add(data, path, result.job, result.analysis))
+                    else:
+                        for path, data in files:
+                            save_start = time.perf_counter()
+                            written = write_atomic(path, data)
+                            stats.add_export(ExportResult(path, written, elapsed=time.perf_counter() - save_start,
+                                                          bytes_out=len(data) if written else 0))
+                        record['output'] = ';'.join(path for path, _ in files)
+                except OSError as e:
+                    record['status'], record['error'] = 'failed', f"{type(e).__name__}: {e}"
+                if result.job.path not in unarchived:
+                    finish(record)
+            else:
+                record['status'], record['error'] = 'failed', result.error.strip() # in the journal already
+            if record['status'] == 'failed':
+                print(f"[{done}/{len(jobs)}] FAILED {result.job.path}: {record['error']}", file=sys.stderr)
+            else:
+                print(f"[{done}/{len(jobs)}] {record['output']}" + (" (suspect lossy source)" if record.get('suspect') else ""))
+            records.append(record)
+    except KeyboardInterrupt:
+        interrupted = True
+        engine.cancel()
+        if journal is not None:
+            journal.cancel_rendering()
+        print("Interrupted", file=sys.stderr)
+        rendered = {record['path'] for record in records}
+        records.extend({'path': job.path, 'output': '', 'status': 'cancelled', 'error': '', 'cached': False, 'seconds': 0.0,
+                        **dict.fromkeys(analysis_fields)} for job in jobs if job.path not in rendered)
+    if writer is not None:
+        archive_exported(writer.close()) # last partial batches, also after an interruption
+    if journal is not None:
+        counts = journal.counts()
+        journal.close()
+        print(f"Journal {args.journal}: " + ", ".join(f"{count} {state}" for state, count in sorted(counts.items())))
+    failed = sum(record['status'] == 'failed' for record in records)
+
+    if args.manifest:
+        records.sort(key=lambda record: record['path'])
+        write_manifest(args.manifest, records)
+    if args.analyze:
+        print(f"{sum(bool(record['suspect']) for record in records)} suspect lossy sources")
+    print(stats.summary_line())
+    print(stats.details())
+    stats.close()
+    if profiler is not None:
+        print(profiler.report(args.profile))
+    if interrupted:
+        print(f"Interrupted after {time.perf_counter() - start:.1f} s, {failed} failed, "
+              f"{sum(record['status'] == 'cancelled' for record in records)} cancelled")
+        return 130 # as a shell reports a process stopped by Ctrl+C
+    print(f"Done in {time.perf_counter() - start:.1f} s, {failed} failed")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,157 @@
+import hashlib, json, sys, tempfile, threading
+import os.path as op, os
+
+from SoXspectroCore import build_sox_command, choose_backend, APP_DATA_DIR
+
+# On-disk spectrogram cache shared by SoXspectroGUI and SoXspectroD&D.
+# Entries are PNG files named after a hash of the source file identity and the render parameters.
+# Each hit touches the entry, so evicting the oldest modification times first gives an LRU.
+# The lossy transcode metrics of an entry are kept next to it in a JSON file of the same name.
+
+CACHE_DIR = op.join(APP_DATA_DIR, 'cache') # only cache entries, clearing and evicting never touch the other app data
+CACHE_MAX_SIZE_MB = 512 # the oldest entries are removed above this size
+CACHE_HASH_CONTENT = False # key on a hash of the file content instead of its path and mtime (slower, survives moves and copies)
+
+
+def file_identity(file_path, hash_content=CACHE_HASH_CONTENT):
+    stat = os.stat(file_path)
+    if not hash_content:
+        return [op.abspath(file_path), stat.st_size, stat.st_mtime_ns]
+    content_hash = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            content_hash.update(chunk)
+    return [stat.st_size, content_hash.hexdigest()]
+
+
+def render_key(job, hash_content=CACHE_HASH_CONTENT):
+    # SoX command without the executable and the input, so only what changes the image is part of the key
+    parameters = [choose_backend(job)] + build_sox_command(job, ())[1:]
+    key_data = json.dumps([file_identity(job.path, hash_content), parameters])
+    return hashlib.sha256(key_data.encode()).hexdigest()
+
+
+class SpectrogramCache:
+    def __init__(self, cache_dir=CACHE_DIR, max_size_mb=CACHE_MAX_SIZE_MB, hash_content=CACHE_HASH_CONTENT):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.hash_content = hash_content
+        self._lock = threading.Lock()
+        self._size = None # scanned on first use, so opening a window does not list the whole cache
+
+    def _entries(self):
+        # (mtime, path, size) of every cached image
+        entries = []
+        if not op.isdir(self.cache_dir):
+            return entries
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.png'):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime_ns, entry.path, stat.st_size))
+        return entries
+
+    def _entry_path(self, key):
+        return op.join(self.cache_dir, key + '.png')
+
+    def _remove(self, entry_path):
+        os.remove(entry_path)
+        try:
+            os.remove(op.splitext(entry_path)[0] + '.json')
+        except OSError:
+            pass
+
+    def __contains__(self, job):
+        try:
+            return op.exists(self._entry_path(render_key(job, self.hash_content)))
+        except OSError:
+            return False
+
+    def get(self, job):
+        try:
+            entry_path = self._entry_path(render_key(job, self.hash_content))
+            with open(entry_path, "rb") as file:
+                image = file.read()
+            os.utime(entry_path) # mark as recently used
+            return image
+        except OSError:
+            return None
+
+    def put(self, job, image):
+        try:
+            entry_path = self._entry_path(render_key(job, self.hash_content))
+        except OSError:
+            return
+        # written to a temporary file first so a concurrent get never reads a partial image.
+        # An unwritable cache only loses the entry, the render itself succeeded
+        temp_path = None
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+            with os.fdopen(fd, "wb") as file:
+                file.write(image)
+            with self._lock:
+                if self._size is None:
+                    self._size = sum(size for _, _, size in self._entries())
+                if op.exists(entry_path):
+                    self._size -= op.getsize(entry_path)
+                os.replace(temp_path, entry_path)
+                self._size += len(image)
+                if self._size > self.max_size:
+                    self._evict()
+        except OSError:
+            if temp_path is not None and op.exists(temp_path):
+                os.remove(temp_path)
+
+    def get_analysis(self, job):
+        try:
+            with open(op.splitext(self._entry_path(render_key(job, self.hash_content)))[0] + '.json', encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def put_analysis(self, job, analysis):
+        # Small enough to be written in place, a partial file reads as a miss
+        try:
+            with open(op.splitext(self._entry_path(render_key(job, self.hash_content)))[0] + '.json', "w", encoding='utf-8') as file:
+                json.dump(analysis, file)
+        except OSError:
+            pass
+
+    def _evict(self):
+        # Remove the least recently used entries until the cache is back under 90% of its size cap
+        for _, entry_path, size in sorted(self._entries()):
+            if self._size <= self.max_size * 0.9:
+                break
+            try:
+                self._remove(entry_path)
+                self._size -= size
+            except OSError:
+                pass
+
+    def size(self):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, _, size in self._entries())
+            return self._size
+
+    def clear(self):
+        with self._lock:
+            for _, entry_path, _ in self._entries():
+                try:
+                    self._remove(entry_path)
+                except OSError:
+                    pass
+            self._size = sum(size for _, _, size in self._entries())
+
+
+if __name__ == '__main__':
+    cache = SpectrogramCache()
+    if len(sys.argv) > 1 and sys.argv[1] == '--clear':
+        cache.clear()
+        print("Cache cleared: " + cache.cache_dir)
+    else:
+        print(f"{cache.cache_dir} : {len(cache._entries())} images, {cache.size() / (1024 * 1024):.1f} MB")
@@ -0,0 +1,745 @@
+import copy, heapq, json, queue, shutil, subprocess, tempfile, threading, time
+import os.path as op, os, io
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from contextlib import contextmanager
+
+# Rendering pipeline shared by SoXspectroGUI and SoXspectroD&D. No Qt import here.
+
+SoXPath = 'sox' # path to the sox / use 'sox' if SoX is in path environment variable
+
+SoXSpectroW = 800 #default 800
+SoXSpectroH = 256 # for one channel
+
+AUDIO_FORMATS = ('.flac', '.wav', '.mp3', '.ogg') # list of file extentions to be parsed
+
+APP_DATA_DIR = op.join(os.environ.get('LOCALAPPDATA') or op.join(op.expanduser('~'), '.cache'), 'SoXspectro')
+SOX_PROBE_CACHE = op.join(APP_DATA_DIR, 'sox_probe.json') # result of the SoX capability probe, kept between launches
+
+MAX_WORKERS = os.cpu_count() or 1 # number of files rendered at the same time (each one drives its own SoX process)
+
+EXPORT_WORKERS = 4 # images written at the same time, mostly waiting on the disk or the network share
+
+# How audio reaches SoX:
+#  'auto'      : SoX reads the file itself when its build supports the format, ffmpeg streams raw PCM otherwise
+#  'sox'       : SoX always reads the file itself
+#  'sox-stdin' : SoX always reads the file on its stdin (what 'auto' does for non ascii paths on Windows)
+#  'ffmpeg'    : always decode with ffmpeg (through pydub's settings) and stream raw PCM to SoX
+#  'pydub'     : legacy path, the whole file is decoded in memory and exported as WAV
+DECODE_STRATEGY = 'auto'
+DECODE_STRATEGIES = ('auto', 'sox', 'sox-stdin', 'ffmpeg', 'pydub')
+SOX_NATIVE_FORMATS = ('.flac', '.wav', '.ogg', '.mp3') # mp3 only when SoX was built with libmad
+
+# What computes the spectrogram:
+#  'sox'   : SoX spectrogram effect, with axes, legend and title
+#  'numpy' : built-in STFT (SoXspectroNumpy.py), plain spectrogram image, no SoX process
+#  'auto'  : SoX when it is installed, numpy otherwise
+RENDER_BACKEND = 'sox'
+
+# Progressive rendering: a quick low resolution pass fills the gallery, then full resolution images replace it
+PREVIEW_W = 200
+PREVIEW_H = 65 # SoX is fastest with 2^n + 1 frequency bins
+
+# Order in which waiting jobs are started, lowest first
+PRIORITY_CLICKED = 0
+PRIORITY_PREVIEW = 1
+PRIORITY_VISIBLE = 2
+PRIORITY_NORMAL = 3
+
+
+class RenderJob:
+    # One file to render, with the parameters used to build the SoX command
+    def __init__(self, path, index=0, width=SoXSpectroW, height=SoXSpectroH, sox_path=SoXPath, decoder=DECODE_STRATEGY,
+                 backend=RENDER_BACKEND, tile_seconds=None, preview=False, priority=PRIORITY_NORMAL, trim=None, outputs=None, analyze=False):
+        self.path = path
+        self.index = index # position of the file in the batch, used to keep the gallery in order
+        self.width = width
+        self.height = height
+        self.sox_path = sox_path
+        self.decoder = decoder
+        self.backend = backend
+        self.tile_seconds = tile_seconds # numpy backend only: one image per tile_seconds of audio
+        self.preview = preview # low resolution image, replaced by the full resolution one
+        self.priority = priority
+        self.trim = trim # (start, end) in seconds to render only part of the file, SoX backend only
+        self.outputs = tuple(outputs) if outputs else None # RenderOutput list: every output rendered from a single decode
+        self.analyze = analyze # compute the lossy transcode metrics (SoXspectroNumpy.SpectralAnalysis) from the decoded samples
+
+    def copy(self, **changes):
+        # Same job with some parameters changed, every other one is kept
+        job = copy.copy(self)
+        for attribute, value in changes.items():
+            if not hasattr(job, attribute):
+                raise AttributeError(f"RenderJob has no parameter {attribute!r}")
+            setattr(job, attribute, value)
+        return job
+
+    @property
+    def name(self):
+        return op.basename(self.path)
+
+    @property
+    def key(self):
+        # jobs with the same key render the same image
+        return (self.path, self.width, self.height, self.sox_path, self.decoder, self.backend, self.tile_seconds, self.preview, self.trim,
+                tuple(output.key for output in self.outputs) if self.outputs else None, self.analyze)
+
+
+class RenderOutput:
+    # One output of a multi-output job, written as <image name><suffix>.png (.npy when raw).
+    # channels: 'all' (stacked like SoX does), 'mono' (mixdown) or 'split' (one <suffix>_ch<n>.png per channel).
+    # raw: float32 dB matrix (channels, height, width) saved with numpy instead of an image
+    def __init__(self, suffix='', width=SoXSpectroW, height=SoXSpectroH, channels='all', raw=False):
+        if channels not in ('all', 'mono', 'split'):
+            raise ValueError(f"Unknown channel mode: {channels}")
+        self.suffix = suffix
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.raw = raw
+
+    @property
+    def key(self):
+        return (self.suffix, self.width, self.height, self.channels, self.raw)
+
+
+# Named sets of outputs for RenderJob.outputs. The first image output is the one shown in the gallery
+RENDER_PROFILES = {
+    'qa': [RenderOutput('', SoXSpectroW, SoXSpectroH), RenderOutput('_thumb', PREVIEW_W, PREVIEW_H), RenderOutput('_large', 1920, 513)],
+    'channels': [RenderOutput('', SoXSpectroW, SoXSpectroH), RenderOutput('_mono', channels='mono'), RenderOutput('', channels='split')],
+    'data': [RenderOutput('', SoXSpectroW, SoXSpectroH), RenderOutput('', SoXSpectroW, SoXSpectroH, raw=True)],
+}
+
+
+class RenderResult:
+    def __init__(self, job, image=None, error=None, elapsed=0.0, cached=False, pixels=None, tiles=None, cancelled=False, outputs=None, analysis=None,
+                 decoder=None):
+        self.job = job
+        self.image = image # PNG bytes as produced by SoX
+        self.pixels = pixels # RGB array (height, width, 3) from the numpy backend, displayed without decoding the PNG
+        self.tiles = tiles # PNG bytes of each tile when the job is tiled, image is then the first one
+        self.outputs = outputs # {file suffix: bytes} of a multi-output job, image is then the first PNG
+        self.analysis = analysis # lossy transcode metrics of an analyze job, see SoXspectroNumpy.SpectralAnalysis.finish
+        self.timings = StageTimes() # seconds spent in each stage
+        self.bytes_in = 0 # size of the audio file
+        self.error = error
+        self.elapsed = elapsed
+        self.cached = cached # served from the spectrogram cache, SoX was not run
+        self.cancelled = cancelled
+        self.decoder = decoder # how SoX got the audio: 'sox', 'sox-stdin', 'ffmpeg' or 'pydub', None for the other pipelines
+
+    @property
+    def ok(self):
+        return self.image is not None
+
+
+class StageTimes(dict):
+    # Seconds spent in each stage of one render: queue, cache, read, decode, probe, spawn, sox, numpy, analyze, encode
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self[name] = self.get(name, 0.0) + time.perf_counter() - start
+
+
+class RenderCancelled(Exception):
+    pass
+
+
+class CancelToken:
+    # Shared between the workers of a batch: tracks live SoX processes so they can be killed
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._processes = set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def check(self):
+        if self._event.is_set():
+            raise RenderCancelled()
+
+    def popen(self, command, **kwargs):
+        with self._lock:
+            self.check()
+            process = subprocess.Popen(command, **kwargs)
+            self._processes.add(process)
+        return process
+
+    def release(self, process):
+        with self._lock:
+            self._processes.discard(process)
+
+    def cancel(self):
+        with self._lock:
+            self._event.set()
+            for process in self._processes:
+                try:
+                    process.kill()
+                except OSError:
+                    pass
+
+
+def preview_job(job, width=PREVIEW_W, height=PREVIEW_H):
+    # Low resolution copy of job, for the first pass of a progressive render
+    return RenderJob(job.path, job.index, width, height, job.sox_path, job.decoder, job.backend, preview=True, priority=PRIORITY_PREVIEW)
+
+
+def progressive_jobs(jobs, cache=None):
+    # Previews of every job then the jobs themselves. Files whose full image is cached skip the preview
+    jobs = list(jobs)
+    previews = [preview_job(job) for job in jobs if not job.tile_seconds and (cache is None or job not in cache)]
+    return previews + jobs
+
+
+def build_sox_command(job, input_args=('-t', 'wav', '-'), effects=()):
+    return [
+        job.sox_path,
+        *input_args, '-n',
+        *(['trim', f"{job.trim[0]:.6f}", f"={job.trim[1]:.6f}"] if job.trim else []),
+        *effects,
+        'spectrogram',
+        '-o', '-',
+        '-x', str(job.width),
+        '-y', str(job.height),
+        '-t',
+        job.name
+    ]
+
+
+@lru_cache(maxsize=None)
+def sox_probe(sox_path=SoXPath, cache_path=SOX_PROBE_CACHE):
+    # Version and file types of the SoX build ({'version', 'formats', 'mp3'}), None when SoX is not installed.
+    # Running SoX takes a while on Windows, so the result is cached on disk until the executable changes
+    executable = shutil.which(sox_path) or (sox_path if op.isfile(sox_path) else None)
+    if executable is None:
+        return None
+    stat = os.stat(executable)
+    identity = [op.abspath(executable), stat.st_size, stat.st_mtime_ns]
+
+    try:
+        with open(cache_path, encoding='utf-8') as file:
+            probes = json.load(file)
+    except (OSError, ValueError):
+        probes = {}
+    cached = probes.get(identity[0])
+    if cached is not None and cached.get('identity') == identity:
+        return cached['probe']
+
+    try:
+        version = subprocess.run([executable, '--version'], capture_output=True)
+        if version.returncode != 0:
+            return None
+        help_text = subprocess.run([executable, '-h'], capture_output=True).stdout.decode(errors='replace')
+    except OSError:
+        return None
+    formats = []
+    for line in help_text.splitlines():
+        if line.startswith('AUDIO FILE FORMATS:'):
+            formats = sorted(line.split(':', 1)[1].split())
+    probe = {'version': version.stdout.decode(errors='replace').strip(), 'formats': formats, 'mp3': 'mp3' in formats}
+
+    probes[identity[0]] = {'identity': identity, 'probe': probe}
+    try:
+        write_atomic(cache_path, json.dumps(probes, indent=1).encode())
+    except OSError:
+        pass
+    return probe
+
+
+def sox_formats(sox_path=SoXPath):
+    # File types supported by this SoX build, as listed in "sox -h"
+    probe = sox_probe(sox_path)
+    return frozenset(probe['formats']) if probe else frozenset()
+
+
+def choose_backend(job):
+    if job.backend != 'auto':
+        return job.backend
+    return 'sox' if sox_formats(job.sox_path) else 'numpy'
+
+
+def sox_file_type(file_path):
+    return op.splitext(file_path)[1].lower().lstrip('.')
+
+
+def choose_decoder(job):
+    if job.decoder != 'auto':
+        return job.decoder
+    if op.splitext(job.path)[1].lower() in SOX_NATIVE_FORMATS and sox_file_type(job.path) in sox_formats(job.sox_path):
+        # SoX for Windows opens files with the ANSI API: non ascii paths are streamed through stdin instead
+        if os.name == 'nt' and not job.path.isascii():
+            return 'sox-stdin'
+        return 'sox'
+    return 'ffmpeg'
+
+
+def decode_to_wav(file_path, timings=None):
+    from pydub import AudioSegment # imported here so worker threads share a single import
+
+    timings = timings if timings is not None else StageTimes()
+    with timings.stage('read'), open(file_path, "rb") as file:
+        audio_data = file.read()
+
+    # Decode audio data into WAV format using pydub
+    with timings.stage('decode'):
+        audio_segment = AudioSegment.from_file(io.BytesIO(audio_data))
+        return audio_segment.export(format='wav').read()
+
+
+def probe_stream(file_path):
+    # (sample rate, channels, duration in seconds) of the first audio stream, read by ffprobe through pydub
+    from pydub.utils import mediainfo
+
+    info = mediainfo(file_path)
+    sample_rate, channels = info.get('sample_rate'), info.get('channels')
+    if not sample_rate or not channels:
+        raise ValueError("Unable to read the audio stream format")
+    return int(sample_rate), int(channels), float(info.get('duration') or 0)
+
+
+def audio_duration(job):
+    # Duration in seconds, read by SoX for the files it opens itself, by ffprobe otherwise
+    if choose_decoder(job) == 'sox':
+        output = subprocess.run([job.sox_path, '--i', '-D', job.path], capture_output=True)
+        if output.returncode == 0:
+            return float(output.stdout)
+    return probe_stream(job.path)[2]
+
+
+def ffmpeg_pcm_command(file_path, sample_rate, channels, sample_format='s32le'):
+    # ffmpeg command writing raw PCM to stdout
+    from pydub.utils import get_encoder_name
+
+    return [get_encoder_name(), '-v', 'error', '-i', file_path, '-ar', str(sample_rate), '-ac', str(channels),
+            '-f', sample_format, '-acodec', 'pcm_' + sample_format, '-']
+
+
+def run_sox(job, input_args, stdin, token, timings, input_data=None):
+    with timings.stage('spawn'):
+        process = token.popen(build_sox_command(job, input_args), stdin=stdin, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, shell=False)
+    try:
+        with timings.stage('sox'):
+            result, error = process.communicate(input=input_data)
+    finally:
+        token.release(process)
+    token.check()
+    return process.returncode, result, error.decode(errors='replace')
+
+
+def render_file(job, token=None):
+    # Renders a single file. Errors are returned in the result instead of raised so one bad file does not stop a batch
+    token = token or CancelToken()
+    timings = StageTimes()
+    start = time.perf_counter()
+    try:
+        result = run_pipeline(job, token, timings)
+    except RenderCancelled:
+        result = RenderResult(job, error="Cancelled", cancelled=True)
+    except Exception as e:
+        result = RenderResult(job, error=f"{type(e).__name__}: {e}")
+    result.elapsed = time.perf_counter() - start
+    result.timings = timings
+    try:
+        result.bytes_in = op.getsize(job.path)
+    except OSError:
+        pass
+    return result
+
+
+def run_pipeline(job, token, timings):
+    token.check()
+    if job.outputs or (job.analyze and choose_backend(job) == 'sox'):
+        # a single decode feeds the SoX processes and the analysis
+        from SoXspectroNumpy import render_outputs, SpectralAnalysis
+
+        analysis = SpectralAnalysis() if job.analyze else None
+        outputs = render_outputs(job, token, timings, analysis)
+        image = next((data for suffix, data in outputs.items() if suffix.endswith('.png')), None)
+        if image is None:
+            return RenderResult(job, error="The render profile has no image output")
+        return RenderResult(job, image=image, outputs=outputs if job.outputs else None,
+                            analysis=analysis.finish() if analysis is not None else None)
+    if choose_backend(job) == 'numpy':
+        from SoXspectroNumpy import render_tiles, encode_png, SpectralAnalysis
+
+        analysis = SpectralAnalysis() if job.analyze else None
+        with timings.stage('numpy'):
+            tile_pixels = render_tiles(job, token, job.tile_seconds, analysis)
+        with timings.stage('encode'):
+            tiles = [encode_png(pixels) for pixels in tile_pixels]
+        return RenderResult(job, image=tiles[0], pixels=tile_pixels[0], tiles=tiles if job.tile_seconds else None,
+                            analysis=analysis.finish() if analysis is not None else None)
+
+    decoder = choose_decoder(job)
+    if decoder == 'sox':
+        returncode, result, error = run_sox(job, [job.path], subprocess.DEVNULL, token, timings)
+    elif decoder == 'sox-stdin':
+        with open(job.path, "rb") as file:
+            returncode, result, error = run_sox(job, ['-t', sox_file_type(job.path), '-'], file, token, timings)
+    elif decoder == 'ffmpeg':
+        with timings.stage('probe'):
+            sample_rate, channels, _ = probe_stream(job.path)
+        input_args = ['-t', 'raw', '-r', str(sample_rate), '-e', 'signed', '-b', '32', '-c', str(channels), '-']
+        with timings.stage('spawn'):
+            ffmpeg = token.popen(ffmpeg_pcm_command(job.path, sample_rate, channels), stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL)
+        try:
+            returncode, result, error = run_sox(job, input_args, ffmpeg.stdout, token, timings)
+        finally:
+            ffmpeg.stdout.close()
+            ffmpeg.wait()
+            token.release(ffmpeg)
+        if ffmpeg.returncode != 0 and returncode == 0:
+            returncode, error = ffmpeg.returncode, "ffmpeg could not decode the file"
+    else:
+        wav_data = decode_to_wav(job.path, timings)
+        token.check()
+        returncode, result, error = run_sox(job, ['-t', 'wav', '-'], subprocess.PIPE, token, timings, wav_data)
+
+    # Check for any errors
+    if returncode != 0:
+        return RenderResult(job, error=error, decoder=decoder)
+    return RenderResult(job, image=result, decoder=decoder)
+
+
+def walk_audio_files(root, extensions=AUDIO_FORMATS, skip_dir=None):
+    # Generator of the audio files of a folder tree, folder by folder in sorted order, skipping folders named skip_dir
+    for folder, dirs, files in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if d != skip_dir)
+        for name in sorted(files):
+            if name.lower().endswith(extensions):
+                yield op.join(folder, name)
+
+
+def file_signature(file_path):
+    # (size, mtime) of a file, None when it does not exist anymore
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class FileIndex:
+    # Remembers the signature of each rendered file to tell which ones were added, changed or removed since
+    def __init__(self):
+        self.signatures = {}
+
+    def update(self, file_paths):
+        # Returns (added, changed, removed) paths and makes file_paths the new reference
+        signatures = {}
+        for file_path in file_paths:
+            signature = file_signature(file_path)
+            if signature is not None:
+                signatures[file_path] = signature
+        added = [path for path in signatures if path not in self.signatures]
+        changed = [path for path, signature in signatures.items() if path in self.signatures and self.signatures[path] != signature]
+        removed = [path for path in self.signatures if path not in signatures]
+        self.signatures = signatures
+        return added, changed, removed
+
+    def add(self, file_paths):
+        # Returns (added, changed) among file_paths only, the other known files are not checked
+        added, changed = [], []
+        for file_path in file_paths:
+            signature = file_signature(file_path)
+            if signature is None:
+                continue
+            if file_path not in self.signatures:
+                added.append(file_path)
+            elif self.signatures[file_path] != signature:
+                changed.append(file_path)
+            self.signatures[file_path] = signature
+        return added, changed
+
+
+class ExportResult:
+    def __init__(self, file_path, written=False, error=None, elapsed=0.0, bytes_out=0):
+        self.file_path = file_path
+        self.written = written # False when the file already held the same image
+        self.error = error
+        self.elapsed = elapsed
+        self.bytes_out = bytes_out
+
+
+def write_atomic(file_path, data):
+    # Writes through a temporary file renamed over file_path, so a failure never leaves a half written image.
+    # Returns False without writing when the file already holds exactly data
+    try:
+        if op.getsize(file_path) == len(data):
+            with open(file_path, "rb") as file:
+                if file.read() == data:
+                    return False
+    except OSError:
+        pass
+
+    folder = op.dirname(file_path) or "."
+    os.makedirs(folder, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix="." + op.basename(file_path), suffix=".tmp", dir=folder)
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    return True
+
+
+def export_images(items, max_workers=EXPORT_WORKERS):
+    # items: (PNG bytes, output path) pairs. Generator yielding one ExportResult per item in completion order
+    def export(data, file_path):
+        start = time.perf_counter()
+        try:
+            written = write_atomic(file_path, data)
+            return ExportResult(file_path, written, elapsed=time.perf_counter() - start, bytes_out=len(data) if written else 0)
+        except OSError as e:
+            return ExportResult(file_path, error=f"{type(e).__name__}: {e}", elapsed=time.perf_counter() - start)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(export, data, file_path) for data, file_path in items]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+class JobQueue:
+    # Jobs waiting for a worker, lowest priority first then in submission order. Waiting jobs can be reprioritized
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = []
+        self.entries = {} # id(job) -> heap entry [priority, sequence, job, submitted] of each waiting job
+        self.sequence = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, job, submitted=None):
+        with self.lock:
+            self._push(job, job.priority, submitted if submitted is not None else time.perf_counter())
+
+    def _push(self, job, priority, submitted):
+        previous = self.entries.get(id(job))
+        if previous is not None:
+            previous[2] = None # left in the heap and skipped when popped
+            sequence = previous[1] # keeps its place among the jobs of the same priority
+        else:
+            sequence = self.sequence
+            self.sequence += 1
+        job.priority = priority
+        entry = [priority, sequence, job, submitted]
+        self.entries[id(job)] = entry
+        heapq.heappush(self.heap, entry)
+
+    def update(self, job, priority):
+        # Changes the priority of a waiting job
+        with self.lock:
+            entry = self.entries.get(id(job))
+            if entry is not None and entry[0] != priority:
+                self._push(job, priority, entry[3])
+
+    def remove(self, job):
+        with self.lock:
+            entry = self.entries.pop(id(job), None)
+            if entry is not None:
+                entry[2] = None
+
+    def get(self):
+        # (job, submitted time) of the most urgent job, None when there is none left
+        with self.lock:
+            while self.heap:
+                _, _, job, submitted = heapq.heappop(self.heap)
+                if job is not None:
+                    del self.entries[id(job)]
+                    return job, submitted
+            return None
+
+    def reprioritize(self, function):
+        # function(job) returns the new priority of a waiting job, or None to leave it
+        with self.lock:
+            for _, _, job, submitted in list(self.entries.values()):
+                priority = function(job)
+                if priority is not None and priority != job.priority:
+                    self._push(job, priority, submitted)
+            if len(self.heap) > 2 * len(self.entries) + 64: # drop the entries left behind
+                self.heap = [entry for entry in self.heap if entry[2] is not None]
+                heapq.heapify(self.heap)
+
+    def clear(self):
+        with self.lock:
+            self.heap.clear()
+            self.entries.clear()
+
+
+class RenderEngine:
+    # Renders a batch of jobs on a pool of worker threads, each one waiting on its own SoX subprocess
+    def __init__(self, max_workers=None, cache=None, stats=None, profiler=None, journal=None):
+        self.max_workers = max_workers or MAX_WORKERS
+        self.token = CancelToken()
+        self.queue = JobQueue()
+        self.cache = cache # SoXspectroCache.SpectrogramCache, or None to always run SoX
+        self.stats = stats # SoXspectroStats.PipelineStats, or None
+        self.profiler = profiler # SoXspectroStats.Profiler, or None
+        self.journal = journal # SoXspectroJournal.BatchJournal, or None. Done is recorded by the caller once the image is saved
+
+    def render(self, job, submitted=None, token=None):
+        start = time.perf_counter()
+        journal = self.journal
+        if journal is not None:
+            journal.record(job.path, 'rendering') # previews too: they decode the file first when rendering progressively
+        result = self.profiler.run(self.render_cached, job, token) if self.profiler is not None else self.render_cached(job, token)
+        result.timings['queue'] = start - submitted if submitted is not None else 0.0
+        if self.stats is not None and not result.cancelled and not job.preview: # the batch counts each file once
+            self.stats.add_result(result)
+        if journal is not None and job.preview:
+            journal.record(job.path, 'previewed') # done or failed is up to the full render
+        elif journal is not None and not result.ok:
+            journal.record(job.path, 'cancelled' if result.cancelled else 'failed', None if result.cancelled else result.error.strip())
+        return result
+
+    def record_queued(self, jobs):
+        if self.journal is not None:
+            self.journal.record_queued([job.path for job in jobs if not job.preview])
+
+    def render_cached(self, job, token=None):
+        start = time.perf_counter()
+        cache = self.cache if not (job.tile_seconds or job.outputs or job.preview) else None # previews are replaced at once
+        if cache is not None:
+            image = cache.get(job)
+            analysis = cache.get_analysis(job) if job.analyze and image is not None else None
+            if image is not None and (analysis is not None or not job.analyze):
+                result = RenderResult(job, image=image, elapsed=time.perf_counter() - start, cached=True, analysis=analysis)
+                result.timings['cache'] = result.elapsed
+                return result
+        result = render_file(job, token or self.token)
+        if cache is not None and result.ok:
+            with result.timings.stage('cache'):
+                cache.put(job, result.image)
+                if result.analysis is not None:
+                    cache.put_analysis(job, result.analysis)
+        return result
+
+    def run(self, jobs):
+        # Generator yielding RenderResult objects in completion order. Jobs are started by priority, see prioritize
+        jobs = list(jobs)
+        results = queue.SimpleQueue()
+        self.record_queued(jobs)
+        for job in jobs:
+            self.queue.put(job)
+
+        def work():
+            # after a cancel the remaining jobs come back at once as "Cancelled"
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                job, submitted = item
+                try:
+                    result = self.render(job, submitted)
+                except Exception as e:
+                    result = RenderResult(job, error=f"{type(e).__name__}: {e}")
+                results.put(result)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for _ in range(min(self.max_workers, len(jobs))):
+                pool.submit(work)
+            try:
+                for _ in range(len(jobs)):
+                    yield results.get()
+            except BaseException: # Ctrl+C or the caller stopped early: kill the running SoX processes instead of waiting for them
+                self.cancel()
+                raise
+            finally:
+                self.queue.clear() # the workers stop after their current job
+
+    def prioritize(self, function):
+        # function(job) returns the new priority of a job not started yet, or None to leave it
+        self.queue.reprioritize(function)
+
+    def cancel(self):
+        self.token.cancel()
+
+
+class RenderScheduler(RenderEngine):
+    # Long lived engine of the windows: jobs can be queued, reprioritized and cancelled while others render.
+    # A job equal to one already waiting or running (same path and parameters) is not queued twice.
+    # on_result(RenderResult) is called from the worker threads once for every queued job, cancelled ones included
+    def __init__(self, on_result, max_workers=None, cache=None, stats=None, profiler=None, journal=None):
+        super().__init__(max_workers, cache, stats, profiler, journal)
+        self.on_result = on_result
+        self.condition = threading.Condition()
+        self.waiting = {} # RenderJob.key -> job in the queue
+        self.running = {} # RenderJob.key -> (job, CancelToken)
+        self.closed = False
+        for number in range(self.max_workers):
+            threading.Thread(target=self.work, name=f"render-{number}", daemon=True).start()
+
+    def submit(self, jobs):
+        # Queues jobs and returns the ones accepted. A duplicate of a waiting job raises its priority instead
+        accepted = []
+        with self.condition:
+            for job in jobs:
+                waiting = self.waiting.get(job.key)
+                if waiting is not None:
+                    if job.priority < waiting.priority:
+                        self.queue.update(waiting, job.priority)
+                elif job.key not in self.running:
+                    self.waiting[job.key] = job
+                    self.queue.put(job)
+                    accepted.append(job)
+            self.condition.notify_all()
+        self.record_queued(accepted)
+        return accepted
+
+    def cancel(self, predicate=None):
+        # Cancels the waiting and running jobs for which predicate(job) is true, all of them by default.
+        # The SoX and ffmpeg processes of the running ones are killed
+        cancelled = []
+        with self.condition:
+            for key, job in list(self.waiting.items()):
+                if predicate is None or predicate(job):
+                    del self.waiting[key]
+                    self.queue.remove(job)
+                    cancelled.append(job)
+            for key, (job, token) in list(self.running.items()):
+                if predicate is None or predicate(job):
+                    del self.running[key] # so the same job can be queued again right away
+                    token.cancel()
+        for job in cancelled:
+            self.on_result(RenderResult(job, error="Cancelled", cancelled=True))
+
+    def work(self):
+        while True:
+            with self.condition:
+                item = self.queue.get()
+                while item is None:
+                    if self.closed:
+                        return
+                    self.condition.wait()
+                    item = self.queue.get()
+                job, submitted = item
+                self.waiting.pop(job.key, None)
+                token = CancelToken()
+                self.running[job.key] = (job, token)
+            try:
+                result = self.render(job, submitted, token)
+            except Exception as e:
+                result = RenderResult(job, error=f"{type(e).__name__}: {e}")
+            with self.condition:
+                if self.running.get(job.key, (None,))[0] is job:
+                    del self.running[job.key]
+            self.on_result(result)
+
+    def close(self):
+        self.cancel()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
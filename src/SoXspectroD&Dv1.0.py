@@ -1,13 +1,14 @@
-import sys, subprocess
-from PyQt5.QtWidgets import QApplication, QMainWindow, QTreeWidget, QTreeWidgetItem, QPushButton, QVBoxLayout, QWidget, QLabel
-from PyQt5.QtGui import QIcon, QImage, QPixmap, QCursor
-from PyQt5.QtCore import Qt, QMimeData, QFileInfo
-import os.path as op, os, io
-from PyQt5.QtWidgets import QFileIconProvider,QScrollArea
+import sys, time, importlib.util
+STARTUP = time.perf_counter()
+from PyQt5.QtWidgets import QApplication, QMainWindow, QCheckBox, QListView, QPushButton, QVBoxLayout, QWidget, QProgressBar
+from PyQt5.QtCore import Qt, QTimer
+import os.path as op, os
 import winsound
-from pydub import AudioSegment
-import cv2
-import numpy as np
+from SoXspectroCore import RenderJob, EXPORT_WORKERS, RENDER_PROFILES, sox_probe, progressive_jobs
+from SoXspectroCache import SpectrogramCache
+from SoXspectroStats import PipelineStats, Profiler
+from SoXspectroJournal import BatchJournal, journal_path
+from SoXspectroQt import BackgroundRenderer, FarmRenderer, ExportThread, SpectrogramModel, SpectrogramView, GalleryEntry, GalleryFilterModel, GalleryFilterBar, archived_entries, ChangeWatcher, SpectrogramViewer, FileQueueModel, FolderScanner, result_qimage
 
 WINDOW_TITLE = "SoXspectroD&D"
 
@@ -22,14 +23,49 @@ SoXSpectroH = 256 # for one channel
 
 SoXPath = 'sox' # path to the sox / use 'sox' if SoX is in path environment variable
 
+MAX_WORKERS = os.cpu_count() or 1 # number of files rendered in parallel
+
+FARM_SPOOL = "" # shared spool folder of a render farm: when set, "Process Audio" sends the queue to the SoXspectroFarm.py workers instead of rendering here
+
+RENDER_BACKEND = 'auto' # 'sox', 'numpy' (built-in, no axes) or 'auto' (SoX when installed, numpy otherwise)
+
+PROGRESSIVE = True # show quick low resolution previews of every file first, then render them at full resolution, files on screen first
+
+RENDER_PROFILE = "" # name of a render profile of SoXspectroCore.RENDER_PROFILES ('qa', 'channels', 'data'): every output is rendered from one decode and saved
+
+ANALYZE = False # measure the lowpass cutoff, high frequency energy and clipping of each file (needs numpy), to sort and filter the gallery on lossy sources. Slower with SoX: the file is decoded and piped to SoX and the analysis
+
+WATCH_LABEL = "Watch queue: render new, modified and dropped files automatically"
+
+STATS_LOG = "" # path of a JSON lines log of every render and save, empty to disable
+PROFILE = False # profile the render workers with cProfile, the report is printed after each batch
+TRACE_MEMORY = False # trace Python allocations with tracemalloc
+PROFILE_OUTPUT = "SoXspectro.prof" # raw cProfile data, for snakeviz or pstats
+
+STARTUP_TARGET_MS = 1000 # a warning is printed when the window takes longer to show
+
+USE_CACHE = True # reuse spectrograms of unchanged files instead of running SoX again
+CACHE_MAX_SIZE_MB = 512
+
 DO_SAVE_TO_SUBFOLDER = True # whether to save the spectrograms to a subfolder. They will be saved RELATIVE TO THEIR RESPECTIVE AUDIO FILES
 SUBFOLDER_NAME = "Spectrograms"
 
-# test if sox is installed
-try:
-    subprocess.check_output([SoXPath, '--version'])
-except (subprocess.CalledProcessError, FileNotFoundError):
-    raise FileNotFoundError("SoX may not be installed. Please set the path to sox.exe in the settings")
+SAVE_TO_ARCHIVE = False # "Save Images" packs the images of each folder into one SQLite file (Spectrograms.sqlite) instead of one file per image
+ARCHIVE_FORMAT = 'png' # image format in the archive: 'png', 'webp' or 'jpeg' (webp and jpeg need Pillow or the Qt image format plugins)
+LOAD_FROM_ARCHIVE = True # unchanged files whose image is in the folder archive are shown from it instead of being rendered
+
+JOURNAL = True # record the progress of each batch on disk, files that made the app crash are skipped the next time they are processed
+
+# test if sox is installed (the result is cached on disk until the sox executable changes)
+if sox_probe(SoXPath) is None:
+    if RENDER_BACKEND == 'sox':
+        raise FileNotFoundError("SoX may not be installed. Please set the path to sox.exe in the settings")
+    print("SoX not found, spectrograms will be computed with the numpy backend")
+    RENDER_BACKEND = 'numpy'
+
+if ANALYZE and importlib.util.find_spec('numpy') is None:
+    print("numpy not found, files will not be analyzed")
+    ANALYZE = False
 
 class FileDropWindow(QMainWindow):
     def __init__(self):
@@ -39,11 +75,14 @@ class FileDropWindow(QMainWindow):
         self.setGeometry(100, 100, MAINWIN_W, MAINWIN_H)  # Geometry   
         self.setAcceptDrops(True)
 
-        self.tree_widget = QTreeWidget(self)
-        self.tree_widget.setFixedHeight(filelistH)  # Set fixed height for the file view
-        self.tree_widget.setHeaderHidden(False)
-        self.tree_widget.setHeaderLabel("Audio files")
-        #self.folder_view_left.header().resizeSection(0, folder_viewW)  # Adjust width of the first section (Name)
+        # List of the queued audio files, dropped folders are scanned on background threads
+        self.file_model = FileQueueModel(self)
+        self.file_view = QListView(self)
+        self.file_view.setFixedHeight(filelistH)  # Set fixed height for the file view
+        self.file_view.setUniformItemSizes(True)
+        self.file_view.setModel(self.file_model)
+        self.file_view.clicked.connect(self.file_clicked)
+        self.scanners = set()
 
         self.clear_button = QPushButton("Clear file list")
         self.clear_button.clicked.connect(self.clear_file_paths)
@@ -52,22 +91,46 @@ class FileDropWindow(QMainWindow):
         self.process_button.clicked.connect(self.process_audio)
         self.process_button.setEnabled(False)
         
+        self.cancel_button = QPushButton("Cancel", self)
+        self.cancel_button.clicked.connect(self.cancel_processing)
+        self.cancel_button.setEnabled(False)
+
+        self.progress_bar = QProgressBar(self)
+        self.progress_bar.setValue(0)
+
+        self.watch_checkbox = QCheckBox(WATCH_LABEL, self)
+        self.watch_checkbox.toggled.connect(self.toggle_watch)
+
         self.save_button = QPushButton("Save Images", self)
         self.save_button.clicked.connect(self.save_images)
         self.save_button.setEnabled(False)
 
-        self.scroll_area = QScrollArea(self)
-        self.scroll_widget = QWidget()
-        self.scroll_layout = QVBoxLayout(self.scroll_widget)
-        self.scroll_area.setWidgetResizable(True)
-        self.scroll_area.setWidget(self.scroll_widget)
+        self.clear_cache_button = QPushButton("Clear Cache", self)
+        self.clear_cache_button.clicked.connect(self.clear_cache)
+        self.clear_cache_button.setEnabled(USE_CACHE)
+
+        # Gallery of the rendered spectrograms, only the visible rows are decoded
+        self.gallery_model = SpectrogramModel(parent=self)
+        self.gallery_filter = GalleryFilterModel(self)
+        self.gallery_filter.setSourceModel(self.gallery_model)
+        self.gallery_filter_bar = GalleryFilterBar(self.gallery_filter, self)
+        self.gallery_filter_bar.setVisible(ANALYZE)
+        self.gallery_view = SpectrogramView(self)
+        self.gallery_view.setModel(self.gallery_filter)
+        self.gallery_view.clicked.connect(self.gallery_clicked)
+        self.gallery_view.visible_changed.connect(self.prioritize_visible)
         
         layout = QVBoxLayout()
-        layout.addWidget(self.tree_widget)
+        layout.addWidget(self.file_view)
         layout.addWidget(self.clear_button)
         layout.addWidget(self.process_button)
+        layout.addWidget(self.cancel_button)
+        layout.addWidget(self.progress_bar)
+        layout.addWidget(self.watch_checkbox)
         layout.addWidget(self.save_button)
-        layout.addWidget(self.scroll_area)
+        layout.addWidget(self.clear_cache_button)
+        layout.addWidget(self.gallery_filter_bar)
+        layout.addWidget(self.gallery_view)
 
         central_widget = QWidget()
         central_widget.setLayout(layout)
@@ -75,181 +138,375 @@ class FileDropWindow(QMainWindow):
         
         self.resizeEvent(None)
         self.images = []
+        self.export_thread = None
+        self.stats = None
+        self.profiler = None
+        self.journal = None
+        self.export_errors = 0
+        self.file_keys = {} # path -> gallery key of the files of the current batch
+        self.next_key = 0
+        self.change_watcher = ChangeWatcher(self.list_queued_files, self.list_watched_paths, parent=self)
+        self.change_watcher.changes.connect(self.files_changed)
+        self.cache = SpectrogramCache(max_size_mb=CACHE_MAX_SIZE_MB) if USE_CACHE else None
+
+        # Renders on background threads, the files on screen or clicked first (or on the farm)
+        if FARM_SPOOL:
+            self.renderer = FarmRenderer(FARM_SPOOL, self)
+            self.renderer.farm_status.connect(self.show_farm_status)
+        else:
+            self.renderer = BackgroundRenderer(MAX_WORKERS, self.cache, self)
+        self.renderer.result_ready.connect(self.add_render_result)
+        self.renderer.progress.connect(self.show_progress)
+        self.renderer.idle.connect(self.processing_finished)
 
     def dragEnterEvent(self, event):
         if event.mimeData().hasUrls():
             event.acceptProposedAction()
 
     def dropEvent(self, event):
+        file_paths, folders = [], []
         for url in event.mimeData().urls():
-            file_path = url.toLocalFile().replace("\\","/")
-            self.add_file_item(file_path)
-        if self.tree_widget.topLevelItemCount() > 0 :
-            self.process_button.setEnabled(True)
-            self.process_button.setText("Process Audio (" + str(self.tree_widget.topLevelItemCount()) + " files)" )
-        else:
-            self.process_button.setEnabled(False)
-            self.process_button.setText("Process Audio")
-
-    def add_file_item(self, file_path):
-        file_extension = op.splitext(file_path)[1].lower()
-        if file_extension in AUDIO_FORMATS:
-            file_icon = self.get_file_icon(file_path)
-            item = QTreeWidgetItem([file_path])
-            item.setIcon(0, file_icon)
-            if not ( self.tree_widget.findItems(file_path, Qt.MatchFixedString) ): self.tree_widget.addTopLevelItem(item) # add item if not already present
-
-    def get_file_icon(self, file_path):
-        file_info = QFileInfo(file_path)
-        icon_provider = QFileIconProvider()
-        file_icon = icon_provider.icon(file_info)
-
-        return file_icon
+            file_path = url.toLocalFile()
+            if op.isdir(file_path):
+                folders.append(file_path)
+            else:
+                file_paths.append(file_path)
+        self.add_file_items(file_paths)
+        if folders:
+            self.scan_folders(folders)
+
+    def scan_folders(self, folders):
+        # Audio files of the dropped folders (and their subfolders) are added as they are found
+        scanner = FolderScanner(folders, AUDIO_FORMATS, SUBFOLDER_NAME, self)
+        scanner.files_found.connect(lambda file_paths: self.files_scanned(scanner, file_paths))
+        scanner.finished.connect(lambda: self.scan_finished(scanner))
+        self.scanners.add(scanner)
+        self.statusBar().showMessage("Scanning " + ", ".join(folders))
+        scanner.start()
+
+    def files_scanned(self, scanner, file_paths):
+        if scanner in self.scanners: # the list was not cleared meanwhile
+            self.add_file_items(file_paths)
+
+    def scan_finished(self, scanner):
+        self.scanners.discard(scanner)
+        scanner.deleteLater()
+        if not self.scanners:
+            self.statusBar().showMessage(f"{self.file_model.rowCount()} files queued")
+
+    def add_file_items(self, file_paths):
+        new_paths = self.file_model.add_paths(op.abspath(file_path).replace("\\","/") for file_path in file_paths
+                                              if file_path.lower().endswith(AUDIO_FORMATS))
+        self.update_process_button()
+        if new_paths:
+            self.change_watcher.add_files(new_paths) # render the dropped files right away
+
+    def update_process_button(self):
+        count = self.file_model.rowCount()
+        self.process_button.setEnabled(count > 0)
+        self.process_button.setText(f"Process Audio ({count} files)" if count else "Process Audio")
 
     def clear_file_paths(self):
-        self.tree_widget.clear()
-        self.process_button.setEnabled(False)
-        self.process_button.setText("Process Audio")
+        for scanner in self.scanners:
+            scanner.cancel()
+        self.scanners.clear()
+        self.file_model.clear()
+        self.update_process_button()
+        if self.change_watcher.active:
+            self.change_watcher.rescan()
             
     def process_audio(self):
-        if self.tree_widget.topLevelItemCount() == 0:
+        if self.file_model.rowCount() == 0:
             return # do nothing if there is no audio files
+        if self.renderer.busy:
+            self.renderer.cancel() # the jobs of the previous batch are stale, their SoX processes are killed
         
-        audio_files = [item.text(0) for item in self.get_all_items(self.tree_widget)] # list all items
-
-        total_files = len(audio_files)
-        processed_files = 0
+        audio_paths = self.list_queued_files()
 
-        # Clear the previous images from the scrollable layout and the images list
+        # Clear the previous images from the gallery and the images list
         self.clear_images()
         self.images = []
 
-        for audio_file in audio_files:
-            # showing progress
-            processed_files += 1
-            file_path = op.abspath(audio_file).replace("\\","/")
-            self.setWindowTitle(f"Processing ({processed_files}/{total_files}) : {file_path}")
+        self.file_keys = {file_path: index for index, file_path in enumerate(audio_paths)}
+        self.next_key = len(audio_paths)
+        archived = self.load_archived(audio_paths) if LOAD_FROM_ARCHIVE else set()
+        crashed = self.open_journal(WINDOW_TITLE, audio_paths) if JOURNAL else set()
+        jobs = self.make_jobs([file_path for file_path in audio_paths if file_path not in archived and file_path not in crashed])
+        self.reset_stats()
+
+        if self.watch_checkbox.isChecked():
+            self.change_watcher.start()
+        self.start_render(jobs)
+
+    def make_job(self, file_path):
+        return RenderJob(file_path, self.file_keys[file_path], SoXSpectroW, SoXSpectroH, SoXPath, backend=RENDER_BACKEND,
+                         outputs=RENDER_PROFILES.get(RENDER_PROFILE), analyze=ANALYZE)
+
+    def load_archived(self, audio_paths):
+        # Shows the images of unchanged files from the archive of their folder, returns their paths so they are not rendered
+        entries = archived_entries([self.make_job(file_path) for file_path in audio_paths],
+                                   lambda job: op.join(op.dirname(job.path), SUBFOLDER_NAME) if DO_SAVE_TO_SUBFOLDER else op.dirname(job.path))
+        for entry in entries:
+            position = self.gallery_model.add_entry(entry)
+            self.images.insert(position, (None, entry.job.path))
+        return {entry.job.path for entry in entries}
+
+    def open_journal(self, key, audio_paths):
+        # The journal of the batch records what each render thread is doing, files that were being rendered
+        # when the app died twice in a row are skipped. Returns their paths
+        if self.journal is not None:
+            self.journal.cancel_rendering() # the renders of the previous batch are being cancelled, not crashing
+            self.journal.close()
+        self.journal = BatchJournal(journal_path(key))
+        self.renderer.set_journal(self.journal)
+        _, crashed = self.journal.resume(audio_paths, skip_done=False, retry_failed=True)
+        for file_path in crashed:
+            print("Skipping a file that stopped the app while being rendered:", file_path)
+        return set(crashed)
+
+    def make_jobs(self, file_paths):
+        jobs = [self.make_job(file_path) for file_path in file_paths]
+        if PROGRESSIVE and len(jobs) > 1:
+            jobs = progressive_jobs(jobs, self.cache)
+        return jobs
+
+    def start_render(self, jobs):
+        # Jobs are queued on the background renderer, results are added to the gallery as they complete
+        self.renderer.submit(jobs)
+        if self.renderer.busy:
+            self.cancel_button.setEnabled(True)
+            self.save_button.setEnabled(False)
 
-            with open(file_path, "rb") as file:
-                print("Loading audio data... " + file_path)
-                audio_data = file.read()
-            
-            # Decode audio data into WAV format using pydub
-            audio_segment = AudioSegment.from_file(io.BytesIO(audio_data))
-            wav_data = audio_segment.export(format='wav').read()
-
-            command = [
-                SoXPath,
-                '-t', 'wav', '-', '-n',
-                'spectrogram',
-                '-o', '-',
-                '-x', str(SoXSpectroW),
-                '-y', str(SoXSpectroH),
-                '-t',
-                op.basename(file_path)
-            ]
-            print("Processing...")
-            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                       shell=False)
-            result, error = process.communicate(input=wav_data)
-
-            # Check for any errors
-            if process.returncode != 0:
+    def reset_stats(self):
+        if self.stats is not None:
+            self.stats.close()
+        self.stats = PipelineStats(STATS_LOG or None)
+        self.profiler = Profiler(PROFILE, TRACE_MEMORY) if (PROFILE or TRACE_MEMORY) else None
+        self.renderer.set_stats(self.stats, self.profiler)
+
+    def show_stats(self):
+        # Live statistics in the status bar, per stage details in its tooltip
+        if self.stats is not None:
+            self.statusBar().showMessage(self.stats.summary_line())
+            self.statusBar().setToolTip(self.stats.details())
+
+    def toggle_watch(self, checked):
+        if checked and self.file_keys:
+            self.change_watcher.start()
+        else:
+            self.change_watcher.stop()
+
+    def files_changed(self, added, changed, removed):
+        # Incremental mode: drop the results of removed files and render only new or modified ones.
+        # Renders of their previous content still queued or running are cancelled
+        stale = set(removed + changed)
+        self.renderer.cancel(lambda job: job.path in stale)
+        for file_path in removed:
+            key = self.file_keys.pop(file_path, None)
+            row = self.gallery_model.remove_entry(key) if key is not None else None
+            if row is not None:
+                del self.images[row]
+        for file_path in added:
+            self.file_keys[file_path] = self.next_key # new files go to the end of the gallery
+            self.next_key += 1
+        file_paths = [file_path for file_path in added + changed if file_path in self.file_keys]
+        if file_paths:
+            print(f"Rendering {len(file_paths)} new or modified files")
+            self.start_render(self.make_jobs(file_paths))
+
+    def list_queued_files(self):
+        return list(self.file_model.paths) # paths are made absolute when queued
+
+    def list_watched_paths(self):
+        # the folders of the queued files, they report files created, replaced, renamed or deleted in them
+        return sorted({op.dirname(file_path) for file_path in self.list_queued_files()})
+
+    def show_progress(self, done, total):
+        self.progress_bar.setMaximum(max(total, 1))
+        self.progress_bar.setValue(done)
+        self.setWindowTitle(f"Processing ({done}/{total})")
+
+    def show_farm_status(self, text):
+        # Workers and jobs of the whole farm, on the progress bar
+        self.progress_bar.setFormat(f"%p%  {text}")
+
+    def add_render_result(self, render_result):
+        self.show_stats()
+        audio_file = render_result.job.path
+        preview = render_result.job.preview
+
+        # Results of files no longer in the gallery (other folder, removed files) are dropped
+        if self.file_keys.get(render_result.job.path) != render_result.job.index:
+            return
+
+        # Check for any errors (a failed preview is reported by its full resolution render)
+        if not render_result.ok:
+            if not preview:
                 print("Error processing file:", audio_file)
-                print("Error:", error.decode())
-                continue
-
-            # Load the image from the byte data
-            image = QImage.fromData(result)
-
-            # Create a QLabel to display the image
-            image_label = QLabel()
-            image_label.setAlignment(Qt.AlignCenter)
-            image_label.setPixmap(QPixmap.fromImage(image))
-            image_label.setScaledContents(True)
-            image_label.setCursor(QCursor(Qt.PointingHandCursor))
-
-            # Set tooltip with the audio file name
-            image_label.setToolTip(audio_file)
-
-            # Connect the click event to the image click handler
-            image_label.mousePressEvent = self.create_image_click_handler(result, audio_file)
-
-            # Add the image label to the scrollable layout
-            self.scroll_layout.addWidget(image_label)
-
-            # Add the image to the images list
-            self.images.append((result, audio_file))
-
+                print("Error:", render_result.error)
+            return
+        if self.journal is not None and not preview:
+            self.journal.record(render_result.job.path, 'done')
+
+        # Previews never replace a full resolution image that arrived first
+        row = self.gallery_model.find_row(render_result.job.index)
+        if preview and row is not None and not self.gallery_model.entries[row].preview:
+            return
+
+        result = render_result.image
+
+        # numpy results seed their thumbnail from the pixel array, SoX results are decoded when scrolled to
+        image = result_qimage(render_result) if render_result.pixels is not None else None
+
+        # Add the spectrogram to the gallery, at the position of the file in the batch
+        entry = GalleryEntry(render_result.job.index, audio_file, result, folder=op.dirname(render_result.job.path), preview=preview,
+                             job=render_result.job, outputs=render_result.outputs,
+                             analysis=render_result.analysis)
+        replaced = row is not None # full resolution image of a preview, or re-rendered after a change
+        position = self.gallery_model.add_entry(entry, image)
+
+        # Add the image to the images list
+        if replaced:
+            self.images[position] = (result, audio_file)
+        else:
+            self.images.insert(position, (result, audio_file))
+
+    def clear_cache(self):
+        if self.cache is not None:
+            self.cache.clear()
+            print("Cache cleared")
+
+    def prioritize_visible(self):
+        # Progressive mode: the full resolution renders of the previews on screen go first
+        if self.renderer.busy:
+            self.renderer.prioritize_visible({entry.key for entry in self.gallery_view.visible_entries() if entry.preview})
+
+    def file_clicked(self, index):
+        # A file clicked in the list is rendered before the rest of the batch
+        key = self.file_keys.get(self.file_model.data(index))
+        if key is not None:
+            self.renderer.prioritize_clicked(key)
+
+    def gallery_clicked(self, index):
+        entry = index.data(Qt.UserRole)
+        if entry.preview:
+            self.renderer.prioritize_clicked(entry.key)
+        self.create_image_click_handler(entry.image_bytes(), entry.name, entry.job)(None)
+
+    def cancel_processing(self):
+        # Waiting jobs are dropped and running SoX processes killed
+        if self.renderer.busy:
+            self.cancel_button.setEnabled(False)
+            self.renderer.cancel()
+
+    def processing_finished(self):
         self.setWindowTitle(WINDOW_TITLE)
+        self.progress_bar.resetFormat()
+        self.process_button.setEnabled(self.file_model.rowCount() > 0)
+        self.cancel_button.setEnabled(False)
         if self.images:
             self.save_button.setEnabled(True)
         else:
             self.save_button.setEnabled(False)
         print("Processing done")
-            
-    def get_all_items(self,tree_widget):
-        # Retrives the list of all files in the tree
-        all_items = []
-
-        # Get the root item
-        root_item = tree_widget.invisibleRootItem()
-
-        # Recursively traverse the tree
-        self.traverse_tree(root_item, all_items)
-
-        return all_items[1:] #remove the first
+        if self.stats is not None:
+            print(self.stats.summary_line())
+            print(self.stats.details())
+        if self.profiler is not None:
+            print(self.profiler.report(PROFILE_OUTPUT))
+            self.profiler = Profiler(PROFILE, TRACE_MEMORY) # next renders of the batch (watch mode) get a new report
+            self.renderer.set_stats(self.stats, self.profiler)
 
-    def traverse_tree(self,item, all_items):
-        # Add the current item to the list
-        all_items.append(item)
 
-        # Recursively traverse the child items
-        for i in range(item.childCount()):
-            child_item = item.child(i)
-            self.traverse_tree(child_item, all_items)
-
-    def create_image_click_handler(self, image_data, audio_file):
+    def create_image_click_handler(self, image_data, audio_file, job=None):
         def image_click_handler(event):
-            # Decode the image data into a numpy array
-            image_array = cv2.imdecode(np.frombuffer(image_data, dtype=np.uint8), cv2.IMREAD_COLOR)
-
-            # Create a window using OpenCV and display the image with the audio file name as the title
-            cv2.namedWindow(audio_file, cv2.WINDOW_NORMAL)
-            cv2.imshow(audio_file, image_array)
-            cv2.waitKey(0)
-            cv2.destroyAllWindows()
+            # Opens a viewer window, rendering and the rest of the app keep running while it is open
+            viewer = SpectrogramViewer(audio_file, image_data, job, self)
+            viewer.show()
 
         return image_click_handler
             
             
     def save_images(self):
-        for image_data, audio_file in self.images:
-            if (DO_SAVE_TO_SUBFOLDER): #saving to a subfolder
-                os.mkdir( op.join(op.dirname(audio_file), SUBFOLDER_NAME) ) # creating the corresponding subfolder
-                file_path = op.join(op.join(op.dirname(audio_file), SUBFOLDER_NAME), op.basename(audio_file) + ".png") # saving to the subfolder
-            else:
-                file_path = op.join(audio_file + ".png")
-            with open(file_path, "wb") as file:
-                print("Writing image... " + file_path)
-                file.write(image_data)
-        print("Images saved successfully!")
+        if not self.images or self.export_thread is not None:
+            return
+        items = []
+        for (image_data, audio_file), entry in zip(self.images, self.gallery_model.entries):
+            if entry.preview: # a cancelled progressive render leaves previews
+                continue
+            if entry.archive is not None and SAVE_TO_ARCHIVE: # loaded from the archive, already in it
+                continue
+            for suffix, data in (entry.outputs or {entry.suffix: image_data if image_data is not None else entry.image_bytes()}).items():
+                if (DO_SAVE_TO_SUBFOLDER): #saving to a subfolder, created when writing the first image
+                    file_path = op.join(op.join(op.dirname(audio_file), SUBFOLDER_NAME), op.basename(audio_file) + suffix) # saving to the subfolder
+                else:
+                    file_path = op.join(audio_file + suffix)
+                items.append((data, file_path, entry.job, entry.analysis) if SAVE_TO_ARCHIVE else (data, file_path))
+
+        # Images are written on background threads
+        self.export_thread = ExportThread(items, EXPORT_WORKERS, self, self.stats, ARCHIVE_FORMAT if SAVE_TO_ARCHIVE else None)
+        self.export_thread.result_ready.connect(self.image_exported)
+        self.export_thread.progress.connect(self.show_export_progress)
+        self.export_thread.finished.connect(self.export_finished)
+        self.export_errors = 0
+        self.save_button.setEnabled(False)
+        self.export_thread.start()
+
+    def show_export_progress(self, done, total):
+        self.progress_bar.setMaximum(max(total, 1))
+        self.progress_bar.setValue(done)
+        self.setWindowTitle(f"Saving ({done}/{total})")
+
+    def image_exported(self, export_result):
+        self.show_stats()
+        if export_result.error:
+            self.export_errors += 1
+            print("Error writing image... " + export_result.file_path)
+            print("Error:", export_result.error)
+        elif export_result.written:
+            print("Writing image... " + export_result.file_path)
+        else:
+            print("Image unchanged... " + export_result.file_path)
+
+    def export_finished(self):
+        self.export_thread = None
+        self.setWindowTitle(WINDOW_TITLE)
+        self.save_button.setEnabled(bool(self.images) and not self.renderer.busy)
+        if self.export_errors:
+            print(f"{self.export_errors} images could not be saved")
+        else:
+            print("Images saved successfully!")
         self.play_complete_sound()
         
+    def closeEvent(self, event):
+        if self.journal is not None:
+            self.renderer.cancel()
+            self.journal.cancel_rendering() # closing the window is not a crash
+            self.journal.close()
+        super().closeEvent(event)
+
     def play_complete_sound(self):
         winsound.PlaySound("SystemExclamation", winsound.SND_ASYNC)
 
     def clear_images(self):
-        # Clear the scrollable layout
-        for i in reversed(range(self.scroll_layout.count())):
-            self.scroll_layout.itemAt(i).widget().setParent(None)
+        # Clear the gallery
+        self.gallery_model.clear()
 
         # Clear the images list
         self.images.clear()
 
 
+def report_startup():
+    # called by the first event loop iteration, once the window is on screen
+    startup_ms = (time.perf_counter() - STARTUP) * 1000
+    print(f"Window shown in {startup_ms:.0f} ms")
+    if startup_ms > STARTUP_TARGET_MS:
+        print(f"Startup slower than {STARTUP_TARGET_MS} ms")
+
+
 if __name__ == "__main__":
     app = QApplication(sys.argv)
     window = FileDropWindow()
     window.show()
+    QTimer.singleShot(0, report_startup)
     sys.exit(app.exec_())
@@ -0,0 +1,554 @@
+import argparse, json, socket, sys, threading, time, uuid
+import os.path as op, os
+
+from SoXspectroCore import RenderJob, RenderOutput, RenderResult, RenderEngine, CancelToken, write_atomic, SoXPath, SoXSpectroW, SoXSpectroH, MAX_WORKERS, RENDER_BACKEND, RENDER_PROFILES
+
+# Render farm over a shared spool folder (a network share, or a local folder for several workers of one machine).
+# A coordinator (a window with FARM_SPOOL set, or the submit command) writes one job file per audio file into queue/.
+# Workers claim a job by renaming its file into claimed/ (only one rename of a file can succeed), render it with the same
+# RenderJob and SoX command as the windows, then write the images into results/ and a report into done/, collected by the
+# coordinator. A worker touches its claims every FARM_HEARTBEAT_SECONDS, a claim left untouched FARM_STALE_SECONDS
+# (worker killed, machine down) is queued again by the other workers.
+# Usage:
+#   python SoXspectroFarm.py worker <spool> [--workers 8] [--map /mnt/music=M:/music]
+#   python SoXspectroFarm.py submit <spool> <folder> [--subfolder]
+#   python SoXspectroFarm.py status <spool>
+
+FARM_HEARTBEAT_SECONDS = 10.0
+FARM_STALE_SECONDS = 60.0 # several heartbeats, so a slow share does not get claims taken back
+FARM_MAX_ATTEMPTS = 3 # claims lost in a row before a job is reported failed: it takes its workers down
+FARM_POLL_SECONDS = 1.0 # idle workers and coordinators look at the spool this often
+FARM_KEEP_SECONDS = 24 * 3600 # results of closed coordinators and status of dead workers are removed after this
+
+QUEUE, CLAIMED, DONE, RESULTS, WORKERS = 'queue', 'claimed', 'done', 'results', 'workers'
+
+
+def new_batch_id():
+    # Sorts by submission time, so the oldest batch is rendered first
+    return time.strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:6]
+
+
+def worker_name():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def job_data(job):
+    # JSON of a RenderJob, the SoX executable is the one of the worker
+    return {'path': job.path, 'index': job.index, 'width': job.width, 'height': job.height, 'decoder': job.decoder, 'backend': job.backend,
+            'tile_seconds': job.tile_seconds, 'trim': job.trim, 'outputs': [output.key for output in job.outputs] if job.outputs else None,
+            'analyze': job.analyze}
+
+
+def map_path(path, path_map=()):
+    # path_map: (coordinator prefix, worker prefix) pairs, for shares mounted at different places on each machine
+    path = path.replace("\\", "/")
+    for source, target in path_map:
+        source = source.replace("\\", "/")
+        if path.startswith(source):
+            return target + path[len(source):]
+    return path
+
+
+def data_job(data, sox_path=SoXPath, path_map=()):
+    return RenderJob(map_path(data['path'], path_map), data['index'], data['width'], data['height'], sox_path, data['decoder'], data['backend'],
+                     data['tile_seconds'], trim=tuple(data['trim']) if data['trim'] else None,
+                     outputs=[RenderOutput(*key) for key in data['outputs']] if data['outputs'] else None, analyze=data['analyze'])
+
+
+def claim_job_id(name):
+    # "<job id>#<attempts>@<worker>.json" -> (job id, attempts)
+    job_id, attempts = name.split('@')[0].rsplit('.json', 1)[0].split('#')
+    return job_id, int(attempts)
+
+
+class Spool:
+    # Shared spool folder: queue/ (job files named <job id>#<claims lost>), claimed/ (<job id>#<claims lost>@<worker>),
+    # done/ (reports), results/ (images) and workers/ (status of each worker).
+    # Every change is a rename or an atomic write, files starting with a dot are being written
+    def __init__(self, root, stale_seconds=FARM_STALE_SECONDS, max_attempts=FARM_MAX_ATTEMPTS):
+        self.root = root
+        self.stale_seconds = stale_seconds
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.listing = [] # queued job files not tried yet by this process, listed again once all are tried
+        for folder in (QUEUE, CLAIMED, DONE, RESULTS, WORKERS):
+            os.makedirs(op.join(root, folder), exist_ok=True)
+
+    def path(self, folder, name):
+        return op.join(self.root, folder, name)
+
+    def names(self, folder, prefix=""):
+        try:
+            return sorted(name for name in os.listdir(op.join(self.root, folder))
+                          if name.endswith('.json') and name.startswith(prefix) and not name.startswith('.'))
+        except OSError:
+            return []
+
+    def now(self):
+        # Time as seen by the spool file system, heartbeats written by machines whose clocks differ are compared to it
+        clock_path = op.join(self.root, '.clock')
+        try:
+            with open(clock_path, "a"):
+                pass
+            os.utime(clock_path)
+            return os.stat(clock_path).st_mtime
+        except OSError:
+            return time.time()
+
+    def put(self, job_id, data, attempts=0):
+        write_atomic(self.path(QUEUE, f"{job_id}#{attempts}.json"), json.dumps(data).encode())
+
+    def withdraw(self, job_ids):
+        # Removes the queued files of job_ids, the ones already claimed are left to their worker
+        for name in self.names(QUEUE):
+            if claim_job_id(name)[0] in job_ids:
+                try:
+                    os.remove(self.path(QUEUE, name))
+                except OSError:
+                    pass
+
+    def claim(self, worker):
+        # Moves the first queued job into claimed/ and returns (claim path, job data), None when nothing is queued
+        while True:
+            with self.lock:
+                if not self.listing:
+                    self.listing = self.names(QUEUE)
+                    if not self.listing:
+                        return None
+                name = self.listing.pop(0)
+            queue_path = self.path(QUEUE, name)
+            claim_path = self.path(CLAIMED, name[:-len('.json')] + f"@{worker}.json")
+            try:
+                os.utime(queue_path) # a rename keeps the modification time, which is the heartbeat of a claim
+                os.rename(queue_path, claim_path)
+            except OSError:
+                continue # claimed by another worker
+            try:
+                with open(claim_path, encoding='utf-8') as file:
+                    return claim_path, json.load(file)
+            except (OSError, ValueError) as e:
+                print(f"Unreadable job {name}: {type(e).__name__}: {e}", file=sys.stderr)
+                try:
+                    os.remove(claim_path)
+                except OSError:
+                    pass
+
+    def touch(self, claim_path):
+        # Heartbeat of a claim, False when it was taken back in the meantime
+        try:
+            os.utime(claim_path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def release(self, claim_path):
+        # Queues again a job its worker is not rendering to the end (worker stopped), no claim is counted as lost
+        try:
+            os.rename(claim_path, self.path(QUEUE, op.basename(claim_path).split('@')[0] + '.json'))
+        except OSError:
+            pass
+
+    def finish(self, claim_path, data, result, worker):
+        # Writes the images of a result into results/, then its report into done/, and drops the claim
+        job_id, _ = claim_job_id(op.basename(claim_path).lstrip('.'))
+        kind, files = None, []
+        if result.ok:
+            if result.outputs:
+                kind, items = 'outputs', list(result.outputs.items())
+            elif result.tiles:
+                kind, items = 'tiles', [(f"_{number:03d}.png", tile) for number, tile in enumerate(result.tiles, 1)]
+            else:
+                kind, items = 'image', [('.png', result.image)]
+            for suffix, data_bytes in items:
+                write_atomic(self.path(RESULTS, job_id + suffix), data_bytes)
+                files.append(suffix)
+        report = {'job': data, 'worker': worker, 'kind': kind, 'files': files, 'error': result.error, 'elapsed': result.elapsed,
+                  'cached': result.cached, 'decoder': result.decoder, 'analysis': result.analysis, 'timings': dict(result.timings), 'bytes_in': result.bytes_in}
+        write_atomic(self.path(DONE, job_id + '.json'), json.dumps(report).encode())
+        try:
+            os.remove(claim_path)
+        except FileNotFoundError:
+            pass
+
+    def collect(self, job_id, job):
+        # RenderResult of a done job (None when its report cannot be read yet), its files are removed from the spool
+        report_path = self.path(DONE, job_id + '.json')
+        try:
+            with open(report_path, encoding='utf-8') as file:
+                report = json.load(file)
+        except (OSError, ValueError):
+            return None
+        result = RenderResult(job, error=report['error'], elapsed=report['elapsed'], cached=report['cached'], analysis=report['analysis'],
+                              decoder=report.get('decoder'))
+        result.timings.update(report['timings'])
+        result.bytes_in = report['bytes_in']
+        try:
+            files = {}
+            for suffix in report['files']:
+                with open(self.path(RESULTS, job_id + suffix), "rb") as file:
+                    files[suffix] = file.read()
+        except OSError as e:
+            files, result.error = {}, f"Result lost from the spool: {type(e).__name__}: {e}"
+        if files:
+            if report['kind'] == 'outputs':
+                result.outputs = files
+                result.image = next((data for suffix, data in files.items() if suffix.endswith('.png')), None)
+            elif report['kind'] == 'tiles':
+                result.tiles = list(files.values())
+                result.image = result.tiles[0]
+            else:
+                result.image = files['.png']
+        self.remove(job_id, report['files'])
+        return result
+
+    def remove(self, job_id, suffixes):
+        for path in [self.path(RESULTS, job_id + suffix) for suffix in suffixes] + [self.path(DONE, job_id + '.json')]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def reclaim(self):
+        # Queues again the claims whose worker stopped heartbeating, or fails their job after max_attempts lost claims.
+        # Any worker can do it at any time: the claim is renamed first, so only one of them acts on it
+        now = self.now()
+        for name in self.names(CLAIMED):
+            claim_path = self.path(CLAIMED, name)
+            try:
+                if now - os.stat(claim_path).st_mtime < self.stale_seconds:
+                    continue
+            except OSError:
+                continue
+            job_id, attempts = claim_job_id(name)
+            if attempts + 1 < self.max_attempts and not op.exists(self.path(DONE, job_id + '.json')):
+                try:
+                    os.rename(claim_path, self.path(QUEUE, f"{job_id}#{attempts + 1}.json"))
+                    print(f"Claim {name} is stale, queued again")
+                except OSError:
+                    pass
+                continue
+            reclaim_path = self.path(CLAIMED, '.' + name)
+            try:
+                os.rename(claim_path, reclaim_path)
+            except OSError:
+                continue
+            try:
+                if not op.exists(self.path(DONE, job_id + '.json')): # not finished while it went stale
+                    with open(reclaim_path, encoding='utf-8') as file:
+                        data = json.load(file)
+                    self.finish(reclaim_path, data, RenderResult(None, error=f"{attempts + 1} workers stopped while rendering this file"), 'farm')
+            except (OSError, ValueError) as e:
+                print(f"Could not fail the job {name}: {type(e).__name__}: {e}", file=sys.stderr)
+            finally:
+                if op.exists(reclaim_path):
+                    os.remove(reclaim_path)
+
+    def clean(self):
+        # Removes the results no coordinator collected (closed while its jobs were rendered) and the status of dead workers
+        now = self.now()
+        for folder in (DONE, WORKERS):
+            for name in self.names(folder):
+                try:
+                    if now - os.stat(self.path(folder, name)).st_mtime < FARM_KEEP_SECONDS:
+                        continue
+                    if folder == DONE:
+                        job_id = name[:-len('.json')]
+                        self.remove(job_id, [result_name[len(job_id):] for result_name in os.listdir(op.join(self.root, RESULTS))
+                                             if result_name.startswith(job_id)])
+                    else:
+                        os.remove(self.path(folder, name))
+                except OSError:
+                    pass
+
+    def put_worker(self, worker, status):
+        write_atomic(self.path(WORKERS, worker + '.json'), json.dumps(status).encode())
+
+    def remove_worker(self, worker):
+        try:
+            os.remove(self.path(WORKERS, worker + '.json'))
+        except OSError:
+            pass
+
+    def status(self, prefix=""):
+        # Jobs queued, being rendered and done (all of them, and the ones whose id starts with prefix),
+        # and the status of the workers that heartbeated within stale_seconds
+        now = self.now()
+        workers = []
+        for name in self.names(WORKERS):
+            try:
+                if now - os.stat(self.path(WORKERS, name)).st_mtime > self.stale_seconds:
+                    continue
+                with open(self.path(WORKERS, name), encoding='utf-8') as file:
+                    workers.append(json.load(file))
+            except (OSError, ValueError):
+                continue
+        status = {'workers': workers}
+        for state, folder in (('queued', QUEUE), ('rendering', CLAIMED), ('done', DONE)):
+            names = self.names(folder)
+            status[state] = sum(name.startswith(prefix) for name in names)
+            status['total_' + state] = len(names)
+        return status
+
+
+def status_text(status):
+    # One line of farm wide progress
+    workers = status['workers']
+    text = (f"Farm: {len(workers)} workers ({sum(worker['threads'] for worker in workers)} threads), "
+            f"{status['queued']} queued, {status['rendering']} rendering")
+    if status['total_queued'] + status['total_rendering'] > status['queued'] + status['rendering']:
+        text += f" ({status['total_queued']} queued, {status['total_rendering']} rendering in all batches)"
+    return text
+
+
+class FarmCoordinator:
+    # Submits the jobs of one batch to the spool and collects their results, from a single thread
+    def __init__(self, spool):
+        self.spool = spool
+        self.batch = new_batch_id()
+        self.sequence = 0
+        self.jobs = {} # job id -> RenderJob submitted and not collected yet
+
+    def submit(self, jobs):
+        for job in jobs:
+            job_id = f"{self.batch}-{self.sequence:06d}"
+            self.sequence += 1
+            self.spool.put(job_id, job_data(job))
+            self.jobs[job_id] = job
+
+    def cancel(self, predicate=None):
+        # Withdraws the jobs for which predicate(job) is true, all of them by default, and returns them.
+        # The ones already claimed are rendered anyway, their results are dropped when they come back
+        cancelled = {job_id: job for job_id, job in self.jobs.items() if predicate is None or predicate(job)}
+        if cancelled:
+            self.spool.withdraw(set(cancelled))
+        for job_id in cancelled:
+            del self.jobs[job_id]
+        return list(cancelled.values())
+
+    def poll(self):
+        # RenderResults of the jobs done since the last call
+        results = []
+        for name in self.spool.names(DONE, self.batch):
+            job_id = name[:-len('.json')]
+            job = self.jobs.get(job_id)
+            result = self.spool.collect(job_id, job)
+            if result is not None and job is not None:
+                del self.jobs[job_id]
+                results.append(result)
+        return results
+
+    def status(self):
+        return self.spool.status(self.batch)
+
+
+class FarmWorker:
+    # Renders the jobs of a spool on threads of this machine, until Ctrl+C or, with exit_when_idle, until the queue is empty
+    def __init__(self, spool, threads=MAX_WORKERS, sox_path=SoXPath, path_map=(), cache=None, heartbeat_seconds=FARM_HEARTBEAT_SECONDS,
+                 exit_when_idle=False):
+        self.spool = spool
+        self.name = worker_name()
+        self.threads = threads
+        self.sox_path = sox_path
+        self.path_map = path_map
+        self.heartbeat_seconds = heartbeat_seconds
+        self.exit_when_idle = exit_when_idle
+        self.engine = RenderEngine(threads, cache)
+        self.lock = threading.Lock()
+        self.claims = {} # claim path -> (audio path, CancelToken of its render), touched by the heartbeat
+        self.lost = set() # claim paths taken back from this worker while rendering (missed heartbeats)
+        self.done = self.failed = 0
+        self.working = 0 # threads still claiming jobs
+        self.stopping = threading.Event()
+        self.finished = threading.Event() # every thread returned
+
+    def work(self):
+        try:
+            while not self.stopping.is_set():
+                claim = self.spool.claim(self.name)
+                if claim is None:
+                    if self.exit_when_idle:
+                        return
+                    self.stopping.wait(FARM_POLL_SECONDS)
+                    continue
+                self.render(*claim)
+        finally:
+            with self.lock:
+                self.working -= 1
+                if not self.working:
+                    self.finished.set()
+
+    def render(self, claim_path, data):
+        token = CancelToken()
+        with self.lock:
+            self.claims[claim_path] = data['path'], token
+            if self.stopping.is_set(): # claimed while stopping
+                token.cancel()
+        job = None
+        try:
+            job = data_job(data, self.sox_path, self.path_map)
+            result = self.engine.render(job, None, token)
+        except Exception as e:
+            result = RenderResult(job, error=f"{type(e).__name__}: {e}")
+        try:
+            with self.lock:
+                lost = claim_path in self.lost
+            if lost or not self.spool.touch(claim_path):
+                # queued again (or failed) by the spool, the worker that claims it next reports it
+                print(f"Claim lost, result of {data['path']} dropped", file=sys.stderr)
+                return
+            if result.cancelled:
+                self.spool.release(claim_path) # worker stopped, another one renders it
+                return
+            try:
+                self.spool.finish(claim_path, data, result, self.name)
+            except OSError as e:
+                result = RenderResult(job, error=f"Could not write the result: {type(e).__name__}: {e}")
+                self.spool.finish(claim_path, data, result, self.name)
+        except OSError as e:
+            print(f"Spool unreachable, {data['path']} queued again: {type(e).__name__}: {e}", file=sys.stderr)
+            self.spool.release(claim_path)
+            return
+        finally:
+            with self.lock:
+                del self.claims[claim_path]
+                self.lost.discard(claim_path)
+        with self.lock:
+            if result.ok:
+                self.done += 1
+            else:
+                self.failed += 1
+        if result.ok:
+            print(f"{data['path']} ({result.elapsed:.1f} s)")
+        else:
+            print(f"FAILED {data['path']}: {result.error.strip()}", file=sys.stderr)
+
+    def heartbeat(self):
+        with self.lock:
+            claims = dict(self.claims)
+            done, failed = self.done, self.failed
+        try:
+            for claim_path, (_, token) in claims.items():
+                if not self.spool.touch(claim_path):
+                    with self.lock:
+                        if claim_path not in self.claims: # finished meanwhile
+                            continue
+                        self.lost.add(claim_path)
+                    token.cancel()
+            self.spool.put_worker(self.name, {'worker': self.name, 'host': socket.gethostname(), 'pid': os.getpid(), 'threads': self.threads,
+                                              'done': done, 'failed': failed, 'rendering': sorted(path for path, _ in claims.values()),
+                                              'time': time.time()})
+            self.spool.reclaim()
+            self.spool.clean()
+        except OSError as e:
+            print(f"Spool unreachable: {type(e).__name__}: {e}", file=sys.stderr)
+
+    def run(self):
+        threads = [threading.Thread(target=self.work, name=f"farm-{number}") for number in range(self.threads)]
+        self.working = len(threads)
+        for thread in threads:
+            thread.start()
+        try:
+            while not self.finished.is_set():
+                self.heartbeat()
+                self.finished.wait(self.heartbeat_seconds) # not Thread.join, a Ctrl+C during a join can leave the thread unjoinable
+        except KeyboardInterrupt:
+            print("Stopping, the files being rendered are queued again", file=sys.stderr)
+            self.stopping.set()
+            with self.lock:
+                for _, token in self.claims.values():
+                    token.cancel()
+            for thread in threads:
+                thread.join()
+        finally:
+            self.spool.remove_worker(self.name)
+        return self.failed
+
+
+def submit(args):
+    # Queues a folder tree, saves the images as they come back like SoXspectroCLI, and withdraws what is left on Ctrl+C
+    from SoXspectroCLI import find_audio_files, output_path, result_files
+    spool = Spool(args.spool)
+    coordinator = FarmCoordinator(spool)
+    coordinator.submit(RenderJob(op.abspath(audio_path), index, args.width, args.height, backend=args.backend,
+                                 outputs=RENDER_PROFILES.get(args.render_profile), analyze=args.analyze)
+                       for index, audio_path in enumerate(find_audio_files(args.root, args.recursive)))
+    total, done, failed = len(coordinator.jobs), 0, 0
+    print(f"{total} files queued in {args.spool} (batch {coordinator.batch})")
+    last_status = 0.0
+    try:
+        while coordinator.jobs:
+            for result in coordinator.poll():
+                done += 1
+                try:
+                    if not result.ok:
+                        raise RuntimeError(result.error.strip())
+                    files = result_files(result, output_path(result.job.path, args.subfolder))
+                    for path, data in files:
+                        write_atomic(path, data)
+                    print(f"[{done}/{total}] " + ';'.join(path for path, _ in files))
+                except (OSError, RuntimeError) as e:
+                    failed += 1
+                    print(f"[{done}/{total}] FAILED {result.job.path}: {e}", file=sys.stderr)
+            if time.monotonic() - last_status >= FARM_HEARTBEAT_SECONDS:
+                print(status_text(coordinator.status()))
+                last_status = time.monotonic()
+            if coordinator.jobs:
+                time.sleep(FARM_POLL_SECONDS)
+    except KeyboardInterrupt:
+        print(f"Interrupted, {len(coordinator.cancel())} files withdrawn from the spool", file=sys.stderr)
+    print(f"{done} done, {failed} failed")
+    return 1 if failed or coordinator.jobs else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Render farm over a shared spool folder.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    worker_parser = commands.add_parser('worker', help="render the jobs of the spool on this machine")
+    worker_parser.add_argument('spool', help="spool folder, shared by the coordinators and the workers")
+    worker_parser.add_argument('--workers', type=int, default=MAX_WORKERS, help="number of files rendered in parallel")
+    worker_parser.add_argument('--sox', default=SoXPath, help="path to the sox executable")
+    worker_parser.add_argument('--map', action='append', default=[], metavar='FROM=TO',
+                        help="audio paths starting with FROM (as seen by the coordinator) are read from TO on this machine")
+    worker_parser.add_argument('--cache', action='store_true', help="use the spectrogram cache of this machine")
+    worker_parser.add_argument('--exit-when-idle', action='store_true', help="stop once the queue is empty instead of waiting for jobs")
+    worker_parser.add_argument('--heartbeat', type=float, default=FARM_HEARTBEAT_SECONDS, help="seconds between heartbeats")
+    worker_parser.add_argument('--stale', type=float, default=FARM_STALE_SECONDS,
+                        help="seconds without heartbeat after which a claim is queued again")
+    submit_parser = commands.add_parser('submit', help="render a folder tree on the farm and save the images as SoXspectroCLI does")
+    submit_parser.add_argument('spool')
+    submit_parser.add_argument('root', help="folder (or single file) to process")
+    submit_parser.add_argument('--no-recursive', dest='recursive', action='store_false', help="only process the top level of the folder")
+    submit_parser.add_argument('--subfolder', action='store_true', help="write images into a 'Spectrograms' folder next to the audio")
+    submit_parser.add_argument('-x', '--width', type=int, default=SoXSpectroW)
+    submit_parser.add_argument('-y', '--height', type=int, default=SoXSpectroH, help="height of one channel")
+    submit_parser.add_argument('--backend', default=RENDER_BACKEND, choices=('sox', 'numpy', 'auto'))
+    submit_parser.add_argument('--render-profile', choices=sorted(RENDER_PROFILES))
+    submit_parser.add_argument('--analyze', action='store_true')
+    status_parser = commands.add_parser('status', help="show the workers and the queue")
+    status_parser.add_argument('spool')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == 'worker':
+        cache = None
+        if args.cache:
+            from SoXspectroCache import SpectrogramCache
+            cache = SpectrogramCache()
+        path_map = [tuple(mapping.split('=', 1)) for mapping in args.map]
+        worker = FarmWorker(Spool(args.spool, args.stale), args.workers, args.sox, path_map, cache, args.heartbeat, args.exit_when_idle)
+        print(f"Worker {worker.name} on {args.spool}, {args.workers} threads")
+        return 1 if worker.run() else 0
+    if args.command == 'submit':
+        return submit(args)
+    status = Spool(args.spool).status()
+    for worker in status['workers']:
+        print(f"{worker['worker']:<30} {worker['threads']:>3} threads {worker['done']:>7} done {worker['failed']:>5} failed "
+              f"{len(worker['rendering']):>3} rendering")
+    print(status_text(status) + f", {status['done']} not collected")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,236 @@
+import hashlib, json, sys, tempfile, threading, time
+import os.path as op, os
+
+from SoXspectroCore import APP_DATA_DIR, file_signature
+
+# Crash safe progress journal of a batch: one JSON line per state change of a file, appended and flushed at once,
+# so a batch interrupted by a crash, a kill or a reboot resumes where it stopped instead of starting over.
+# States: queued -> rendering -> done or failed (cancelled when stopped on purpose). With progressive renders, a file
+# is 'previewed' between its preview and its full render. A file left 'rendering' JOURNAL_MAX_ATTEMPTS times in a row
+# took the whole process down with it and is failed instead of tried again.
+# Show a journal: python SoXspectroJournal.py <journal file>
+
+JOURNAL_DIR = op.join(APP_DATA_DIR, 'journals') # journals of the windows, one per folder
+JOURNAL_MAX_ATTEMPTS = 2
+JOURNAL_SYNC_SECONDS = 1.0 # every line is flushed, fsync (power loss) at most this often
+
+QUEUED, RENDERING, PREVIEWED, DONE, FAILED, CANCELLED = 'queued', 'rendering', 'previewed', 'done', 'failed', 'cancelled'
+
+
+def journal_path(key):
+    # Journal of a batch identified by key (a folder path, a window name)
+    return op.join(JOURNAL_DIR, hashlib.sha1(key.encode('utf-8', 'surrogatepass')).hexdigest()[:16] + '.jsonl')
+
+
+def output_exists(path, archives=None):
+    # A loose image, or a member of a SoXspectroArchive archive: <folder>/Spectrograms.sqlite/<name>.
+    # archives: {archive path: member names} filled as archives are read, so each one is read once
+    if op.exists(path):
+        return True
+    archive_path, name = op.split(path)
+    if not op.isfile(archive_path):
+        return False
+    archives = archives if archives is not None else {}
+    if archive_path not in archives:
+        import sqlite3
+        from SoXspectroArchive import SpectrogramArchive
+
+        try:
+            archive = SpectrogramArchive(archive_path)
+            try:
+                archives[archive_path] = archive.names()
+            finally:
+                archive.close()
+        except (OSError, sqlite3.Error):
+            archives[archive_path] = set()
+    return name in archives[archive_path]
+
+
+class FileState:
+    def __init__(self):
+        self.state = None
+        self.error = None
+        self.output = None
+        self.signature = None # [size, mtime_ns] of the audio file when it was done
+        self.params = None # render parameters the outputs were made with
+        self.attempts = 0 # renders started and not finished since the last done, failed or cancelled
+
+
+class BatchJournal:
+    # Append only journal shared by the render threads. Replayed when opened, the last line may be torn by a crash
+    def __init__(self, path, max_attempts=JOURNAL_MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.files = {} # audio path -> FileState
+        self.rendering = {} # files this process started rendering and did not finish yet -> renders in progress (preview, full)
+        self.last_sync = time.monotonic()
+        self.torn = False # last line cut by a crash
+        lines = self._replay()
+        os.makedirs(op.dirname(path) or ".", exist_ok=True)
+        if lines > 2 * len(self.files) + 1000:
+            self._compact()
+        self.file = open(path, "a", encoding='utf-8')
+        if self.torn:
+            self.file.write("\n") # so the next line is not appended to it
+
+    def _replay(self):
+        lines = 0
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                for line in file:
+                    lines += 1
+                    self.torn = not line.endswith("\n")
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue # torn by a crash while being written
+                    self._apply(entry)
+        except OSError:
+            pass
+        return lines
+
+    def _apply(self, entry):
+        state = self.files.setdefault(entry['path'], FileState())
+        state.state = entry['state']
+        if entry['state'] == RENDERING:
+            state.attempts += 1
+        elif entry['state'] == PREVIEWED: # the preview did not take the process down
+            state.attempts = max(0, state.attempts - 1)
+        elif entry['state'] in (DONE, FAILED, CANCELLED):
+            state.attempts = 0
+        if entry['state'] not in (QUEUED, PREVIEWED): # queueing again keeps the outcome of the last run
+            state.error = entry.get('error')
+            state.output = entry.get('output')
+            state.signature = entry.get('signature')
+            state.params = entry.get('params')
+        if 'attempts' in entry: # compacted journal
+            state.attempts = entry['attempts']
+
+    def _compact(self):
+        # Rewrites the journal with only the last state of each file, atomically
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=op.dirname(self.path) or ".")
+        try:
+            with os.fdopen(fd, "w", encoding='utf-8') as file:
+                for path, state in self.files.items():
+                    file.write(json.dumps({'path': path, 'state': state.state, 'error': state.error, 'output': state.output,
+                                           'signature': state.signature, 'params': state.params, 'attempts': state.attempts},
+                                          ensure_ascii=False) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.path)
+            self.torn = False
+        except OSError:
+            if op.exists(temp_path):
+                os.remove(temp_path)
+
+    def _write(self, entries):
+        with self.lock:
+            if self.file is None:
+                return
+            for entry in entries:
+                path = entry['path']
+                if entry['state'] == RENDERING:
+                    self.rendering[path] = self.rendering.get(path, 0) + 1
+                    if self.rendering[path] > 1:
+                        continue # the preview and the full render of a file at once: one line covers both
+                elif entry['state'] == PREVIEWED:
+                    if path not in self.rendering:
+                        continue # finished or cancelled meanwhile
+                    self.rendering[path] -= 1
+                    if self.rendering[path]:
+                        continue # the full render is still running
+                    del self.rendering[path]
+                else:
+                    self.rendering.pop(path, None)
+                self._apply(entry)
+                self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.file.flush()
+            if time.monotonic() - self.last_sync >= JOURNAL_SYNC_SECONDS:
+                os.fsync(self.file.fileno())
+                self.last_sync = time.monotonic()
+
+    def record(self, path, state, error=None, output=None, params=None):
+        # output: ';' separated paths of the files written, params: JSON render parameters they depend on
+        entry = {'path': path, 'state': state, 'time': round(time.time(), 3)}
+        if error:
+            entry['error'] = error
+        if output:
+            entry['output'] = output
+        if params is not None:
+            entry['params'] = params
+        if state == DONE:
+            entry['signature'] = list(file_signature(path) or ())
+        self._write([entry])
+
+    def record_queued(self, paths):
+        now = round(time.time(), 3)
+        self._write([{'path': path, 'state': QUEUED, 'time': now} for path in paths])
+
+    def cancel_rendering(self):
+        # Stopped on purpose (new batch, window closed, Ctrl+C): the files this process is rendering did not take it down.
+        # Files left rendering by an earlier process that died keep their attempts
+        now = round(time.time(), 3)
+        with self.lock:
+            paths = sorted(self.rendering)
+        self._write([{'path': path, 'state': CANCELLED, 'time': now} for path in paths])
+
+    def state(self, path):
+        with self.lock:
+            return self.files.get(path)
+
+    def is_done(self, path, params=None, archives=None):
+        # Done with the same render parameters, from the same audio file, and every output is still there
+        state = self.files.get(path)
+        return (state is not None and state.state == DONE and state.params == params and bool(state.output)
+                and state.signature == list(file_signature(path) or ())
+                and all(output_exists(output, archives) for output in state.output.split(';')))
+
+    def resume(self, paths, skip_done=True, retry_failed=False, params=None):
+        # Splits paths into (to render, skipped). Skipped: done with params and unchanged since (skip_done), failed (unless
+        # retry_failed), and the files that were being rendered max_attempts times when the process died, failed here
+        todo, skipped, crashed = [], [], []
+        archives = {} # archive path -> member names
+        with self.lock:
+            for path in paths:
+                state = self.files.get(path)
+                if state is None:
+                    todo.append(path)
+                elif state.state == RENDERING and state.attempts >= self.max_attempts:
+                    crashed.append(path)
+                elif skip_done and self.is_done(path, params, archives):
+                    skipped.append(path)
+                elif state.state == FAILED and not retry_failed:
+                    skipped.append(path)
+                else:
+                    todo.append(path)
+        for path in crashed:
+            self.record(path, FAILED, f"The renderer stopped {self.max_attempts} times while rendering this file")
+        return todo, skipped + crashed
+
+    def counts(self):
+        with self.lock:
+            counts = {}
+            for state in self.files.values():
+                counts[state.state] = counts.get(state.state, 0) + 1
+            return counts
+
+    def close(self):
+        # Renders still running are recorded as cancelled, results arriving after the close are dropped
+        self.cancel_rendering()
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or not op.isfile(sys.argv[1]):
+        sys.exit("Usage: python SoXspectroJournal.py <journal file>")
+    journal = BatchJournal(sys.argv[1])
+    for path, state in sorted(journal.files.items()):
+        print(f"{state.state:<10} {path}" + (f"  ({state.error})" if state.error else ""))
+    print(", ".join(f"{count} {state}" for state, count in sorted(journal.counts().items())))
+    journal.close()
@@ -0,0 +1,550 @@
+import io, struct, subprocess, sys, time, wave, zlib
+import os.path as op
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from SoXspectroCore import (RenderJob, RenderOutput, CancelToken, StageTimes, probe_stream, ffmpeg_pcm_command, build_sox_command,
+                             choose_backend, choose_decoder, decode_to_wav, sox_file_type)
+
+# Built-in spectrogram backend: vectorized STFT with the same dB range and palette as SoX, no SoX process.
+# Benchmark against SoX: python SoXspectroNumpy.py <audio files...>
+
+DYNAMIC_RANGE = 120 # dB, same as SoX's default -z
+FRAMES_PER_COLUMN = None # max number of windows averaged in one column. None: every sample counts. A number samples long files evenly within each column, faster but short events can be missed
+PREVIEW_FRAMES_PER_COLUMN = 8 # same for the low resolution first pass of progressive renders, replaced by the full render
+BLOCK_BYTES = 64 * 1024 * 1024 # memory used by one batch of FFT frames
+CHUNK_FRAMES = 1 << 18 # samples per channel read at once
+
+# Lossy transcode detection (SpectralAnalysis)
+ANALYSIS_DFT = 4096 # long term average spectrum resolution, about 11 Hz per bin at 44.1 kHz
+ANALYSIS_BANDS = (16000, 19000, 20000) # Hz, energy above each one is reported (mp3 128k, 192k, 320k lowpasses)
+CUTOFF_DROP_DB = 25 # the cutoff is the highest frequency this much louder than everything CUTOFF_SPAN_HZ above it
+CUTOFF_SPAN_HZ = 500
+SUSPECT_CUTOFF_RATIO = 0.9 # files whose cutoff is below this fraction of Nyquist are flagged
+CLIP_LEVEL = 0.999 # samples at or above this magnitude count as clipped
+
+
+def sox_palette(points=256):
+    # SoX's default spectrogram palette: black, blue, purple, red, orange, yellow, white
+    x = np.linspace(0, 1, points)
+    red = np.where(x < .13, 0, np.where(x < .73, np.sin((x - .13) / .60 * np.pi / 2), 1))
+    green = np.where(x < .60, 0, np.where(x < .91, np.sin((x - .60) / .31 * np.pi / 2), 1))
+    blue = np.where(x < .60, .5 * np.sin(x / .60 * np.pi), np.where(x < .78, 0, (x - .78) / .22))
+    return (np.stack([red, green, blue], axis=1) * 255 + .5).astype(np.uint8)
+
+
+PALETTE = sox_palette()
+
+
+def pcm_to_float(data, sample_width, channels, floating=False):
+    # Interleaved little endian PCM bytes to a float32 (channels, samples) array in [-1, 1]
+    if floating:
+        samples = np.frombuffer(data, {4: '<f4', 8: '<f8'}[sample_width]).astype(np.float32)
+    elif sample_width == 1:
+        samples = (np.frombuffer(data, np.uint8).astype(np.float32) - 128) / 128
+    elif sample_width == 3:
+        raw = np.frombuffer(data, np.uint8).reshape(-1, 3).astype(np.int32)
+        samples = ((raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)) << 8 >> 8).astype(np.float32) / 8388608
+    else:
+        samples = np.frombuffer(data, {2: '<i2', 4: '<i4'}[sample_width]).astype(np.float32) / 2 ** (8 * sample_width - 1)
+    return samples.reshape(-1, channels).T
+
+
+WAV_SAMPLE_WIDTHS = {1: (1, 2, 3, 4), 3: (4, 8)} # bytes per sample pcm_to_float reads, by format tag (PCM, float)
+
+
+def wav_layout(file_path):
+    # (data offset, data size, sample width, channels, sample rate, floating) of a PCM or float wav file, None otherwise
+    # (other encodings, sample widths pcm_to_float does not read, malformed headers: left to SoX or ffmpeg)
+    try:
+        return _wav_layout(file_path)
+    except struct.error:
+        return None
+
+
+def _wav_layout(file_path):
+    file_size = op.getsize(file_path)
+    with open(file_path, "rb") as file:
+        riff, _, wave_id = struct.unpack('<4sI4s', file.read(12))
+        if riff not in (b'RIFF', b'RF64') or wave_id != b'WAVE':
+            return None
+        fmt = None
+        while True:
+            header = file.read(8)
+            if len(header) < 8:
+                return None
+            chunk_id, size = struct.unpack('<4sI', header)
+            if chunk_id == b'fmt ':
+                body = file.read(size)
+                tag, channels, sample_rate, _, block_align, _ = struct.unpack('<HHIIHH', body[:16])
+                if tag == 0xFFFE: # extensible: the real format tag starts the sub format GUID
+                    tag = struct.unpack('<H', body[24:26])[0]
+                # the container width, 24 bit samples may be stored in 4 bytes
+                fmt = (tag, channels, sample_rate, block_align // channels if channels else 0)
+                file.seek(size % 2, 1)
+            elif chunk_id == b'data':
+                if fmt is None or fmt[3] not in WAV_SAMPLE_WIDTHS.get(fmt[0], ()):
+                    return None
+                offset = file.tell()
+                size = min(size, file_size - offset) # RF64 and truncated files
+                tag, channels, sample_rate, sample_width = fmt
+                return offset, size, sample_width, channels, sample_rate, tag == 3
+            else:
+                file.seek(size + size % 2, 1)
+
+
+def sox_stream_info(file_path, sox_path, stdin=None):
+    # (sample rate, channels, frames) of a file SoX opens itself, or reads from stdin (an open file), from "sox --i"
+    output = subprocess.run([sox_path, '--i', '-' if stdin else file_path], stdin=stdin, capture_output=True)
+    if output.returncode != 0:
+        raise ValueError(output.stderr.decode(errors='replace').strip() or "SoX could not read the file")
+    info = {}
+    for line in output.stdout.decode(errors='replace').splitlines():
+        name, _, value = line.partition(':')
+        info[name.strip()] = value.strip()
+    duration = info.get('Duration', '') # "00:00:05.00 = 220500 samples ~ 375 CDDA sectors"
+    frames = int(duration.split('=')[1].split()[0]) if '=' in duration else 0
+    return int(float(info['Sample Rate'])), int(info['Channels']), frames
+
+
+def stream_samples(file_path, token=None, chunk_frames=CHUNK_FRAMES, decoder='ffmpeg', sox_path=None):
+    # Yields the stream format (sample rate, channels, expected frames) then float32 (channels, frames) chunks.
+    # wav data is memory mapped, other formats are decoded as choose_decoder tells: by SoX ('sox', or 'sox-stdin' when
+    # the file is fed on its stdin) or ffmpeg and read from its pipe, or decoded in memory by pydub ('pydub')
+    layout = wav_layout(file_path) if file_path.lower().endswith('.wav') else None
+    if layout is not None:
+        offset, size, sample_width, channels, sample_rate, floating = layout
+        frame_size = sample_width * channels
+        yield sample_rate, channels, size // frame_size
+        if size < frame_size:
+            return
+        data = np.memmap(file_path, np.uint8, 'r', offset, (size // frame_size) * frame_size)
+        for first in range(0, len(data), chunk_frames * frame_size):
+            if token is not None:
+                token.check()
+            yield pcm_to_float(data[first:first + chunk_frames * frame_size], sample_width, channels, floating)
+        return
+
+    token = token or CancelToken()
+    if decoder == 'pydub':
+        with wave.open(io.BytesIO(decode_to_wav(file_path))) as file:
+            sample_width, channels = file.getsampwidth(), file.getnchannels()
+            yield file.getframerate(), channels, file.getnframes()
+            while data := file.readframes(chunk_frames):
+                token.check()
+                yield pcm_to_float(data, sample_width, channels)
+        return
+    use_sox = decoder in ('sox', 'sox-stdin')
+    sox_output = ['-t', 'raw', '-L', '-e', 'floating-point', '-b', '32', '-']
+    if decoder == 'sox-stdin':
+        with open(file_path, "rb") as file: # SoX keeps its own handle
+            stream_format = sox_stream_info(file_path, sox_path, file)
+            file.seek(0)
+            process = token.popen([sox_path, '-t', sox_file_type(file_path), '-'] + sox_output, stdin=file,
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    elif decoder == 'sox':
+        stream_format = sox_stream_info(file_path, sox_path)
+        process = token.popen([sox_path, file_path] + sox_output, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL)
+    elif decoder == 'ffmpeg':
+        sample_rate, channels, duration = probe_stream(file_path)
+        stream_format = sample_rate, channels, int(duration * sample_rate)
+        process = token.popen(ffmpeg_pcm_command(file_path, sample_rate, channels), stdin=subprocess.DEVNULL,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    else:
+        raise ValueError(f"Unknown decoder {decoder!r}")
+    channels = stream_format[1]
+    try:
+        yield stream_format
+        chunk_size = chunk_frames * channels * 4
+        while True:
+            data = process.stdout.read(chunk_size)
+            token.check()
+            if len(data) < channels * 4:
+                break
+            yield pcm_to_float(data[:len(data) - len(data) % (channels * 4)], 4, channels, floating=use_sox)
+    finally:
+        process.stdout.close()
+        process.wait()
+        token.release(process)
+    if process.returncode != 0:
+        raise ValueError(("SoX" if use_sox else "ffmpeg") + " could not decode the file")
+
+
+class StreamingSpectrogram:
+    # Reduces samples to spectrogram columns as they arrive, so memory does not depend on the file duration.
+    # Like SoX, height is the number of frequency bins, so the DFT size is 2 * (height - 1).
+    # Each of the width columns is the mean power of windows spread evenly over its time span, overlapping by half
+    # so that every sample counts. frames_per_column caps their number (sampled preview of long files)
+    def __init__(self, channels, length, width, height, frames_per_column=FRAMES_PER_COLUMN):
+        self.channels, self.width, self.height = channels, width, height
+        self.dft_size = 2 * (height - 1)
+        self.window = np.hanning(self.dft_size + 1)[:-1].astype(np.float32)
+
+        self.length = max(length, 0)
+        column_span = max(length, 1) / width
+        self.per_column = int(max(1, np.ceil(2 * column_span / self.dft_size)))
+        if frames_per_column:
+            self.per_column = min(self.per_column, frames_per_column)
+        self.hop = column_span / self.per_column # distance between the centres of two windows
+        self.frame_count = width * self.per_column
+        self.next_frame = 0
+
+        self.power = np.zeros((channels, width, height), np.float32)
+        self.buffer = np.zeros((channels, self.dft_size // 2), np.float32) # zero padding before the first sample
+        self.buffer_start = -(self.dft_size // 2) # sample position of buffer[:, 0]
+        self.block = max(1, BLOCK_BYTES // (channels * self.dft_size * 16))
+
+    def feed(self, chunk):
+        self.buffer = np.concatenate([self.buffer, chunk], axis=1)
+        self._process()
+
+    def frame_starts(self, first, last):
+        # First sample of the windows first to last - 1 (sorted), computed on the fly so memory does not grow with the file
+        centres = ((np.arange(first, last) + .5) * self.hop).astype(np.int64)
+        return np.clip(centres, 0, self.length) - self.dft_size // 2
+
+    def ready_frames(self, buffer_end):
+        # Number of windows that end within the samples received so far
+        ready = int(min(self.frame_count, max(0, np.ceil((buffer_end - self.dft_size + self.dft_size // 2 + 1) / self.hop - .5))))
+        while ready < self.frame_count and self.frame_starts(ready, ready + 1)[0] + self.dft_size <= buffer_end:
+            ready += 1 # rounding
+        while ready > 0 and self.frame_starts(ready - 1, ready)[0] + self.dft_size > buffer_end:
+            ready -= 1
+        return ready
+
+    def finish(self):
+        # (channels, height, width) power in dB relative to full scale, lowest frequency first
+        buffer_end = self.buffer_start + self.buffer.shape[1]
+        last_start = int(self.frame_starts(self.frame_count - 1, self.frame_count)[0])
+        missing = max(0, last_start + self.dft_size - buffer_end) # zero padding after the last sample
+        self.feed(np.zeros((self.channels, missing), np.float32))
+        power = self.power / (self.window.sum() / 2) ** 2 # a full scale sine reads 0 dB
+        return 10 * np.log10(np.maximum(power, 1e-30)).transpose(0, 2, 1)
+
+    def _process(self):
+        buffer_end = self.buffer_start + self.buffer.shape[1]
+        ready = self.ready_frames(buffer_end)
+        if ready > self.next_frame:
+            frames = sliding_window_view(self.buffer, self.dft_size, axis=1) # view, nothing copied
+            for first in range(self.next_frame, ready, self.block):
+                last = min(first + self.block, ready)
+                batch = frames[:, self.frame_starts(first, last) - self.buffer_start] * self.window
+                spectrum = np.abs(np.fft.rfft(batch, axis=-1)) ** 2
+                columns = np.arange(first, last) // self.per_column
+                bounds = np.flatnonzero(np.diff(columns, prepend=-1)) # first window of each column, windows are sorted
+                self.power[:, columns[bounds]] += np.add.reduceat(spectrum, bounds, axis=1) / self.per_column
+            self.next_frame = ready
+
+        # drop the samples no remaining frame needs
+        keep_from = self.buffer.shape[1]
+        if self.next_frame < self.frame_count:
+            keep_from = min(keep_from, int(self.frame_starts(self.next_frame, self.next_frame + 1)[0]) - self.buffer_start)
+        if keep_from > 0:
+            self.buffer = self.buffer[:, keep_from:]
+            self.buffer_start += keep_from
+
+
+def spectrogram_db(samples, width, height, frames_per_column=FRAMES_PER_COLUMN):
+    spectrogram = StreamingSpectrogram(samples.shape[0], samples.shape[1], width, height, frames_per_column)
+    spectrogram.feed(samples)
+    return spectrogram.finish()
+
+
+def db_to_pixels(db, dynamic_range=DYNAMIC_RANGE):
+    # RGB image (channels * height, width, 3), channels stacked top to bottom, high frequencies at the top
+    levels = np.clip((db + dynamic_range) / dynamic_range, 0, 1)
+    indexes = (levels * (len(PALETTE) - 1) + .5).astype(np.intp)
+    return np.ascontiguousarray(PALETTE[indexes[:, ::-1]].reshape(-1, db.shape[2], 3))
+
+
+class SpectralAnalysis:
+    # Long term average spectrum and clipped samples of a stream, fed the chunks decoded for the spectrogram.
+    # finish() returns the metrics used to spot lossy sources: a lowpass cutoff well below Nyquist and no energy above it
+    def __init__(self, dft_size=ANALYSIS_DFT):
+        self.dft_size = dft_size
+        self.window = np.hanning(dft_size + 1)[:-1].astype(np.float32)
+        self.power = np.zeros(dft_size // 2 + 1)
+        self.frames = self.samples = self.clipped = 0
+        self.sample_rate = None
+
+    def start(self, sample_rate, channels):
+        self.sample_rate = sample_rate
+        self.buffer = np.zeros((channels, 0), np.float32)
+
+    def feed(self, chunk):
+        self.samples += chunk.size
+        self.clipped += int(np.count_nonzero(np.abs(chunk) >= CLIP_LEVEL))
+        buffer = np.concatenate([self.buffer, chunk], axis=1)
+        count = buffer.shape[1] // self.dft_size
+        if count: # every complete window of every channel in one FFT batch
+            frames = buffer[:, :count * self.dft_size].reshape(buffer.shape[0], count, self.dft_size) * self.window
+            self.power += (np.abs(np.fft.rfft(frames, axis=-1)) ** 2).sum(axis=(0, 1))
+            self.frames += frames.shape[0] * count
+        self.buffer = buffer[:, count * self.dft_size:]
+
+    def finish(self):
+        # {'cutoff_hz', 'energy_16k' ... (dB relative to the total energy, None above Nyquist), 'clipping' (ratio), 'suspect'}
+        if self.buffer.shape[1] >= self.dft_size // 4: # the end of the file, zero padded to a last window
+            frames = np.pad(self.buffer, ((0, 0), (0, self.dft_size - self.buffer.shape[1]))) * self.window
+            self.power += (np.abs(np.fft.rfft(frames, axis=-1)) ** 2).sum(axis=0)
+            self.frames += frames.shape[0]
+            self.buffer = self.buffer[:, :0]
+        nyquist = self.sample_rate / 2
+        frequencies = np.fft.rfftfreq(self.dft_size, 1 / self.sample_rate)
+        total = self.power.sum()
+        metrics = {'cutoff_hz': 0.0}
+        if total > 0:
+            # a lowpass is a cliff: the level drops by CUTOFF_DROP_DB and never comes back up, a natural roll off is gradual
+            level = 10 * np.log10(np.maximum(self.power / self.frames, 1e-30))
+            level = np.convolve(np.pad(level, 4, mode='edge'), np.ones(9) / 9, 'valid') # smoothed over 9 bins
+            span = int(np.ceil(CUTOFF_SPAN_HZ * self.dft_size / self.sample_rate))
+            loudest_above = np.maximum.accumulate(level[::-1])[::-1][span:] # loudest level from each bin up to Nyquist
+            cliffs = np.flatnonzero(level[:-span] - loudest_above >= CUTOFF_DROP_DB)
+            cutoff = nyquist
+            if cliffs.size: # the last cliff starts up to span below its edge: the edge is where it is half way down
+                top = cliffs[-1]
+                edge = top + int(np.argmax(level[top:top + span + 1] <= level[top] - CUTOFF_DROP_DB / 2))
+                cutoff = float(frequencies[edge])
+            metrics['cutoff_hz'] = round(cutoff, 1)
+        for band in ANALYSIS_BANDS:
+            energy = self.power[frequencies >= band].sum()
+            metrics[f"energy_{band // 1000}k"] = (round(float(10 * np.log10(max(energy / total, 1e-30))), 2) if total > 0 and band < nyquist
+                                                  else None)
+        metrics['clipping'] = round(self.clipped / self.samples, 6) if self.samples else 0.0
+        metrics['suspect'] = bool(total > 0 and metrics['cutoff_hz'] < SUSPECT_CUTOFF_RATIO * nyquist)
+        return metrics
+
+
+def render_tiles(job, token=None, tile_seconds=None, analysis=None):
+    # Streams the file once and returns one pixel array per tile of tile_seconds (a single tile when None).
+    # analysis (SpectralAnalysis) is fed the same samples
+    stream = stream_samples(job.path, token)
+    sample_rate, channels, length = next(stream)
+    if analysis is not None:
+        analysis.start(sample_rate, channels)
+    tile_length = int(tile_seconds * sample_rate) if tile_seconds else max(length, 1)
+    tile_count = max(1, -(-length // tile_length))
+    frames_per_column = PREVIEW_FRAMES_PER_COLUMN if job.preview else FRAMES_PER_COLUMN
+    tiles = [StreamingSpectrogram(channels, min(tile_length, length - index * tile_length), job.width, job.height, frames_per_column)
+             for index in range(tile_count)]
+
+    position = 0
+    for chunk in stream:
+        if analysis is not None:
+            analysis.feed(chunk)
+        # split the chunk on tile boundaries. Samples past the expected length (inexact ffmpeg duration) go to the last tile
+        while chunk.shape[1]:
+            index = min(position // tile_length, tile_count - 1)
+            take = chunk.shape[1] if index == tile_count - 1 else min(chunk.shape[1], (index + 1) * tile_length - position)
+            tiles[index].feed(chunk[:, :take])
+            chunk, position = chunk[:, take:], position + take
+    return [db_to_pixels(tile.finish()) for tile in tiles]
+
+
+def render_pixels(job, token=None):
+    return render_tiles(job, token)[0]
+
+
+def output_names(output, channels):
+    # File suffixes written for one RenderOutput of a stream with this many channels
+    if output.raw:
+        return [output.suffix + '.npy']
+    if output.channels == 'split':
+        return [f"{output.suffix}_ch{number}.png" for number in range(1, channels + 1)]
+    return [output.suffix + '.png']
+
+
+def render_outputs(job, token=None, timings=None, analysis=None):
+    # Decodes job.path once and renders every output of job.outputs (the job image by default) from the same samples:
+    # {file suffix: bytes}. SoX outputs read the samples as raw float PCM on their stdin (remixed for mono and split
+    # outputs), numpy outputs and raw dB matrices share one StreamingSpectrogram per size and mixdown.
+    # analysis (SpectralAnalysis) is fed the same samples
+    token = token or CancelToken()
+    job_outputs = job.outputs or (RenderOutput('', job.width, job.height),)
+    timings = timings if timings is not None else StageTimes()
+    stream = stream_samples(job.path, token, decoder=choose_decoder(job), sox_path=job.sox_path)
+    with timings.stage('decode'):
+        sample_rate, channels, length = next(stream)
+    if analysis is not None:
+        analysis.start(sample_rate, channels)
+    use_sox = choose_backend(job) == 'sox'
+    input_args = ['-t', 'raw', '-L', '-r', str(sample_rate), '-e', 'floating-point', '-b', '32', '-c', str(channels), '-']
+
+    outputs = {} # file suffix -> bytes, filled in the order of the outputs
+    processes = [] # (file suffix, SoX process)
+    spectrograms = {} # (width, height, mono) -> StreamingSpectrogram
+    try:
+        for output in job_outputs:
+            names = output_names(output, channels)
+            outputs.update(dict.fromkeys(names))
+            if use_sox and not output.raw:
+                output_job = job.copy(width=output.width, height=output.height, outputs=None, analyze=False)
+                if output.channels == 'split':
+                    remixes = [['remix', str(number)] for number in range(1, channels + 1)]
+                else:
+                    remixes = [['remix', '-'] if output.channels == 'mono' else []]
+                for name, remix in zip(names, remixes):
+                    with timings.stage('spawn'):
+                        process = token.popen(build_sox_command(output_job, input_args, remix), stdin=subprocess.PIPE,
+                                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                    processes.append((name, process))
+            else:
+                shape = (output.width, output.height, output.channels == 'mono')
+                if shape not in spectrograms:
+                    spectrograms[shape] = StreamingSpectrogram(1 if shape[2] else channels, length, output.width, output.height)
+
+        while True:
+            with timings.stage('decode'):
+                chunk = next(stream, None)
+            if chunk is None:
+                break
+            if processes:
+                data = chunk.T.astype('<f4').tobytes() # interleaved
+                with timings.stage('sox'):
+                    for _, process in processes:
+                        try:
+                            process.stdin.write(data)
+                        except BrokenPipeError: # SoX failed, its error is read below
+                            pass
+            if spectrograms:
+                with timings.stage('numpy'):
+                    mixdown = chunk.mean(axis=0, keepdims=True) if any(mono for _, _, mono in spectrograms) else None
+                    for (_, _, mono), spectrogram in spectrograms.items():
+                        spectrogram.feed(mixdown if mono else chunk)
+            if analysis is not None:
+                with timings.stage('analyze'):
+                    analysis.feed(chunk)
+
+        for _, process in processes:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+        for name, process in processes:
+            with timings.stage('sox'):
+                image, error = process.stdout.read(), process.stderr.read()
+                process.wait()
+            token.check()
+            if process.returncode != 0:
+                raise ValueError(error.decode(errors='replace').strip() or f"SoX could not render {name}")
+            outputs[name] = image
+    finally:
+        stream.close()
+        for _, process in processes:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            token.release(process)
+
+    if not spectrograms:
+        return outputs
+    with timings.stage('numpy'):
+        db = {shape: spectrogram.finish() for shape, spectrogram in spectrograms.items()}
+    with timings.stage('encode'):
+        for output in job_outputs:
+            if use_sox and not output.raw:
+                continue
+            matrix = db[(output.width, output.height, output.channels == 'mono')]
+            names = output_names(output, channels)
+            if output.raw:
+                buffer = io.BytesIO()
+                np.save(buffer, matrix.astype(np.float32))
+                outputs[names[0]] = buffer.getvalue()
+            elif output.channels == 'split':
+                for number, name in enumerate(names):
+                    outputs[name] = encode_png(db_to_pixels(matrix[number:number + 1]))
+            else:
+                outputs[names[0]] = encode_png(db_to_pixels(matrix))
+    return outputs
+
+
+def encode_png(pixels, level=6):
+    # Minimal RGB PNG writer, so saving and caching work without cv2
+    height, width, _ = pixels.shape
+    rows = np.zeros((height, width * 3 + 1), np.uint8) # filter byte 0 at the start of each row
+    rows[:, 1:] = pixels.reshape(height, -1)
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows.tobytes(), level)) + chunk(b'IEND', b''))
+
+
+def decode_png(data):
+    # Minimal 8 bit PNG reader (grey, RGB, palette, RGBA; not interlaced), used to compare with SoX output
+    position, chunks, palette = 8, [], None
+    while position < len(data):
+        length, tag = struct.unpack('>I4s', data[position:position + 8])
+        body = data[position + 8:position + 8 + length]
+        if tag == b'IHDR':
+            width, height, depth, colour = struct.unpack('>IIBB', body[:10])
+        elif tag == b'PLTE':
+            palette = np.frombuffer(body, np.uint8).reshape(-1, 3)
+        elif tag == b'IDAT':
+            chunks.append(body)
+        position += length + 12
+    if depth != 8:
+        raise ValueError("Only 8 bit PNG are supported")
+    bpp = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}[colour]
+    raw = np.frombuffer(zlib.decompress(b''.join(chunks)), np.uint8).reshape(height, width * bpp + 1)
+
+    image = np.zeros((height, width * bpp), np.int32)
+    previous = np.zeros(width * bpp, np.int32)
+    for y in range(height):
+        kind, line = raw[y, 0], raw[y, 1:].astype(np.int32)
+        if kind == 2:
+            line = (line + previous) & 255
+        elif kind in (1, 3, 4):
+            line = line.copy()
+            for x in range(width * bpp):
+                left = line[x - bpp] if x >= bpp else 0
+                up_left = previous[x - bpp] if x >= bpp else 0
+                if kind == 1:
+                    predictor = left
+                elif kind == 3:
+                    predictor = (left + previous[x]) >> 1
+                else:
+                    p = left + previous[x] - up_left
+                    pa, pb, pc = abs(p - left), abs(p - previous[x]), abs(p - up_left)
+                    predictor = left if pa <= pb and pa <= pc else previous[x] if pb <= pc else up_left
+                line[x] = (line[x] + predictor) & 255
+        image[y] = previous = line
+    image = image.astype(np.uint8).reshape(height, width, bpp)
+    if colour == 3:
+        return palette[image[:, :, 0]]
+    if colour in (0, 4):
+        return np.repeat(image[:, :, :1], 3, axis=2)
+    return image[:, :, :3]
+
+
+def benchmark(file_paths, width=800, height=257):
+    # Times both backends and compares the numpy image with SoX's raw spectrogram (-r: no axes nor legend)
+    for file_path in file_paths:
+        job = RenderJob(file_path, width=width, height=height)
+
+        start = time.perf_counter()
+        command = build_sox_command(job, [file_path])
+        command.remove('-t') # no title
+        command.remove(job.name)
+        sox_png = subprocess.run(command + ['-r'], capture_output=True, check=True).stdout
+        sox_seconds = time.perf_counter() - start
+        sox_pixels = decode_png(sox_png)
+
+        start = time.perf_counter()
+        numpy_pixels = render_pixels(job)
+        numpy_seconds = time.perf_counter() - start
+
+        if sox_pixels.shape == numpy_pixels.shape:
+            luma = np.array([.299, .587, .114])
+            difference = np.abs(sox_pixels @ luma - numpy_pixels @ luma).mean() / 255
+            parity = f"mean luma difference {difference:.1%}"
+        else:
+            parity = f"size mismatch, sox {sox_pixels.shape} numpy {numpy_pixels.shape}"
+        print(f"{op.basename(file_path)}: sox {sox_seconds:.3f} s, numpy {numpy_seconds:.3f} s, {parity}")
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1:])
@@ -0,0 +1,869 @@
+import queue, threading, time
+import os.path as op
+from bisect import bisect, bisect_left
+from collections import OrderedDict
+
+from PyQt5.QtCore import Qt, QCoreApplication, QThread, QObject, QFileInfo, QRectF, QRunnable, QThreadPool, QAbstractListModel, QSortFilterProxyModel, QModelIndex, QSize, QFileSystemWatcher, QTimer, pyqtSignal
+from PyQt5.QtGui import QImage, QPixmap, QColor, QPainter, QTransform
+from PyQt5.QtWidgets import QListView, QAbstractItemView, QFileIconProvider, QMainWindow, QGraphicsView, QGraphicsScene, QWidget, QHBoxLayout, QLabel, QComboBox, QCheckBox
+
+from SoXspectroFarm import Spool, FarmCoordinator, status_text, FARM_POLL_SECONDS
+from SoXspectroCore import RenderJob, RenderResult, RenderScheduler, FileIndex, export_images, walk_audio_files, render_file, audio_duration, choose_backend, EXPORT_WORKERS, AUDIO_FORMATS, PRIORITY_CLICKED, PRIORITY_VISIBLE, PRIORITY_NORMAL
+
+# Qt helpers shared by SoXspectroGUI and SoXspectroD&D
+
+THUMBNAIL_W = 320 # size of the spectrograms shown in the gallery, click one to open it at full size
+THUMBNAIL_H = 240
+THUMBNAIL_CACHE_MB = 64 # memory for the decoded thumbnails (4 bytes per pixel), the others are decoded again when scrolled to
+THUMBNAIL_CACHE_SIZE = THUMBNAIL_CACHE_MB * 2**20 // (THUMBNAIL_W * THUMBNAIL_H * 4)
+THUMBNAIL_THREADS = 2
+
+VISIBLE_DELAY_MS = 150 # the rows on screen are reported once scrolling pauses
+
+VIEWER_W = 1280 # largest initial size of the viewer window
+VIEWER_H = 900
+VIEWER_TILE = 512 # pyramid tiles, only the ones on screen are painted
+VIEWER_MAX_ZOOM = 16
+VIEWER_ZOOM_STEP = 1.25 # per wheel notch
+VIEWER_MAX_RENDER_W = 8000 # size limits of a re-rendered time range
+VIEWER_MAX_RENDER_H = 1025
+SOX_PLOT_LEFT = 58 # x of the first spectrogram column in SoX images, right of the axis labels
+
+SCAN_BATCH_SECONDS = 0.2 # files found in dropped folders are added to the list at this interval
+
+WATCH_DELAY_MS = 2000 # wait for the folder to settle (files being copied) before rendering changes
+
+
+def result_qimage(render_result):
+    # numpy backend results are shown from their pixel array, SoX results are decoded from the PNG
+    if render_result.pixels is not None:
+        height, width, _ = render_result.pixels.shape
+        return QImage(render_result.pixels.data, width, height, width * 3, QImage.Format_RGB888).copy()
+    return QImage.fromData(render_result.image)
+
+
+class BackgroundRenderer(QObject):
+    # RenderScheduler of a window. Jobs can be queued, reprioritized and cancelled at any time,
+    # results come back on the UI thread through signals. Cancelled jobs are not reported
+    result_ready = pyqtSignal(object) # RenderResult
+    progress = pyqtSignal(int, int) # done, total since the renderer was last idle
+    idle = pyqtSignal() # every queued job is done or cancelled
+    delivered = pyqtSignal(object) # emitted by the worker threads, queued to the UI thread
+
+    def __init__(self, max_workers=None, cache=None, parent=None):
+        super().__init__(parent)
+        self.done = self.total = 0
+        self.delivered.connect(self.deliver, Qt.QueuedConnection)
+        self.scheduler = RenderScheduler(self.delivered.emit, max_workers, cache)
+        if QCoreApplication.instance() is not None: # kill the running SoX processes when the app quits
+            QCoreApplication.instance().aboutToQuit.connect(self.close)
+
+    @property
+    def busy(self):
+        return self.done < self.total
+
+    def set_stats(self, stats, profiler=None):
+        self.scheduler.stats = stats
+        self.scheduler.profiler = profiler
+
+    def set_journal(self, journal):
+        # SoXspectroJournal.BatchJournal of the batch, or None. Jobs already running keep the journal they started with
+        self.scheduler.journal = journal
+
+    def submit(self, jobs):
+        accepted = self.scheduler.submit(jobs)
+        self.total += len(accepted)
+        if accepted:
+            self.progress.emit(self.done, self.total)
+        return accepted
+
+    def cancel(self, predicate=None):
+        # predicate(job) selects the jobs to cancel, all of them by default
+        self.scheduler.cancel(predicate)
+
+    def deliver(self, result):
+        if result.cancelled:
+            self.total -= 1
+        else:
+            self.done += 1
+            self.result_ready.emit(result)
+        self.progress.emit(self.done, self.total)
+        if self.done >= self.total:
+            self.done = self.total = 0
+            self.idle.emit()
+
+    def prioritize_visible(self, keys):
+        # Full resolution jobs of the rows on screen (gallery keys) go first, the ones scrolled away go back in line
+        def priority(job):
+            if job.preview or job.priority == PRIORITY_CLICKED:
+                return None
+            return PRIORITY_VISIBLE if job.index in keys else PRIORITY_NORMAL
+        self.scheduler.prioritize(priority)
+
+    def prioritize_clicked(self, key):
+        # The full resolution job of a clicked file goes before everything else, previews included
+        self.scheduler.prioritize(lambda job: PRIORITY_CLICKED if job.index == key and not job.preview else None)
+
+    def close(self):
+        self.scheduler.close()
+
+
+class FarmRenderer(QObject):
+    # Stands in for BackgroundRenderer when a window renders on a farm (SoXspectroFarm.py workers): jobs are written to the
+    # spool and results read back by a thread of their own, so a slow share never blocks the window.
+    # Previews are not submitted, the farm only renders full resolution images. Priorities are left to the workers
+    result_ready = pyqtSignal(object) # RenderResult
+    progress = pyqtSignal(int, int) # done, total since the renderer was last idle
+    idle = pyqtSignal()
+    farm_status = pyqtSignal(str) # workers and jobs of the whole farm, see SoXspectroFarm.status_text
+    delivered = pyqtSignal(object)
+
+    def __init__(self, spool_path, parent=None):
+        super().__init__(parent)
+        self.done = self.total = 0
+        self.stats = None
+        self.journal = None
+        self.commands = queue.SimpleQueue() # (method of the coordinator, argument), None to stop
+        self.delivered.connect(self.deliver, Qt.QueuedConnection)
+        self.coordinator = FarmCoordinator(Spool(spool_path))
+        self.thread = threading.Thread(target=self.run, name="farm-coordinator", daemon=True)
+        self.thread.start()
+        if QCoreApplication.instance() is not None: # withdraw the queued jobs when the app quits
+            QCoreApplication.instance().aboutToQuit.connect(self.close)
+
+    @property
+    def busy(self):
+        return self.done < self.total
+
+    def set_stats(self, stats, profiler=None):
+        self.stats = stats # the profiler runs on the workers
+
+    def set_journal(self, journal):
+        self.journal = journal
+
+    def submit(self, jobs):
+        accepted = [job for job in jobs if not job.preview]
+        if accepted:
+            if self.journal is not None:
+                self.journal.record_queued([job.path for job in accepted])
+            self.commands.put((self.coordinator.submit, accepted))
+            self.total += len(accepted)
+            self.progress.emit(self.done, self.total)
+        return accepted
+
+    def cancel(self, predicate=None):
+        self.commands.put((self.coordinator.cancel, predicate))
+
+    def run(self):
+        last_status = 0.0
+        while True:
+            try:
+                command = self.commands.get(timeout=FARM_POLL_SECONDS)
+            except queue.Empty:
+                command = None
+            try:
+                if command is not None:
+                    function, argument = command
+                    if function is None:
+                        self.coordinator.cancel()
+                        return
+                    for job in function(argument) or ():
+                        self.delivered.emit(RenderResult(job, error="Cancelled", cancelled=True))
+                for result in self.coordinator.poll():
+                    self.delivered.emit(result)
+                if self.coordinator.jobs and time.monotonic() - last_status >= FARM_POLL_SECONDS:
+                    self.farm_status.emit(status_text(self.coordinator.status()))
+                    last_status = time.monotonic()
+            except OSError as e:
+                print(f"Farm spool unreachable: {type(e).__name__}: {e}")
+
+    def deliver(self, result):
+        if result.cancelled:
+            self.total -= 1
+        else:
+            self.done += 1
+            if self.stats is not None:
+                self.stats.add_result(result)
+            if self.journal is not None and not result.ok:
+                self.journal.record(result.job.path, 'failed', result.error.strip())
+            self.result_ready.emit(result)
+        self.progress.emit(self.done, self.total)
+        if self.done >= self.total:
+            self.done = self.total = 0
+            self.idle.emit()
+
+    def prioritize_visible(self, keys):
+        pass
+
+    def prioritize_clicked(self, key):
+        pass
+
+    def close(self):
+        self.commands.put((None, None))
+        self.thread.join(10)
+
+
+class ExportThread(QThread):
+    # Writes images on a pool of I/O threads and reports each file through signals.
+    # With archive_format, items are (image, path, RenderJob, analysis) packed into the SQLite archive of each folder
+    result_ready = pyqtSignal(object) # ExportResult
+    progress = pyqtSignal(int, int) # done, total
+
+    def __init__(self, items, max_workers=EXPORT_WORKERS, parent=None, stats=None, archive_format=None):
+        super().__init__(parent)
+        self.items = list(items)
+        self.max_workers = max_workers
+        self.stats = stats
+        self.archive_format = archive_format
+
+    def run(self):
+        total = len(self.items)
+        self.progress.emit(0, total)
+        if self.archive_format:
+            from SoXspectroArchive import export_archive
+            results = export_archive(self.items, self.archive_format)
+        else:
+            results = export_images(self.items, self.max_workers)
+        for done, result in enumerate(results, 1):
+            if self.stats is not None:
+                self.stats.add_export(result)
+            self.result_ready.emit(result)
+            self.progress.emit(done, total)
+
+
+class GalleryEntry:
+    # One gallery row. Only the compressed PNG (or the path of a PNG on disk or in an archive) is kept, thumbnails are decoded on demand
+    def __init__(self, key, name, image=None, image_path=None, folder="", preview=False, job=None, outputs=None, analysis=None, archive=None,
+                 suffix=".png"):
+        self.key = key # batch index, rows are sorted on it
+        self.name = name
+        self.image = image
+        self.image_path = image_path
+        self.folder = folder
+        self.preview = preview # low resolution image of a progressive render, not saved
+        self.job = job # RenderJob of the image, the viewer renders parts of the file again from it
+        self.outputs = outputs # {file suffix: bytes} of a render profile, all saved next to the image
+        self.analysis = analysis # lossy transcode metrics, shown next to the image and used to sort and filter the gallery
+        self.archive = archive # SoXspectroArchive.SpectrogramArchive holding image_path, read on demand
+        self.suffix = suffix # file suffix of the image bytes, '.webp' or '.jpg' when read from such an archive
+
+    def image_bytes(self):
+        if self.image is not None:
+            return self.image
+        if self.archive is not None:
+            return self.archive.read(self.image_path)
+        with open(self.image_path, "rb") as file:
+            return file.read()
+
+
+def archived_entries(jobs, archive_folder):
+    # GalleryEntry of each job whose image, rendered from the current file with the same parameters, is in the
+    # archive of archive_folder(job). Images are read from the archive when shown, nothing is rendered
+    from SoXspectroArchive import open_archive, FORMAT_EXTENSIONS
+
+    archives = {} # folder -> (SpectrogramArchive or None, records)
+    entries = []
+    for job in jobs:
+        folder = archive_folder(job)
+        if folder not in archives:
+            archive = open_archive(folder)
+            archives[folder] = (archive, archive.records() if archive is not None else {})
+        archive, records = archives[folder]
+        record = archive.find(job, records) if archive is not None else None
+        if record is not None:
+            entries.append(GalleryEntry(job.index, job.name, image_path=record['name'], folder=op.dirname(job.path), job=job,
+                                        analysis=record['analysis'], archive=archive, suffix=FORMAT_EXTENSIONS[record['format']]))
+    return entries
+
+
+def analysis_text(analysis):
+    # One line summary of SpectralAnalysis metrics for the gallery
+    if not analysis:
+        return None
+    parts = [f"cutoff {analysis['cutoff_hz'] / 1000:.1f} kHz"]
+    for name, value in analysis.items():
+        if name.startswith('energy_') and value is not None:
+            parts.append(f">{name[7:]} {value:.0f} dB")
+    parts.append(f"clipping {analysis['clipping']:.2%}")
+    if analysis['suspect']:
+        parts.append("SUSPECT (lossy source?)")
+    return " | ".join(parts)
+
+
+class ThumbnailSignals(QObject):
+    decoded = pyqtSignal(int, object, QImage) # generation, entry, thumbnail
+
+
+class ThumbnailTask(QRunnable):
+    # Decodes and downscales one PNG on the thumbnail thread pool (QImage is safe outside the UI thread, QPixmap is not)
+    def __init__(self, generation, entry, size, signals):
+        super().__init__()
+        self.generation = generation
+        self.entry = entry
+        self.size = size
+        self.signals = signals
+
+    def run(self):
+        try:
+            image = QImage.fromData(self.entry.image_bytes())
+        except OSError:
+            image = QImage()
+        if not image.isNull():
+            image = image.scaled(self.size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        self.signals.decoded.emit(self.generation, self.entry, image)
+
+
+class SpectrogramModel(QAbstractListModel):
+    # List model of rendered spectrograms. The view only asks for visible rows, so only those get decoded
+    def __init__(self, thumbnail_size=QSize(THUMBNAIL_W, THUMBNAIL_H), cache_size=THUMBNAIL_CACHE_SIZE, parent=None):
+        super().__init__(parent)
+        self.thumbnail_size = thumbnail_size
+        self.cache_size = cache_size
+        self.entries = []
+        self.keys = [] # sorted keys of entries, for bisect
+        self.pixmaps = OrderedDict() # key -> thumbnail, least recently used first
+        self.pending = set()
+        self.generation = 0 # bumped on clear so thumbnails of a previous batch are dropped
+
+        self.placeholder = QPixmap(thumbnail_size)
+        self.placeholder.fill(QColor(32, 32, 32))
+
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(THUMBNAIL_THREADS)
+        self.signals = ThumbnailSignals(self)
+        self.signals.decoded.connect(self.thumbnail_decoded)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.entries)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        entry = self.entries[index.row()]
+        if role == Qt.DecorationRole:
+            return self.thumbnail(entry)
+        if role == Qt.DisplayRole:
+            return analysis_text(entry.analysis)
+        if role == Qt.ToolTipRole:
+            return entry.name
+        if role == Qt.UserRole:
+            return entry
+        return None
+
+    def find_row(self, key):
+        row = bisect_left(self.keys, key)
+        if row < len(self.keys) and self.keys[row] == key:
+            return row
+        return None
+
+    def add_entry(self, entry, image=None):
+        # Inserts the entry at the position of its key (or replaces the entry with that key) and returns its row.
+        # image (QImage) seeds the thumbnail
+        row = self.find_row(entry.key)
+        self.pixmaps.pop(entry.key, None)
+        self.pending.discard(entry.key)
+        if row is not None:
+            self.entries[row] = entry
+            index = self.index(row)
+            self.dataChanged.emit(index, index)
+        else:
+            row = bisect(self.keys, entry.key)
+            self.beginInsertRows(QModelIndex(), row, row)
+            self.keys.insert(row, entry.key)
+            self.entries.insert(row, entry)
+            self.endInsertRows()
+        if image is not None and not image.isNull():
+            self.store_thumbnail(entry.key, image.scaled(self.thumbnail_size, Qt.KeepAspectRatio, Qt.SmoothTransformation))
+        return row
+
+    def remove_entry(self, key):
+        # Removes the entry with that key and returns its former row, None if there was none
+        row = self.find_row(key)
+        if row is not None:
+            self.beginRemoveRows(QModelIndex(), row, row)
+            del self.keys[row]
+            del self.entries[row]
+            self.pixmaps.pop(key, None)
+            self.endRemoveRows()
+        return row
+
+    def clear(self):
+        self.beginResetModel()
+        self.generation += 1
+        self.entries.clear()
+        self.keys.clear()
+        self.pixmaps.clear()
+        self.pending.clear()
+        self.endResetModel()
+
+    def thumbnail(self, entry):
+        pixmap = self.pixmaps.get(entry.key)
+        if pixmap is not None:
+            self.pixmaps.move_to_end(entry.key)
+            return pixmap
+        if entry.key not in self.pending:
+            self.pending.add(entry.key)
+            self.pool.start(ThumbnailTask(self.generation, entry, self.thumbnail_size, self.signals))
+        return self.placeholder
+
+    def store_thumbnail(self, key, image):
+        self.pixmaps[key] = QPixmap.fromImage(image)
+        while len(self.pixmaps) > self.cache_size:
+            self.pixmaps.popitem(last=False)
+
+    def thumbnail_decoded(self, generation, entry, image):
+        if generation != self.generation:
+            return
+        row = self.find_row(entry.key)
+        if row is not None and self.entries[row] is entry: # not removed nor replaced meanwhile
+            self.pending.discard(entry.key)
+            self.store_thumbnail(entry.key, image)
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+
+class SpectrogramView(QListView):
+    # Gallery view: one spectrogram per row, all rows the same size so layout does not depend on the number of rows
+    visible_changed = pyqtSignal() # the rows on screen changed (scroll, resize, rows added)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setViewMode(QListView.ListMode)
+        self.setUniformItemSizes(True)
+        self.setIconSize(QSize(THUMBNAIL_W, THUMBNAIL_H))
+        self.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.setCursor(Qt.PointingHandCursor)
+
+        self.visible_timer = QTimer(self)
+        self.visible_timer.setSingleShot(True)
+        self.visible_timer.setInterval(VISIBLE_DELAY_MS)
+        self.visible_timer.timeout.connect(self.visible_changed)
+        self.verticalScrollBar().valueChanged.connect(self.visible_timer.start)
+
+    def setModel(self, model):
+        super().setModel(model)
+        model.rowsInserted.connect(self.visible_timer.start)
+        model.modelReset.connect(self.visible_timer.start)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.visible_timer.start()
+
+    def visible_entries(self):
+        # GalleryEntry of each row at least partly on screen
+        model = self.model()
+        if model is None or model.rowCount() == 0:
+            return []
+        top = self.indexAt(self.viewport().rect().topLeft())
+        if not top.isValid():
+            return []
+        bottom = self.indexAt(self.viewport().rect().bottomLeft())
+        last = bottom.row() if bottom.isValid() else model.rowCount() - 1
+        return [model.index(row, 0).data(Qt.UserRole) for row in range(top.row(), last + 1)] # also through a GalleryFilterModel
+
+
+# Gallery orders: label -> (metric, descending). Entries without the metric go last
+GALLERY_SORTS = {
+    "Batch order": (None, False),
+    "Lowest cutoff first": ('cutoff_hz', False),
+    "Least energy above 16 kHz first": ('energy_16k', False),
+    "Least energy above 19 kHz first": ('energy_19k', False),
+    "Most clipping first": ('clipping', True),
+}
+
+
+class GalleryFilterModel(QSortFilterProxyModel):
+    # Sorts the gallery on a lossy transcode metric and optionally hides the files not flagged as suspect.
+    # The SpectrogramModel underneath keeps the batch order, rows added later are sorted in place
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.metric, self.descending = None, False
+        self.suspect_only = False
+        self.setDynamicSortFilter(True)
+        self.sort(0)
+
+    def set_sort(self, label):
+        self.metric, self.descending = GALLERY_SORTS[label]
+        self.invalidate()
+
+    def set_suspect_only(self, suspect_only):
+        self.suspect_only = suspect_only
+        self.invalidateFilter()
+
+    def sort_value(self, entry):
+        value = entry.analysis.get(self.metric) if self.metric and entry.analysis else None
+        if value is None:
+            return (1, 0, entry.key)
+        return (0, -value if self.descending else value, entry.key)
+
+    def lessThan(self, left, right):
+        return self.sort_value(left.data(Qt.UserRole)) < self.sort_value(right.data(Qt.UserRole))
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        if not self.suspect_only:
+            return True
+        analysis = self.sourceModel().entries[source_row].analysis
+        return bool(analysis and analysis['suspect'])
+
+
+class GalleryFilterBar(QWidget):
+    # Sort order and "suspects only" controls of a GalleryFilterModel, with the number of suspect files
+    def __init__(self, filter_model, parent=None):
+        super().__init__(parent)
+        self.filter_model = filter_model
+
+        self.sort_box = QComboBox(self)
+        self.sort_box.addItems(list(GALLERY_SORTS))
+        self.sort_box.currentTextChanged.connect(filter_model.set_sort)
+        self.suspect_checkbox = QCheckBox("Suspects only", self)
+        self.suspect_checkbox.toggled.connect(filter_model.set_suspect_only)
+        self.count_label = QLabel(self)
+
+        layout = QHBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(QLabel("Sort:", self))
+        layout.addWidget(self.sort_box)
+        layout.addWidget(self.suspect_checkbox)
+        layout.addStretch()
+        layout.addWidget(self.count_label)
+
+        # counted at most once per VISIBLE_DELAY_MS, results arrive one row at a time
+        self.count_timer = QTimer(self)
+        self.count_timer.setSingleShot(True)
+        self.count_timer.setInterval(VISIBLE_DELAY_MS)
+        self.count_timer.timeout.connect(self.update_count)
+        source = filter_model.sourceModel()
+        for signal in (source.rowsInserted, source.rowsRemoved, source.modelReset, source.dataChanged):
+            signal.connect(self.count_timer.start)
+
+    def update_count(self):
+        entries = self.filter_model.sourceModel().entries
+        analyzed = sum(entry.analysis is not None for entry in entries)
+        suspects = sum(bool(entry.analysis and entry.analysis['suspect']) for entry in entries)
+        self.count_label.setText(f"{suspects} suspect / {analyzed} analyzed" if analyzed else "")
+
+
+class FileQueueModel(QAbstractListModel):
+    # Audio files queued in SoXspectroD&D, in drop order. A hashed index of the paths makes each addition O(1)
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.paths = []
+        self.rows = {} # path -> row
+        self.icon_provider = QFileIconProvider()
+        self.icons = {} # extension -> icon, asking the provider for each file is slow
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.paths)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        file_path = self.paths[index.row()]
+        if role == Qt.DisplayRole:
+            return file_path
+        if role == Qt.DecorationRole:
+            return self.icon(file_path)
+        return None
+
+    def icon(self, file_path):
+        extension = op.splitext(file_path)[1].lower()
+        icon = self.icons.get(extension)
+        if icon is None:
+            icon = self.icons[extension] = self.icon_provider.icon(QFileInfo(file_path))
+        return icon
+
+    def add_paths(self, file_paths):
+        # Appends the paths not queued yet and returns them
+        new_paths = list(dict.fromkeys(file_path for file_path in file_paths if file_path not in self.rows))
+        if new_paths:
+            first = len(self.paths)
+            self.beginInsertRows(QModelIndex(), first, first + len(new_paths) - 1)
+            for row, file_path in enumerate(new_paths, first):
+                self.rows[file_path] = row
+            self.paths.extend(new_paths)
+            self.endInsertRows()
+        return new_paths
+
+    def clear(self):
+        self.beginResetModel()
+        self.paths.clear()
+        self.rows.clear()
+        self.endResetModel()
+
+
+class FolderScanner(QThread):
+    # Lists the audio files of dropped folders recursively. They are reported in batches so the list fills in during the scan
+    files_found = pyqtSignal(list)
+
+    def __init__(self, roots, extensions=AUDIO_FORMATS, skip_dir=None, parent=None):
+        super().__init__(parent)
+        self.roots = list(roots)
+        self.extensions = extensions
+        self.skip_dir = skip_dir
+        self.cancelled = False
+
+    def run(self):
+        batch = []
+        last = time.perf_counter()
+        for root in self.roots:
+            for file_path in walk_audio_files(root, self.extensions, self.skip_dir):
+                if self.cancelled:
+                    return
+                batch.append(file_path)
+                if time.perf_counter() - last > SCAN_BATCH_SECONDS:
+                    self.files_found.emit(batch)
+                    batch = []
+                    last = time.perf_counter()
+        if batch:
+            self.files_found.emit(batch)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class ChangeWatcher(QObject):
+    # Watches folders and reports which audio files were added, changed or removed since the last reset.
+    # list_files returns the audio files to consider, list_watched the folders to watch
+    changes = pyqtSignal(list, list, list) # added, changed, removed
+
+    def __init__(self, list_files, list_watched, delay_ms=WATCH_DELAY_MS, parent=None):
+        super().__init__(parent)
+        self.list_files = list_files
+        self.list_watched = list_watched
+        self.index = FileIndex()
+        self.active = False
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay_ms)
+        self.timer.timeout.connect(self.rescan)
+
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(self.timer.start)
+        self.watcher.fileChanged.connect(self.timer.start)
+
+    def start(self):
+        # The current files are taken as already rendered
+        self.active = True
+        self.index.update(self.list_files())
+        self.rewatch()
+
+    def stop(self):
+        self.active = False
+        self.timer.stop()
+        watched = self.watcher.files() + self.watcher.directories()
+        if watched:
+            self.watcher.removePaths(watched)
+
+    def rewatch(self):
+        # Only the differences are applied: folders deleted and created again were dropped by QFileSystemWatcher
+        wanted = {path for path in self.list_watched() if path}
+        watched = set(self.watcher.directories())
+        if watched - wanted:
+            self.watcher.removePaths(sorted(watched - wanted))
+        self.watch(wanted - watched)
+
+    def watch(self, folders):
+        folders = sorted(set(folders) - set(self.watcher.directories()))
+        if folders:
+            self.watcher.addPaths(folders)
+
+    def rescan(self):
+        # Checks every file, after a change on disk
+        if not self.active:
+            return
+        added, changed, removed = self.index.update(self.list_files())
+        self.rewatch()
+        if added or changed or removed:
+            self.changes.emit(added, changed, removed)
+
+    def add_files(self, file_paths):
+        # Files just added to the list: only those are checked, and their folders watched
+        if not self.active:
+            return
+        added, changed = self.index.add(file_paths)
+        self.watch(op.dirname(file_path) for file_path in file_paths)
+        if added or changed:
+            self.changes.emit(added, changed, [])
+
+
+class ImagePyramid:
+    # An image and copies halved in size down to a single tile. Each level is cut in tiles converted to pixmaps when first shown
+    def __init__(self, image, tile_size=VIEWER_TILE):
+        self.tile_size = tile_size
+        self.levels = [image]
+        while max(image.width(), image.height()) > tile_size:
+            image = image.scaled(max(image.width() // 2, 1), max(image.height() // 2, 1), Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+            self.levels.append(image)
+
+    def level_for(self, zoom):
+        # Smallest level still showing at least one image pixel per screen pixel
+        level = 0
+        while level + 1 < len(self.levels) and self.levels[level + 1].width() >= self.levels[0].width() * zoom:
+            level += 1
+        return level
+
+    def tiles(self, level):
+        # (x, y, pixmap) of the tiles of a level, in the coordinates of that level
+        image = self.levels[level]
+        size = self.tile_size
+        return [(x, y, QPixmap.fromImage(image.copy(x, y, min(size, image.width() - x), min(size, image.height() - y))))
+                for y in range(0, image.height(), size) for x in range(0, image.width(), size)]
+
+
+class ZoomView(QGraphicsView):
+    # Shows an ImagePyramid: wheel to zoom around the cursor, drag to pan. Only the level matching the zoom is shown
+    zoomed = pyqtSignal(float)
+
+    def __init__(self, pyramid, parent=None):
+        super().__init__(parent)
+        self.pyramid = pyramid
+        self.setScene(QGraphicsScene(self))
+        self.scene().setSceneRect(QRectF(pyramid.levels[0].rect()))
+        self.setDragMode(QGraphicsView.ScrollHandDrag)
+        self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
+        self.setRenderHint(QPainter.SmoothPixmapTransform)
+        self.setBackgroundBrush(QColor(32, 32, 32))
+        self.items = {} # level -> tile items, created when the level is first shown
+        self.level = None
+        self.fitted = True
+        self.show_level(0)
+
+    def zoom(self):
+        return self.transform().m11()
+
+    def fit_zoom(self):
+        rect = self.sceneRect()
+        if rect.isEmpty(): # the image could not be decoded
+            return 1.0
+        return min(self.viewport().width() / rect.width(), self.viewport().height() / rect.height(), 1.0)
+
+    def fit(self):
+        self.setTransform(QTransform.fromScale(self.fit_zoom(), self.fit_zoom()))
+        self.centerOn(self.sceneRect().center())
+        self.fitted = True
+        self.zoom_changed()
+
+    def zoom_by(self, factor):
+        zoom = min(max(self.zoom() * factor, self.fit_zoom()), VIEWER_MAX_ZOOM)
+        self.scale(zoom / self.zoom(), zoom / self.zoom())
+        self.fitted = False
+        self.zoom_changed()
+
+    def zoom_changed(self):
+        level = self.pyramid.level_for(self.zoom() * self.devicePixelRatioF())
+        if level != self.level:
+            self.show_level(level)
+        self.zoomed.emit(self.zoom())
+
+    def show_level(self, level):
+        if self.level is not None:
+            for item in self.items[self.level]:
+                item.setVisible(False)
+        if level not in self.items:
+            scale = self.pyramid.levels[0].width() / self.pyramid.levels[level].width()
+            self.items[level] = []
+            for x, y, pixmap in self.pyramid.tiles(level):
+                item = self.scene().addPixmap(pixmap)
+                item.setTransformationMode(Qt.SmoothTransformation)
+                item.setOffset(x, y)
+                item.setScale(scale)
+                self.items[level].append(item)
+        for item in self.items[level]:
+            item.setVisible(True)
+        self.level = level
+
+    def visible_columns(self):
+        # (left, right) x of the image part on screen, in pixels of the full image
+        rect = self.mapToScene(self.viewport().rect()).boundingRect() & self.sceneRect()
+        return rect.left(), rect.right()
+
+    def wheelEvent(self, event):
+        self.zoom_by(VIEWER_ZOOM_STEP ** (event.angleDelta().y() / 120))
+
+    def mouseDoubleClickEvent(self, event):
+        self.fit()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        if self.fitted:
+            self.fit()
+
+
+class RangeRenderSignals(QObject):
+    done = pyqtSignal(object) # RenderResult
+
+
+class RangeRenderTask(QRunnable):
+    # Renders the part of job.path between the fractions first and last of the image time axis, on the global thread pool
+    def __init__(self, job, first, last, width, height, signals):
+        super().__init__()
+        self.job = job
+        self.first, self.last = first, last
+        self.width, self.height = width, height
+        self.signals = signals
+
+    def run(self):
+        try:
+            start, end = self.job.trim or (0.0, audio_duration(self.job))
+            trim = (start + self.first * (end - start), start + self.last * (end - start))
+            job = RenderJob(self.job.path, self.job.index, self.width, self.height, self.job.sox_path, self.job.decoder, 'sox', trim=trim)
+            result = render_file(job)
+        except Exception as e:
+            result = RenderResult(self.job, error=f"{type(e).__name__}: {e}")
+        try:
+            self.signals.done.emit(result)
+        except RuntimeError: # the app is quitting
+            pass
+
+
+class SpectrogramViewer(QMainWindow):
+    # Viewer window, opened without blocking the app. The image is decoded once into an ImagePyramid.
+    # With the RenderJob of a SoX image, the time range on screen can be rendered again at screen resolution (SoX trim),
+    # the result opens in another viewer
+    def __init__(self, title, image_data, job=None, parent=None):
+        super().__init__(parent)
+        self.setAttribute(Qt.WA_DeleteOnClose)
+        self.setWindowTitle(title)
+        self.job = job
+        self.pyramid = ImagePyramid(QImage.fromData(image_data))
+        self.view = ZoomView(self.pyramid, self)
+        self.view.zoomed.connect(self.show_zoom)
+        self.setCentralWidget(self.view)
+
+        toolbar = self.addToolBar("View")
+        toolbar.addAction("Fit (F)", self.view.fit).setShortcut("F")
+        toolbar.addAction("1:1", lambda: self.view.zoom_by(1 / self.view.zoom())).setShortcut("1")
+        self.render_action = toolbar.addAction("Render visible range (R)", self.render_range)
+        self.render_action.setShortcut("R")
+        self.render_action.setEnabled(job is not None and choose_backend(job) == 'sox')
+
+        self.signals = RangeRenderSignals() # no parent: a render finishing after the window is closed is dropped
+        self.signals.done.connect(self.range_rendered)
+        image = self.pyramid.levels[0]
+        self.resize(min(image.width() + 40, VIEWER_W), min(image.height() + 80, VIEWER_H))
+
+    def show_zoom(self, zoom):
+        self.statusBar().showMessage(f"{zoom * 100:.0f} %")
+
+    def render_range(self):
+        left, right = self.view.visible_columns()
+        first = min(max((left - SOX_PLOT_LEFT) / self.job.width, 0.0), 1.0)
+        last = min(max((right - SOX_PLOT_LEFT) / self.job.width, 0.0), 1.0)
+        if last <= first:
+            return
+        zoom = self.view.zoom() * self.devicePixelRatioF()
+        width = min(max(round((last - first) * self.job.width * zoom), 100), VIEWER_MAX_RENDER_W)
+        height = min(max(round(self.job.height * zoom), self.job.height), VIEWER_MAX_RENDER_H)
+        self.statusBar().showMessage(f"Rendering {first * 100:.1f} - {last * 100:.1f} % at {width} x {height}...")
+        QThreadPool.globalInstance().start(RangeRenderTask(self.job, first, last, width, height, self.signals))
+
+    def range_rendered(self, result):
+        if not result.ok:
+            self.statusBar().showMessage("Render failed: " + result.error.strip())
+            return
+        self.statusBar().clearMessage()
+        start, end = result.job.trim
+        viewer = SpectrogramViewer(f"{result.job.name} [{start:.3f} - {end:.3f} s]", result.image, result.job, self.parent())
+        viewer.show()
@@ -0,0 +1,179 @@
+import cProfile, io, json, os, pstats, sys, threading, time, tracemalloc
+from datetime import datetime, timezone
+
+# Instrumentation of the rendering pipeline: per stage timings, bytes, memory, JSON lines log and optional profiling
+
+STAGE_ORDER = ('queue', 'cache', 'read', 'decode', 'probe', 'spawn', 'sox', 'numpy', 'analyze', 'encode', 'save')
+
+
+def peak_rss_mb():
+    # Peak resident memory of this process and of its finished child processes (SoX, ffmpeg), in MB
+    if os.name == 'nt':
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + \
+                       [(name, ctypes.c_size_t) for name in ('PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage',
+                        'QuotaPagedPoolUsage', 'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage')]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        handle = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+            return {}
+        return {'self': counters.PeakWorkingSetSize / 1e6}
+
+    import resource
+    scale = 1 if sys.platform == 'darwin' else 1024 # ru_maxrss is in bytes on macOS, KB elsewhere
+    return {'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1e6,
+            'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 1e6}
+
+
+class PipelineStats:
+    # Thread safe aggregate of the renders and exports of a batch. Each event is also appended to log_path as a JSON line
+    def __init__(self, log_path=None):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.stages = {} # stage -> [count, total seconds, max seconds]
+        self.files = self.failed = self.cached = self.saved = 0
+        self.bytes_in = self.bytes_out = self.bytes_saved = 0
+        self.log_file = open(log_path, "a", encoding='utf-8') if log_path else None
+
+    def add_stage(self, stage, seconds):
+        entry = self.stages.setdefault(stage, [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+
+    def log(self, event):
+        if self.log_file is not None:
+            event['time'] = datetime.now(timezone.utc).isoformat()
+            self.log_file.write(json.dumps(event, ensure_ascii=False) + "\n")
+            self.log_file.flush()
+
+    def add_result(self, result):
+        bytes_out = len(result.image) if result.ok else 0
+        with self.lock:
+            self.files += 1
+            self.failed += not result.ok
+            self.cached += result.cached
+            self.bytes_in += result.bytes_in
+            self.bytes_out += bytes_out
+            for stage, seconds in result.timings.items():
+                self.add_stage(stage, seconds)
+            self.log({'event': 'render', 'path': result.job.path, 'ok': result.ok, 'cached': result.cached, 'decoder': result.decoder,
+                      'error': result.error, 'seconds': round(result.elapsed, 6), 'bytes_in': result.bytes_in,
+                      'bytes_out': bytes_out, 'stages': {stage: round(seconds, 6) for stage, seconds in result.timings.items()}})
+
+    def add_export(self, export_result):
+        with self.lock:
+            self.saved += export_result.error is None
+            self.bytes_saved += export_result.bytes_out
+            self.add_stage('save', export_result.elapsed)
+            self.log({'event': 'save', 'path': export_result.file_path, 'written': export_result.written,
+                      'error': export_result.error, 'seconds': round(export_result.elapsed, 6), 'bytes_out': export_result.bytes_out})
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.perf_counter() - self.started
+            return {
+                'files': self.files, 'failed': self.failed, 'cached': self.cached, 'saved': self.saved,
+                'seconds': elapsed, 'files_per_s': self.files / elapsed if elapsed else 0.0,
+                'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out, 'bytes_saved': self.bytes_saved,
+                'stages': {stage: {'count': count, 'total_s': total, 'mean_s': total / count, 'max_s': maximum}
+                           for stage, (count, total, maximum) in sorted(self.stages.items(), key=lambda item: stage_rank(item[0]))},
+                'peak_rss_mb': peak_rss_mb(),
+            }
+
+    def summary_line(self):
+        snapshot = self.snapshot()
+        stages = ", ".join(f"{stage} {entry['mean_s'] * 1000:.0f} ms" for stage, entry in snapshot['stages'].items())
+        memory = snapshot['peak_rss_mb'].get('self')
+        return (f"{snapshot['files']} files ({snapshot['cached']} cached, {snapshot['failed']} failed), "
+                f"{snapshot['files_per_s']:.1f} files/s | {stages} | {snapshot['bytes_in'] / 1e6:.0f} MB in, "
+                f"{snapshot['bytes_out'] / 1e6:.1f} MB out" + (f" | peak {memory:.0f} MB" if memory else ""))
+
+    def details(self):
+        # Multi line table of the stages, for a tooltip or the console
+        snapshot = self.snapshot()
+        lines = [f"{'stage':<8} {'count':>6} {'mean ms':>9} {'max ms':>9} {'total s':>9}"]
+        for stage, entry in snapshot['stages'].items():
+            lines.append(f"{stage:<8} {entry['count']:>6} {entry['mean_s'] * 1000:>9.1f} {entry['max_s'] * 1000:>9.1f} {entry['total_s']:>9.2f}")
+        return "\n".join(lines)
+
+    def close(self):
+        self.log({'event': 'batch', **self.snapshot()})
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+
+def stage_rank(stage):
+    return STAGE_ORDER.index(stage) if stage in STAGE_ORDER else len(STAGE_ORDER)
+
+
+class Profiler:
+    # Optional cProfile (merged over the profiled renders) and tracemalloc hooks
+    def __init__(self, profile=True, trace_memory=False):
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.lock = threading.Lock()
+        self.profiling = threading.Lock() # held by the one render being profiled
+        self.stats = None
+        self.calls = self.profiled = 0
+        if trace_memory:
+            tracemalloc.start()
+
+    def run(self, function, *args):
+        # Only one profiler can be active at a time (Python 3.12 refuses a second one), so the renders that start
+        # while another render is profiled run unprofiled
+        if not self.profile:
+            return function(*args)
+        with self.lock:
+            self.calls += 1
+        if not self.profiling.acquire(blocking=False):
+            return function(*args)
+        try:
+            profile = cProfile.Profile() # cProfile only sees the thread that enabled it
+            try:
+                profile.enable()
+            except ValueError: # another profiling tool is active (debugger, coverage)
+                profile = None
+            try:
+                return function(*args)
+            finally:
+                if profile is not None:
+                    profile.disable()
+                    self.add(profile)
+        finally:
+            self.profiling.release()
+
+    def add(self, profile):
+        with self.lock:
+            self.profiled += 1
+            try:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+            except TypeError: # nothing was recorded
+                pass
+
+    def report(self, output_path=None, limit=25):
+        # Text report of the hottest functions and largest allocations. The raw profile is dumped to output_path
+        text = io.StringIO()
+        if self.profile:
+            text.write(f"cProfile: {self.profiled} of {self.calls} renders profiled\n")
+        if self.stats is not None:
+            if output_path:
+                self.stats.dump_stats(output_path)
+            self.stats.stream = text
+            self.stats.sort_stats('cumulative').print_stats(limit)
+        if self.trace_memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            text.write(f"tracemalloc: current {current / 1e6:.1f} MB, peak {peak / 1e6:.1f} MB\n")
+            for statistic in tracemalloc.take_snapshot().statistics('lineno')[:limit]:
+                text.write(f"{statistic}\n")
+            tracemalloc.stop()
+        return text.getvalue()
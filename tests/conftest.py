@@ -0,0 +1,56 @@
+import os, queue, stat, sys, time
+import os.path as op
+
+import pytest
+
+sys.path.insert(0, op.join(op.dirname(op.dirname(op.abspath(__file__))), 'src'))
+
+# Stand-in for the sox executable: prints "PNG <title>" as the image. Titles starting with "gate" wait for the file
+# named by STUB_SOX_GATE, titles starting with "fail" exit with an error, like SoX on a file it cannot open
+STUB_SOX = """
+import os, sys, time
+title = sys.argv[-1]
+gate = os.environ.get('STUB_SOX_GATE')
+if title.startswith('gate') and gate:
+    deadline = time.monotonic() + 30
+    while not os.path.exists(gate) and time.monotonic() < deadline:
+        time.sleep(0.01)
+if title.startswith('fail'):
+    sys.stderr.write('stub sox FAIL formats: cannot open ' + title)
+    sys.exit(2)
+sys.stdout.write('PNG ' + title)
+"""
+
+
+@pytest.fixture
+def stub_sox(tmp_path):
+    if os.name == 'nt':
+        pytest.skip("the stub sox is a script run through its shebang")
+    path = tmp_path / 'sox'
+    path.write_text(f"#!{sys.executable}\n" + STUB_SOX)
+    path.chmod(path.stat().st_mode | stat.S_IXUSR)
+    return str(path)
+
+
+@pytest.fixture
+def gate(tmp_path, monkeypatch):
+    # Path to create to let the "gate" renders finish
+    path = tmp_path / 'gate'
+    monkeypatch.setenv('STUB_SOX_GATE', str(path))
+    return path
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.01)
+
+
+def take(results, count, timeout=10.0):
+    # count items of a queue.Queue filled from other threads
+    try:
+        return [results.get(timeout=timeout) for _ in range(count)]
+    except queue.Empty:
+        raise AssertionError("timed out") from None
@@ -0,0 +1,28 @@
+from SoXspectroCore import RenderJob
+from SoXspectroCache import SpectrogramCache
+
+
+def make_job(tmp_path):
+    audio = tmp_path / 'a.wav'
+    audio.write_bytes(b'RIFF')
+    return RenderJob(str(audio), width=100, height=65, decoder='sox', backend='sox')
+
+
+def test_unwritable_cache_is_a_miss(tmp_path):
+    blocker = tmp_path / 'blocker'
+    blocker.write_bytes(b'') # a file where the cache folder should be
+    cache = SpectrogramCache(str(blocker / 'cache'))
+    job = make_job(tmp_path)
+    cache.put(job, b'PNG')
+    assert cache.get(job) is None
+
+
+def test_clear_only_removes_entries(tmp_path):
+    cache = SpectrogramCache(str(tmp_path / 'cache'))
+    job = make_job(tmp_path)
+    cache.put(job, b'PNG')
+    assert cache.get(job) == b'PNG'
+    other = tmp_path / 'cache' / 'notes.txt'
+    other.write_text("kept")
+    cache.clear()
+    assert cache.get(job) is None and other.exists()
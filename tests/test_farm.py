@@ -0,0 +1,118 @@
+import os, threading, time
+
+from SoXspectroCore import RenderJob
+from SoXspectroFarm import Spool, FarmCoordinator, FarmWorker, claim_job_id, QUEUE, CLAIMED
+from conftest import wait_for
+
+
+def make_spool(tmp_path, **kwargs):
+    return Spool(str(tmp_path / 'spool'), **kwargs)
+
+
+def age(path, seconds):
+    # Makes a claim look like its worker stopped heartbeating seconds ago
+    then = time.time() - seconds
+    os.utime(path, (then, then))
+
+
+def submit(spool, names, sox_path='sox'):
+    coordinator = FarmCoordinator(spool)
+    coordinator.submit(RenderJob('/music/' + name, index, sox_path=sox_path, decoder='sox', backend='sox') for index, name in enumerate(names))
+    return coordinator
+
+
+def test_claims_are_exclusive(tmp_path):
+    spool = make_spool(tmp_path)
+    coordinator = submit(spool, [f'{number}.wav' for number in range(200)])
+    claims = {}
+
+    def worker(name):
+        worker_spool = make_spool(tmp_path) # a worker of another machine lists the queue on its own
+        claimed = claims.setdefault(name, [])
+        while (claim := worker_spool.claim(name)) is not None:
+            claimed.append(claim[1]['path'])
+
+    threads = [threading.Thread(target=worker, args=(f"w{number}",)) for number in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    paths = [path for claimed in claims.values() for path in claimed]
+    assert sorted(paths) == sorted(job.path for job in coordinator.jobs.values())
+    assert spool.names(QUEUE) == [] and len(spool.names(CLAIMED)) == 200
+
+
+def test_stale_claim_is_queued_again(tmp_path):
+    spool = make_spool(tmp_path, stale_seconds=60)
+    submit(spool, ['a.wav', 'b.wav'])
+    stale_path, stale_data = spool.claim('dead')
+    live_path, _ = spool.claim('alive')
+    age(stale_path, 120)
+    age(live_path, 30)
+    spool.reclaim()
+    assert not spool.touch(stale_path) # the dead worker lost its claim
+    assert spool.touch(live_path)
+    [name] = spool.names(QUEUE)
+    assert claim_job_id(name)[1] == 1 # one claim lost
+
+    claim_path, data = make_spool(tmp_path).claim('other')
+    assert data == stale_data
+    assert claim_path.endswith('@other.json')
+
+
+def test_job_fails_after_max_attempts(tmp_path):
+    spool = make_spool(tmp_path, stale_seconds=60, max_attempts=2)
+    coordinator = submit(spool, ['crashy.wav'])
+    for _ in range(2):
+        claim_path, _ = spool.claim('dead')
+        age(claim_path, 120)
+        spool.reclaim()
+    assert spool.names(QUEUE) == [] and spool.names(CLAIMED) == []
+    [result] = coordinator.poll()
+    assert result.job.name == 'crashy.wav' and not result.ok
+    assert "2 workers stopped" in result.error
+    assert coordinator.jobs == {}
+
+
+def test_worker_renders_and_coordinator_collects(tmp_path, stub_sox):
+    spool = make_spool(tmp_path)
+    coordinator = submit(spool, ['a.wav', 'b.wav', 'fail.wav'], stub_sox)
+    worker = FarmWorker(make_spool(tmp_path), threads=2, sox_path=stub_sox, exit_when_idle=True)
+    assert worker.run() == 1
+    results = {result.job.name: result for result in coordinator.poll()}
+    assert results['a.wav'].image == b'PNG a.wav' and results['a.wav'].decoder == 'sox'
+    assert results['b.wav'].ok
+    assert not results['fail.wav'].ok and 'cannot open' in results['fail.wav'].error
+    assert coordinator.jobs == {}
+    assert os.listdir(tmp_path / 'spool' / 'results') == []
+
+
+def test_lost_claim_is_cancelled_and_dropped(tmp_path, stub_sox, gate, capsys):
+    spool = make_spool(tmp_path)
+    coordinator = submit(spool, ['gate.wav'], stub_sox)
+    worker = FarmWorker(make_spool(tmp_path), threads=1, sox_path=stub_sox, heartbeat_seconds=0.05, exit_when_idle=True)
+    thread = threading.Thread(target=worker.run)
+    thread.start()
+    wait_for(lambda: spool.names(CLAIMED))
+    [name] = spool.names(CLAIMED)
+    job_id, _ = claim_job_id(name)
+    # taken back as if the heartbeats had stopped reaching the spool, the worker claims it again
+    os.rename(spool.path(CLAIMED, name), spool.path(QUEUE, f"{job_id}#1.json"))
+    wait_for(lambda: [claim_job_id(name)[1] for name in spool.names(CLAIMED)] == [1])
+    gate.touch()
+    thread.join()
+    assert "Claim lost" in capsys.readouterr().err
+    [result] = coordinator.poll()
+    assert result.ok and worker.done == 1 and worker.failed == 0
+    assert os.listdir(tmp_path / 'spool' / 'done') == []
+
+
+def test_cancel_withdraws_queued_jobs(tmp_path):
+    spool = make_spool(tmp_path)
+    coordinator = submit(spool, ['a.wav', 'b.wav', 'c.wav'])
+    spool.claim('busy') # a.wav, rendered anyway
+    cancelled = coordinator.cancel(lambda job: job.name != 'c.wav')
+    assert sorted(job.name for job in cancelled) == ['a.wav', 'b.wav']
+    other = make_spool(tmp_path)
+    assert other.claim('next')[1]['path'] == '/music/c.wav'
+    assert other.claim('next') is None
@@ -0,0 +1,184 @@
+import json
+
+import pytest
+
+from SoXspectroCore import RenderEngine, RenderJob, preview_job
+from SoXspectroArchive import ArchiveWriter, SpectrogramArchive
+from SoXspectroJournal import BatchJournal, QUEUED, RENDERING, PREVIEWED, DONE, FAILED, CANCELLED
+
+
+@pytest.fixture
+def audio(tmp_path):
+    paths = []
+    for name in ('a.wav', 'b.wav', 'c.wav'):
+        path = tmp_path / name
+        path.write_bytes(b'RIFF' + name.encode())
+        paths.append(str(path))
+    return paths
+
+
+def crash(journal):
+    # The process dies: nothing more is written, renders in progress are not recorded as cancelled
+    journal.file.flush()
+    journal.file.close()
+    journal.file = None
+
+
+def replayed(path):
+    # State of the files as a new process would see them
+    journal = BatchJournal(path)
+    journal.close()
+    return journal
+
+
+def test_replay(tmp_path, audio):
+    path = str(tmp_path / 'batch.jsonl')
+    journal = BatchJournal(path)
+    journal.record_queued(audio)
+    journal.record(audio[0], RENDERING)
+    journal.record(audio[0], DONE, output=audio[0] + '.png')
+    journal.record(audio[1], RENDERING)
+    journal.record(audio[1], FAILED, "SoX error")
+    journal.close()
+
+    journal = BatchJournal(path)
+    assert journal.state(audio[0]).state == DONE
+    assert journal.state(audio[0]).output == audio[0] + '.png'
+    assert (journal.state(audio[1]).state, journal.state(audio[1]).error) == (FAILED, "SoX error")
+    assert journal.state(audio[2]).state == QUEUED
+    assert journal.counts() == {DONE: 1, FAILED: 1, QUEUED: 1}
+    journal.close()
+
+
+def test_replay_skips_torn_line(tmp_path, audio):
+    path = tmp_path / 'batch.jsonl'
+    journal = BatchJournal(str(path))
+    journal.record(audio[0], RENDERING)
+    crash(journal)
+    with open(path, "a", encoding='utf-8') as file:
+        file.write('{"path": "' + audio[1] + '", "sta') # cut by the crash
+
+    journal = BatchJournal(str(path))
+    assert journal.state(audio[1]) is None
+    journal.record(audio[1], DONE)
+    journal.close()
+    lines = path.read_text(encoding='utf-8').splitlines()
+    assert json.loads(lines[-1])['path'] == audio[1] # not appended to the torn line
+    assert replayed(str(path)).state(audio[1]).state == DONE
+
+
+def test_resume_skips_done_and_failed(tmp_path, audio):
+    image = tmp_path / 'a.png'
+    image.write_bytes(b'PNG')
+    params = {'width': 800}
+    journal = BatchJournal(str(tmp_path / 'batch.jsonl'))
+    journal.record(audio[0], DONE, output=str(image), params=params)
+    journal.record(audio[1], FAILED, "SoX error")
+    assert journal.resume(audio, params=params) == ([audio[2]], [audio[0], audio[1]])
+    assert journal.resume(audio, retry_failed=True, params=params) == ([audio[1], audio[2]], [audio[0]])
+    # other options, a deleted image or a modified audio file render again
+    assert journal.resume(audio[:1], params={'width': 1600}) == ([audio[0]], [])
+    (tmp_path / 'a.wav').write_bytes(b'RIFF modified')
+    assert journal.resume(audio[:1], params=params) == ([audio[0]], [])
+    journal.record(audio[0], DONE, output=str(image), params=params)
+    image.unlink()
+    assert journal.resume(audio[:1], params=params) == ([audio[0]], [])
+    journal.close()
+
+
+def test_resume_checks_archive_members(tmp_path, audio):
+    writer = ArchiveWriter('png')
+    [result] = writer.add(b'PNG', str(tmp_path / 'Spectrograms' / 'a.png')) + writer.close()
+    other = str(tmp_path / 'Spectrograms' / 'Spectrograms.sqlite' / 'b.png') # never written
+    journal = BatchJournal(str(tmp_path / 'batch.jsonl'))
+    journal.record(audio[0], DONE, output=result.file_path)
+    journal.record(audio[1], DONE, output=other)
+    assert journal.resume(audio[:2]) == ([audio[1]], [audio[0]])
+    archive = SpectrogramArchive(str(tmp_path / 'Spectrograms' / 'Spectrograms.sqlite'))
+    with archive.connection:
+        archive.connection.execute("DELETE FROM images")
+    archive.close()
+    assert journal.resume(audio[:2]) == (audio[:2], [])
+    journal.close()
+
+
+def test_crashes_are_counted(tmp_path, audio):
+    path = str(tmp_path / 'batch.jsonl')
+    for attempt in range(1, 3):
+        journal = BatchJournal(path, max_attempts=2)
+        todo, skipped = journal.resume(audio[:2])
+        assert todo == audio[:2] and skipped == []
+        journal.record(audio[0], RENDERING)
+        journal.record(audio[1], RENDERING)
+        journal.record(audio[1], DONE) # finished before the crash
+        crash(journal)
+        assert replayed(path).state(audio[0]).attempts == attempt
+
+    journal = BatchJournal(path, max_attempts=2)
+    todo, skipped = journal.resume(audio[:2], skip_done=False)
+    assert todo == [audio[1]] and skipped == [audio[0]]
+    assert journal.state(audio[0]).state == FAILED
+    assert "stopped 2 times" in journal.state(audio[0]).error
+    journal.close()
+
+
+def test_stopping_on_purpose_is_not_a_crash(tmp_path, audio):
+    path = str(tmp_path / 'batch.jsonl')
+    for _ in range(3):
+        journal = BatchJournal(path, max_attempts=2)
+        assert journal.resume(audio[:1]) == (audio[:1], [])
+        journal.record(audio[0], RENDERING)
+        journal.close() # window closed, Ctrl+C: recorded as cancelled
+        assert replayed(path).state(audio[0]).state == CANCELLED
+
+
+def test_only_renders_of_this_process_are_cancelled(tmp_path, audio):
+    path = str(tmp_path / 'batch.jsonl')
+    journal = BatchJournal(path)
+    journal.record(audio[0], RENDERING)
+    crash(journal)
+
+    journal = BatchJournal(path)
+    journal.record(audio[1], RENDERING)
+    journal.cancel_rendering()
+    assert journal.state(audio[0]).state == RENDERING # left by the process that died
+    assert journal.state(audio[1]).state == CANCELLED
+    journal.close()
+
+
+def test_previews_are_journaled(tmp_path, audio):
+    path = str(tmp_path / 'batch.jsonl')
+    journal = BatchJournal(path)
+    journal.record(audio[0], RENDERING) # preview
+    journal.record(audio[0], PREVIEWED)
+    journal.record(audio[1], RENDERING) # preview and full render at once
+    journal.record(audio[1], RENDERING)
+    journal.record(audio[1], PREVIEWED)
+    journal.record(audio[2], RENDERING) # the preview takes the process down
+    crash(journal)
+
+    journal = replayed(path)
+    assert (journal.state(audio[0]).state, journal.state(audio[0]).attempts) == (PREVIEWED, 0)
+    assert (journal.state(audio[1]).state, journal.state(audio[1]).attempts) == (RENDERING, 1)
+    assert (journal.state(audio[2]).state, journal.state(audio[2]).attempts) == (RENDERING, 1)
+
+
+def test_engine_records_failures(tmp_path, stub_sox):
+    journal = BatchJournal(str(tmp_path / 'batch.jsonl'))
+    engine = RenderEngine(2, journal=journal)
+    jobs = [RenderJob(f'/music/{name}', sox_path=stub_sox, decoder='sox', backend='sox') for name in ('ok.wav', 'fail.wav')]
+    results = {result.job.name: result for result in engine.run(jobs)}
+    assert results['ok.wav'].ok and not results['fail.wav'].ok
+    assert journal.state('/music/ok.wav').state == RENDERING # done is recorded by the caller once the image is saved
+    assert journal.state('/music/fail.wav').state == FAILED
+    assert 'cannot open' in journal.state('/music/fail.wav').error
+    journal.close()
+
+
+def test_engine_journals_previews(tmp_path, stub_sox):
+    journal = BatchJournal(str(tmp_path / 'batch.jsonl'))
+    engine = RenderEngine(1, journal=journal)
+    job = RenderJob('/music/a.wav', sox_path=stub_sox, decoder='sox', backend='sox')
+    assert all(result.ok for result in engine.run([preview_job(job)]))
+    assert journal.state('/music/a.wav').state == PREVIEWED
+    journal.close()
@@ -0,0 +1,49 @@
+import struct
+import wave
+
+import numpy as np
+import pytest
+
+from SoXspectroNumpy import wav_layout, stream_samples
+
+
+def write_wav(path, tag, channels, block_align, bits, data=b''):
+    fmt = struct.pack('<HHIIHH', tag, channels, 44100, 44100 * block_align, block_align, bits)
+    body = b'WAVE' + b'fmt ' + struct.pack('<I', len(fmt)) + fmt + b'data' + struct.pack('<I', len(data)) + data
+    path.write_bytes(b'RIFF' + struct.pack('<I', len(body)) + body)
+    return str(path)
+
+
+def test_wav_layout_reads_pcm(tmp_path):
+    path = str(tmp_path / 'a.wav')
+    with wave.open(path, 'wb') as file:
+        file.setnchannels(2)
+        file.setsampwidth(2)
+        file.setframerate(8000)
+        file.writeframes(struct.pack('<4h', 16384, -16384, 0, 32767))
+    assert wav_layout(path) == (44, 8, 2, 2, 8000, False)
+    stream = stream_samples(path)
+    assert next(stream) == (8000, 2, 2)
+    assert np.allclose(next(stream), [[0.5, 0], [-0.5, 32767 / 32768]])
+
+
+def test_wav_layout_uses_the_container_width(tmp_path):
+    # 24 bit samples in 4 byte containers are read as 32 bit samples
+    path = write_wav(tmp_path / 'a.wav', 1, 2, 8, 24, b'\0' * 16)
+    assert wav_layout(path)[2] == 4
+
+
+@pytest.mark.parametrize('header', [
+    b'',  # empty file
+    b'RIFF\0\0',  # truncated header
+])
+def test_wav_layout_rejects_malformed_files(tmp_path, header):
+    path = tmp_path / 'a.wav'
+    path.write_bytes(header)
+    assert wav_layout(str(path)) is None
+
+
+def test_wav_layout_rejects_unread_widths(tmp_path):
+    assert wav_layout(write_wav(tmp_path / 'a.wav', 1, 1, 5, 40)) is None
+    assert wav_layout(write_wav(tmp_path / 'b.wav', 3, 1, 2, 16)) is None # 16 bit float
+    assert wav_layout(write_wav(tmp_path / 'c.wav', 1, 0, 2, 16)) is None # no channels
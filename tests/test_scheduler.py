@@ -0,0 +1,104 @@
+import queue
+
+import pytest
+
+from SoXspectroCore import RenderJob, RenderEngine, RenderScheduler, JobQueue, preview_job, PRIORITY_CLICKED, PRIORITY_PREVIEW, PRIORITY_VISIBLE, PRIORITY_NORMAL
+from SoXspectroCache import SpectrogramCache
+from SoXspectroStats import PipelineStats
+from conftest import wait_for, take
+
+
+def make_job(name, sox_path, priority=PRIORITY_NORMAL, width=100):
+    return RenderJob('/music/' + name, width=width, height=65, sox_path=sox_path, decoder='sox', backend='sox', priority=priority)
+
+
+@pytest.fixture
+def scheduler(stub_sox, gate):
+    # Single worker, held by a "gate" job until the gate file is created, so the queue can be filled meanwhile
+    results = queue.Queue()
+    scheduler = RenderScheduler(results.put, max_workers=1)
+    scheduler.results = results
+    scheduler.gate_job = make_job('gate.wav', stub_sox)
+    scheduler.submit([scheduler.gate_job])
+    wait_for(lambda: scheduler.gate_job.key in scheduler.running)
+    yield scheduler
+    gate.touch()
+    scheduler.close()
+
+
+def test_job_queue_priority_then_submission_order():
+    jobs = [RenderJob(f'/music/{number}.wav', priority=PRIORITY_NORMAL) for number in range(4)]
+    job_queue = JobQueue()
+    for job in jobs:
+        job_queue.put(job)
+    job_queue.update(jobs[2], PRIORITY_CLICKED)
+    job_queue.reprioritize(lambda job: PRIORITY_VISIBLE if job in (jobs[3], jobs[1]) else None)
+    job_queue.remove(jobs[0])
+    order = []
+    while (item := job_queue.get()) is not None:
+        order.append(item[0])
+    assert order == [jobs[2], jobs[1], jobs[3]]
+    assert len(job_queue) == 0
+
+
+def test_scheduler_renders_by_priority(scheduler, stub_sox, gate):
+    normal = make_job('normal.wav', stub_sox)
+    visible = make_job('visible.wav', stub_sox, PRIORITY_VISIBLE)
+    clicked = make_job('clicked.wav', stub_sox, PRIORITY_CLICKED)
+    raised = make_job('raised.wav', stub_sox)
+    assert scheduler.submit([normal, raised, visible, clicked]) == [normal, raised, visible, clicked]
+    # a duplicate of a waiting job raises its priority instead of being queued
+    assert scheduler.submit([make_job('raised.wav', stub_sox, PRIORITY_PREVIEW)]) == []
+    gate.touch()
+    results = take(scheduler.results, 5)
+    assert [result.job.name for result in results] == ['gate.wav', 'clicked.wav', 'raised.wav', 'visible.wav', 'normal.wav']
+    assert all(result.ok for result in results)
+    assert results[1].image == b'PNG clicked.wav'
+
+
+def test_scheduler_skips_duplicates(scheduler, stub_sox, gate):
+    job = make_job('a.wav', stub_sox)
+    assert scheduler.submit([job, make_job('a.wav', stub_sox)]) == [job]
+    assert scheduler.submit([make_job('gate.wav', stub_sox)]) == [] # same as the running job
+    other_size = make_job('a.wav', stub_sox, width=200)
+    assert scheduler.submit([other_size]) == [other_size] # different image
+    gate.touch()
+    results = take(scheduler.results, 3)
+    assert sorted(result.job.width for result in results) == [100, 100, 200]
+    with pytest.raises(AssertionError):
+        take(scheduler.results, 1, timeout=0.5)
+
+
+def test_scheduler_cancel(scheduler, stub_sox, gate):
+    keep, drop = make_job('keep.wav', stub_sox), make_job('drop.wav', stub_sox)
+    scheduler.submit([keep, drop])
+    scheduler.cancel(lambda job: job.name in ('drop.wav', 'gate.wav'))
+    # the waiting job comes back at once, the running one once its SoX process is killed, without opening the gate
+    cancelled = take(scheduler.results, 2, timeout=5)
+    assert {result.job.name for result in cancelled} == {'drop.wav', 'gate.wav'}
+    assert all(result.cancelled and not result.ok for result in cancelled)
+    assert take(scheduler.results, 1)[0].job.name == 'keep.wav'
+    # cancelled jobs can be queued again
+    again = make_job('drop.wav', stub_sox)
+    assert scheduler.submit([again]) == [again]
+    assert take(scheduler.results, 1)[0].ok
+
+
+def test_scheduler_reports_sox_errors(scheduler, stub_sox, gate):
+    gate.touch()
+    scheduler.submit([make_job('fail.wav', stub_sox)])
+    results = take(scheduler.results, 2)
+    failed = results[1]
+    assert failed.job.name == 'fail.wav' and not failed.ok and not failed.cancelled
+    assert 'cannot open' in failed.error
+
+
+def test_previews_are_not_cached_nor_counted(tmp_path, stub_sox):
+    audio = tmp_path / 'a.wav'
+    audio.write_bytes(b'RIFF')
+    cache, stats = SpectrogramCache(str(tmp_path / 'cache')), PipelineStats()
+    engine = RenderEngine(1, cache, stats)
+    job = RenderJob(str(audio), width=100, height=65, sox_path=stub_sox, decoder='sox', backend='sox')
+    assert all(result.ok for result in engine.run([preview_job(job), job]))
+    assert stats.files == 1
+    assert preview_job(job) not in cache and job in cache